@@ -6,8 +6,11 @@ from google.appengine.api import users
 from google.appengine.api import taskqueue
 from google.appengine.ext.webapp.util import login_required
 
+from mapreduce import util
+from ndb import eventloop
 from ndb import model
 from ndb import query
+from ndb import tasklets
 
 import csv
 import logging
@@ -17,6 +20,12 @@ import simplejson
 appid = os.environ['APPLICATION_ID']
 appver = os.environ['CURRENT_VERSION_ID'].split('.')[0]
 
+# Debug mode is on in the dev appserver. Search responses then carry an
+# X-Ndb-Stats header with a summary of where the request spent its time (see
+# ndb.eventloop); elsewhere, admins can add a stats=1 request parameter to get
+# it.
+DEBUG = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
 
 # ------------------------------------------------------------------------------
 # Models
@@ -105,6 +114,9 @@ class Record(model.Model): # key_name=record.occurrenceid, parent=Collection
 class RecordIndex(model.Expando): # parent=Record
     """Index relation for Record."""
 
+    # Index entities are wide; decode properties only when they are used.
+    _lazy_deserialize = True
+
     corpus = model.StringProperty('c', repeated=True) # full text
 
     @classmethod
@@ -142,14 +154,36 @@ class RecordIndex(model.Expando): # parent=Record
                        rec.values()))) # adds tokenized values
         return list(corpus)
     
+# Entities per group_put batch, to stay well within the entity count and
+# size limits of a single transaction.
+GROUP_PUT_BATCH_SIZE = 100
+
+def group_put_multi(entities, batch_size=GROUP_PUT_BATCH_SIZE):
+    """Puts entities with one transaction per entity group and batch."""
+    ctx = tasklets.get_context()
+    keys = []
+    for i in xrange(0, len(entities), batch_size):
+        futures = [ctx.group_put(entity)
+                   for entity in entities[i:i + batch_size]]
+        keys.extend(future.get_result() for future in futures)
+    return keys
+
 # ------------------------------------------------------------------------------
 # Map Reduce
 
-def delete_Record(entity):
-    entity.key().delete()
+# The batch mappers below expect mapreduce.input_readers.DatastoreKeyInputReader
+# and delete each batch of keys with a single call.
 
-def delete_RecordIndex(entity):
-    entity.key().delete()
+def _ndb_keys(keys):
+    return [model.Key(urlsafe=str(key)) for key in keys]
+
+@util.batch_mapper(batch_size=100)
+def delete_Record(keys):
+    model.delete_multi(_ndb_keys(keys))
+
+@util.batch_mapper(batch_size=100)
+def delete_RecordIndex(keys):
+    model.delete_multi(_ndb_keys(keys))
 
 def delete_RecordFullTextIndex(entity):
     entity.key().delete()
@@ -170,12 +204,19 @@ class ApiHandler(BaseHandler):
     def get(self):
         args = dict(
             (name, self.request.get(name).lower().strip()) \
-                for name in self.request.arguments() if name != 'q')        
+                for name in self.request.arguments() if name not in ('q', 'stats'))
         keywords = [x.lower() for x in self.request.get('q', '').split(',') if x]        
+        stats = None
+        if DEBUG or (self.request.get('stats').lower() in ('1', 'true')
+                     and users.is_current_user_admin()):
+            stats = eventloop.enable_stats()
         results = RecordIndex.search(args=args, keywords=keywords)
         self.response.headers["Content-Type"] = "application/json"
         self.response.out.write(
             simplejson.dumps([simplejson.loads(x.record) for x in results]))        
+        if stats is not None:
+            self.response.headers['X-Ndb-Stats'] = stats.short_summary()
+            logging.debug('ndb stats:\n%s', stats.summary())
 
 class LoadTestData(BaseHandler):
     def post(self):
@@ -183,8 +224,13 @@ class LoadTestData(BaseHandler):
         
     @login_required
     def get(self):
-        pkey = Publisher.create('Museum of Vertebrate Zoology').put()
-        ckey = Collection.create('Birds', pkey).put()
+        # Reloading must not clobber an existing publisher or collection.
+        [publisher] = model.get_or_insert_multi(
+            [Publisher.create('Museum of Vertebrate Zoology')])
+        pkey = publisher.key
+        [collection] = model.get_or_insert_multi(
+            [Collection.create('Birds', pkey)])
+        ckey = collection.key
 
         start = int(self.request.get('start'))
         size = int(self.request.get('size'))
@@ -202,8 +248,9 @@ class LoadTestData(BaseHandler):
 
         for rec in reader:
             if created == size:
-                model.put_multi(dc)
-                model.put_multi(dci)
+                # Records and their indexes are all rooted at the
+                # publisher, so each batch is one publisher transaction.
+                group_put_multi(dc + dci)
             rec = dict((k.lower(), v) for k,v in rec.iteritems()) # lowercase all keys
             dc.append(Record.create(rec, ckey))
             dci.append(RecordIndex.create(rec, ckey))
@@ -212,7 +259,8 @@ class LoadTestData(BaseHandler):
 
 class PublisherHandler(BaseHandler):
     def get(self):        
-        response = [simplejson.loads(x.json) for x in Publisher.query().fetch()]
+        publishers = Publisher.query().fetch(projection=[Publisher.json])
+        response = [simplejson.loads(x.json) for x in publishers]
         self.response.headers["Content-Type"] = "application/json"
         self.response.out.write(simplejson.dumps(response))
 
@@ -25,9 +25,14 @@ from handlers such as counters, log messages, mutation pools.
 
 __all__ = ["MAX_ENTITY_COUNT", "MAX_POOL_SIZE", "Context", "MutationPool",
            "Counters", "ItemList", "EntityList", "get", "COUNTER_MAPPER_CALLS",
-           "DATASTORE_DEADLINE"]
+           "DATASTORE_DEADLINE", "DATASTORE_RETRIES"]
+
+import logging
+import time
 
 from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
+from google.appengine.datastore import datastore_rpc
 from google.appengine.ext import db
 
 
@@ -42,6 +47,9 @@ MAX_ENTITY_COUNT = 500
 # Deadline in seconds for mutation pool datastore operations.
 DATASTORE_DEADLINE = 15
 
+# Number of times a failed mutation pool batch is retried.
+DATASTORE_RETRIES = 2
+
 # The name of the counter which counts all mapper calls.
 COUNTER_MAPPER_CALLS = "mapper_calls"
 
@@ -104,15 +112,24 @@ class ItemList(object):
 EntityList = ItemList
 
 
-# TODO(user): mutation pool has no error handling at all. Add some.
 class MutationPool(object):
   """Mutation pool accumulates datastore changes to perform them in batch.
 
+  Batches are written asynchronously: while one batch of puts or deletes is
+  in flight, the next one is filled. Only one batch is in flight at a time,
+  so puts and deletes of the same entity are applied in the order their
+  batches were started. Entities and keys are converted to protocol buffers
+  once, when they are added to the pool, so later changes to them are not
+  seen. Failed batches are retried, unless they put entities with incomplete
+  keys, which the failed attempt may have created already.
+
   Properties:
-    puts: ItemList of entities to put to datastore.
-    deletes: ItemList of keys to delete from datastore.
+    puts: ItemList of entity protocol buffers to put to datastore.
+    deletes: ItemList of key protocol buffers to delete from datastore.
     max_pool_size: maximum single list pool size. List changes will be flushed
       when this size is reached.
+    wait_latency: moving average of the time in seconds spent blocked on in
+      flight batches, i.e. how much datastore writes hold back the mapper.
   """
 
   def __init__(self,
@@ -128,6 +145,13 @@ class MutationPool(object):
     self.max_entity_count = max_entity_count
     self.puts = ItemList()
     self.deletes = ItemList()
+    # The items are protocol buffers already, so send them as they are.
+    self._connection = datastore_rpc.Connection(
+        adapter=datastore_rpc.IdentityAdapter())
+    self._config = datastore_rpc.Configuration(deadline=DATASTORE_DEADLINE)
+    # In flight batch as (rpc, items, start function, retry), or None.
+    self._batch = None
+    self.wait_latency = 0.0
 
   def put(self, entity):
     """Registers entity to put to datastore.
@@ -135,12 +159,13 @@ class MutationPool(object):
     Args:
       entity: an entity or model instance to put.
     """
-    actual_entity = _normalize_entity(entity)
-    entity_size = len(actual_entity._ToPb().Encode())
+    # This is not very nice: we're calling protected methods here...
+    entity_pb = _normalize_entity(entity)._ToPb()
+    entity_size = entity_pb.ByteSize()
     if (self.puts.length >= self.max_entity_count or
         (self.puts.size + entity_size) > self.max_pool_size):
       self.__flush_puts()
-    self.puts.append(actual_entity, entity_size)
+    self.puts.append(entity_pb, entity_size)
 
   def delete(self, entity):
     """Registers entity to delete from datastore.
@@ -148,45 +173,90 @@ class MutationPool(object):
     Args:
       entity: an entity, model instance, or key to delete.
     """
-    # This is not very nice: we're calling two protected methods here...
-    key = _normalize_key(entity)
-    key_size = len(key._ToPb().Encode())
+    key_pb = _normalize_key(entity)._ToPb()
+    key_size = key_pb.ByteSize()
     if (self.deletes.length >= self.max_entity_count or
         (self.deletes.size + key_size) > self.max_pool_size):
       self.__flush_deletes()
-    self.deletes.append(key, key_size)
+    self.deletes.append(key_pb, key_size)
 
-  # TODO(user): some kind of error handling/retries is needed here.
   def flush(self):
-    """Flush(apply) all changed to datastore."""
+    """Flush(apply) all changed to datastore and wait for completion."""
     self.__flush_puts()
     self.__flush_deletes()
+    self._batch = self.__wait(self._batch)
 
   def __flush_puts(self):
-    """Flush all puts to datastore."""
+    """Start writing all puts, after the previous batch completes."""
+    self._batch = self.__wait(self._batch)
     if self.puts.length:
-      datastore.Put(self.puts.items, rpc=self.__create_rpc())
+      retry = True
+      for entity_pb in self.puts.items:
+        last_element = entity_pb.key().path().element_list()[-1]
+        if not (last_element.id() or last_element.name()):
+          retry = False
+          break
+      self._batch = self.__start(self.puts.items,
+                                 self._connection.async_put, retry)
     self.puts.clear()
 
   def __flush_deletes(self):
-    """Flush all deletes to datastore."""
+    """Start all deletes, after the previous batch completes."""
+    self._batch = self.__wait(self._batch)
     if self.deletes.length:
-      datastore.Delete(self.deletes.items, rpc=self.__create_rpc())
+      self._batch = self.__start(self.deletes.items,
+                                 self._connection.async_delete, True)
     self.deletes.clear()
 
-  def __create_rpc(self):
-    """Creates correctly configured RPC object for datastore calls.
+  def __start(self, items, start_function, retry):
+    """Start an asynchronous datastore call for a batch.
+
+    Args:
+      items: list of protocol buffers to write.
+      start_function: connection method starting the call.
+      retry: whether the call may be repeated if it fails.
+
+    Returns:
+      The in flight batch as a tuple (rpc, items, start_function, retry).
+    """
+    return start_function(self._config, items), items, start_function, retry
+
+  def __wait(self, batch):
+    """Wait for an in flight batch, retrying it on transient errors.
+
+    Args:
+      batch: in flight batch as returned by __start(), or None.
 
     Returns:
-      A UserRPC instance.
+      None.
+
+    Raises:
+      The datastore error of the last attempt if all retries failed.
     """
-    return datastore.CreateRPC(deadline=DATASTORE_DEADLINE)
+    if batch is None:
+      return None
+    rpc, items, start_function, can_retry = batch
+    start_time = time.time()
+    for retry in xrange(DATASTORE_RETRIES + 1):
+      try:
+        rpc.get_result()
+        self.wait_latency = (self.wait_latency + time.time() - start_time) / 2
+        return None
+      except (datastore_errors.Timeout,
+              datastore_errors.InternalError), e:
+        if not can_retry or retry == DATASTORE_RETRIES:
+          raise
+        logging.warning("Retrying write of %d items after %s: %s",
+                        len(items), e.__class__.__name__, e)
+        rpc = start_function(self._config, items)
 
 
-# This doesn't do much yet. In future it will play nicely with checkpoint/error
-# handling system.
 class Counters(object):
-  """Regulates access to counters."""
+  """Regulates access to counters.
+
+  Increments are accumulated locally and only added to the shard state's
+  counters map by flush(), which happens once per slice.
+  """
 
   def __init__(self, shard_state):
     """Constructor.
@@ -195,6 +265,8 @@ class Counters(object):
       shard_state: current mapreduce shard state as model.ShardState.
     """
     self._shard_state = shard_state
+    # Maps counter name to the increments not flushed yet.
+    self._deltas = {}
 
   def increment(self, counter_name, delta=1):
     """Increment counter value.
@@ -203,11 +275,32 @@ class Counters(object):
       counter_name: name of the counter as string.
       delta: increment delta as int.
     """
-    self._shard_state.counters_map.increment(counter_name, delta)
+    self._deltas[counter_name] = self._deltas.get(counter_name, 0) + delta
+
+  def get_handle(self, counter_name):
+    """Get a function incrementing a single counter.
+
+    Meant for hot paths, where it is cheaper than increment() or an
+    operation.counters.Increment operation.
+
+    Args:
+      counter_name: name of the counter as string.
+
+    Returns:
+      A function taking an optional int delta (defaults to 1).
+    """
+    deltas = self._deltas
+    def increment(delta=1):
+      deltas[counter_name] = deltas.get(counter_name, 0) + delta
+    return increment
 
   def flush(self):
     """Flush unsaved counter values."""
-    pass
+    counters_map = self._shard_state.counters_map
+    for counter_name, delta in self._deltas.iteritems():
+      counters_map.increment(counter_name, delta)
+    # Handles keep a reference to the dict, so clear it in place.
+    self._deltas.clear()
 
 
 class Context(object):
@@ -256,8 +349,11 @@ class Context(object):
 
   def flush(self):
     """Flush all information recorded in context."""
-    for pool in self._pools.values():
-      pool.flush()
+    for key, pool in self._pools.items():
+      if key != "counters":
+        pool.flush()
+    # Flushing other pools may increment counters, so flush those last.
+    self.counters.flush()
 
   # TODO(user): Add convenience method for mapper params.
 
@@ -25,7 +25,6 @@
 import datetime
 import gc
 import logging
-import math
 import os
 from mapreduce.lib import simplejson
 import time
@@ -48,9 +47,49 @@ _QUOTA_BATCH_SIZE = 20
 # scheduled as soon as current one takes this long.
 _SLICE_DURATION_SEC = 15
 
+# Minimum delay between attempts to consume quota while a shard is rate
+# limited.
+_QUOTA_WAIT_SEC = 0.1
+
+# With the "adaptive_quota" mapper parameter, shards slow down while they
+# spend more than this many seconds waiting for each batch of writes.
+_TARGET_DATASTORE_WAIT_SEC = 0.1
+
 # Delay between consecutive controller callback invocations.
 _CONTROLLER_PERIOD_SEC = 2
 
+# While no shard makes progress, the delay between controller callbacks
+# doubles up to this many seconds.
+_CONTROLLER_MAX_PERIOD_SEC = 16
+
+# Every this many polls the controller reads all shard states, rather than
+# only those whose version changed.
+_FULL_POLL_INTERVAL = 10
+
+# Memcache namespace for shard state versions. A worker bumps the version of
+# its shard each time it saves the shard state.
+_SHARD_VERSION_NAMESPACE = "mapreduce_shard_version"
+
+# Memcache namespace for the shard counter values the controller aggregated
+# into the mapreduce state, tagged with the poll time they were saved at.
+_SHARD_COUNTERS_NAMESPACE = "mapreduce_shard_counters"
+
+# Once this fraction of shards has finished, the controller asks the shards
+# still running to split their remaining input into new shards.
+_STRAGGLER_FINISHED_FRACTION = 0.5
+
+# Shards are only split once they have run this many slices, so shards
+# split off recently get a chance to finish first.
+_MIN_SLICES_BEFORE_SPLIT = 3
+
+# Shards split off shard n in slice s get number (n + 1) * base + s, so a
+# retried slice finds the shard it already split off.
+_SPLIT_SHARD_NUMBER_BASE = 1000000
+
+# Shards may be split until the job has this many times its initial number
+# of shards.
+_MAX_SHARD_SPLIT_FACTOR = 4
+
 
 class Error(Exception):
   """Base class for exceptions in this module."""
@@ -88,6 +127,12 @@ def _run_task_hook(hooks, method, task, queue_name):
   return False
 
 
+def _bump_shard_version(shard_state):
+  """Tell the controller that a shard state has been saved."""
+  memcache.incr(shard_state.shard_id, initial_value=0,
+                namespace=_SHARD_VERSION_NAMESPACE)
+
+
 class MapperWorkerCallbackHandler(util.HugeTaskHandler):
   """Callback handler for mapreduce worker task.
 
@@ -109,6 +154,10 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
   def handle(self):
     """Handle request."""
     tstate = model.TransientShardState.from_request(self.request)
+    if not tstate:
+      logging.error("State not found for mapreduce_id %r; shutting down",
+                    self.request.get("mapreduce_id"))
+      return
     spec = tstate.mapreduce_spec
     self._start_time = self._time()
     shard_id = tstate.shard_id
@@ -132,22 +181,37 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
       shard_state.active = False
       shard_state.result_status = model.ShardState.RESULT_ABORTED
       shard_state.put(config=util.create_datastore_write_config(spec))
+      _bump_shard_version(shard_state)
       model.MapreduceControl.abort(spec.mapreduce_id)
       return
 
+    # Splitting at the start of the slice hands off the same input when the
+    # slice is retried.
+    split_requested = shard_state.split_requested
+    split = split_requested and self.split_shard(shard_state, tstate)
+    if split_requested and not split:
+      # Don't get asked again.
+      shard_state.splittable = False
+
     input_reader = tstate.input_reader
 
+    ctx = context.Context(spec, shard_state,
+                          task_retry_count=self.task_retry_count())
+    context.Context._set(ctx)
+
     if spec.mapper.params.get("enable_quota", True):
-      quota_consumer = quota.QuotaConsumer(
-          quota.QuotaManager(memcache.Client()),
-          shard_id,
-          _QUOTA_BATCH_SIZE)
+      quota_consumer = self.create_quota_consumer(spec, shard_id, ctx)
     else:
       quota_consumer = None
 
-    ctx = context.Context(spec, shard_state,
-                          task_retry_count=self.task_retry_count())
-    context.Context._set(ctx)
+    # Per-slice invariants, hoisted out of the per-item path.
+    self._handler = spec.mapper.handler
+    self._is_generator = util.is_generator_function(self._handler)
+    self._handler_calls = 0
+    self._quota_countdown = None
+    self._count_mapper_calls = ctx.counters.get_handle(
+        context.COUNTER_MAPPER_CALLS)
+    batch_size = util.get_mapper_batch_size(self._handler)
 
     try:
       # consume quota ahead, because we do not want to run a datastore
@@ -155,28 +219,42 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
       if not quota_consumer or quota_consumer.check():
         scan_aborted = False
         entity = None
+        batch = []
 
         # We shouldn't fetch an entity from the reader if there's not enough
         # quota to process it. Perform all quota checks proactively.
-        if not quota_consumer or quota_consumer.consume():
+        if not quota_consumer or self._consume_quota(quota_consumer):
           for entity in input_reader:
-            if isinstance(entity, db.Model):
-              shard_state.last_work_item = repr(entity.key())
+            if batch_size:
+              batch.append(entity)
+              if len(batch) >= batch_size:
+                scan_aborted = not self.process_batch(
+                    batch, input_reader, ctx, tstate)
+                batch = []
             else:
-              shard_state.last_work_item = repr(entity)[:100]
-
-            scan_aborted = not self.process_data(
-                entity, input_reader, ctx, tstate)
+              scan_aborted = not self.process_data(
+                  entity, input_reader, ctx, tstate)
 
             # Check if we've got enough quota for the next entity.
             if (quota_consumer and not scan_aborted and
-                not quota_consumer.consume()):
+                not self._consume_quota(quota_consumer)):
               scan_aborted = True
             if scan_aborted:
               break
         else:
           scan_aborted = True
 
+        # Inputs already taken from the reader must be processed in this
+        # slice, since the reader's position has moved past them.
+        if batch:
+          self.process_batch(batch, input_reader, ctx, tstate)
+
+        if entity is not None:
+          if isinstance(entity, db.Model):
+            shard_state.last_work_item = repr(entity.key())
+          else:
+            shard_state.last_work_item = repr(entity)[:100]
+
 
         if not scan_aborted:
           logging.info("Processing done for shard %d of job '%s'",
@@ -187,6 +265,8 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
             quota_consumer.put(1)
           shard_state.active = False
           shard_state.result_status = model.ShardState.RESULT_SUCCESS
+      else:
+        self._quota_countdown = int(quota_consumer.wait_time())
 
       operation.counters.Increment(
           "mapper-walltime-msec",
@@ -200,7 +280,24 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
         # shard is going to stop. Finalize output writer if any.
         if tstate.output_writer:
           tstate.output_writer.finalize(ctx, shard_state.shard_number)
-      shard_state.put(config=util.create_datastore_write_config(spec))
+      shard_state.slice_count = tstate.slice_id + 1
+      config = util.create_datastore_write_config(spec)
+
+      def save_shard_state():
+        # The controller may have requested a split during this slice.
+        fresh_state = model.ShardState.get_by_shard_id(shard_id)
+        shard_state.split_requested = bool(
+            fresh_state and fresh_state.split_requested and
+            not split_requested)
+        shard_state.put(config=config)
+        if split and shard_state.active:
+          # The narrowed input reader must be saved along with the cleared
+          # split request.
+          self.reschedule(shard_state, tstate, transactional=True,
+                          countdown=self._quota_countdown)
+
+      db.run_in_transaction(save_shard_state)
+      _bump_shard_version(shard_state)
     finally:
       context.Context._set(None)
       if quota_consumer:
@@ -208,8 +305,8 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
 
     # Rescheduling work should always be the last statement. It shouldn't happen
     # if there were any exceptions in code before it.
-    if shard_state.active:
-      self.reschedule(shard_state, tstate)
+    if shard_state.active and not split:
+      self.reschedule(shard_state, tstate, countdown=self._quota_countdown)
     gc.collect()
 
   def process_data(self, data, input_reader, ctx, transient_shard_state):
@@ -225,30 +322,188 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
     Returns:
       True if scan should be continued, False if scan should be aborted.
     """
-    ctx.counters.increment(context.COUNTER_MAPPER_CALLS)
+    self._count_mapper_calls()
+    self._handler_calls += 1
 
-    handler = ctx.mapreduce_spec.mapper.handler
+    handler = self._handler
     if input_reader.expand_parameters:
       result = handler(*data)
     else:
       result = handler(data)
 
-    if util.is_generator_function(handler):
-      for output in result:
-        if isinstance(output, operation.Operation):
-          output(ctx)
-        else:
-          output_writer = transient_shard_state.output_writer
-          if not output_writer:
-            logging.error(
-                "Handler yielded %s, but no output writer is set.", output)
-          else:
-            output_writer.write(output, ctx)
+    if self._is_generator:
+      self._process_outputs(result, ctx, transient_shard_state)
+
+    return not self._slice_expired()
+
+  def process_batch(self, batch, input_reader, ctx, transient_shard_state):
+    """Process a list of data pieces with a batch mapper handler.
+
+    See util.batch_mapper().
+
+    Args:
+      batch: a list of data to process.
+      input_reader: input reader.
+      ctx: current execution context.
+
+    Returns:
+      True if scan should be continued, False if scan should be aborted.
+    """
+    self._count_mapper_calls(len(batch))
+    self._handler_calls += 1
+
+    result = self._handler(batch)
+    if self._is_generator:
+      self._process_outputs(result, ctx, transient_shard_state)
+
+    return not self._slice_expired()
+
+  def _process_outputs(self, result, ctx, transient_shard_state):
+    """Apply operations and write outputs yielded by a handler."""
+    output_writer = transient_shard_state.output_writer
+    for output in result:
+      if isinstance(output, operation.Operation):
+        output(ctx)
+      elif not output_writer:
+        logging.error(
+            "Handler yielded %s, but no output writer is set.", output)
+      else:
+        output_writer.write(output, ctx)
+
+  def create_quota_consumer(self, spec, shard_id, ctx):
+    """Create the quota consumer rate limiting this shard.
+
+    All shards of a job share a token bucket for the "processing_rate"
+    mapper parameter, with an optional "processing_burst" limit. The
+    optional "processing_rate_per_shard" parameter limits each shard as
+    well. With "adaptive_quota", the shard slows down while datastore
+    writes hold it back; its rate defaults to its share of the
+    "processing_rate".
 
-    if self._time() - self._start_time > _SLICE_DURATION_SEC:
-      logging.debug("Spent %s seconds. Rescheduling",
-                    self._time() - self._start_time)
+    Args:
+      spec: mapreduce specification as MapreduceSpec.
+      shard_id: id of the shard.
+      ctx: current execution context.
+
+    Returns:
+      A quota.QuotaConsumer.
+    """
+    params = spec.mapper.params
+    memcache_client = memcache.Client()
+    processing_rate = float(params.get("processing_rate") or
+                            model._DEFAULT_PROCESSING_RATE_PER_SEC)
+    burst = params.get("processing_burst")
+    quota_consumer = quota.QuotaConsumer(
+        quota.TokenBucketManager(memcache_client, processing_rate,
+                                 burst=burst and int(burst)),
+        spec.mapreduce_id,
+        _QUOTA_BATCH_SIZE)
+
+    shard_rate = params.get("processing_rate_per_shard")
+    throttle = None
+    if params.get("adaptive_quota"):
+      mutation_pool = ctx.mutation_pool
+      throttle = quota.LatencyThrottle(lambda: mutation_pool.wait_latency,
+                                       _TARGET_DATASTORE_WAIT_SEC)
+      # The throttle slows the shard down relative to its own rate.
+      shard_rate = shard_rate or (
+          processing_rate / max(1, spec.mapper.shard_count))
+    if shard_rate:
+      quota_consumer = quota.QuotaConsumer(
+          quota.TokenBucketManager(memcache_client, float(shard_rate)),
+          shard_id,
+          _QUOTA_BATCH_SIZE,
+          throttle=throttle,
+          parent=quota_consumer)
+    return quota_consumer
+
+  def _consume_quota(self, quota_consumer):
+    """Consume quota for one input, waiting for it while the slice lasts.
+
+    If the quota won't be available before the slice ends, the slice ends
+    right away and the next one is delayed until then (see
+    self._quota_countdown).
+
+    Returns:
+      True if quota was consumed, False if the slice should end.
+    """
+    while not quota_consumer.consume():
+      wait = max(_QUOTA_WAIT_SEC, quota_consumer.wait_time())
+      remaining = _SLICE_DURATION_SEC - (self._time() - self._start_time)
+      if wait > remaining:
+        self._quota_countdown = int(wait)
+        return False
+      time.sleep(wait)
+    return True
+
+  def _slice_expired(self):
+    """Return True if this slice has run for long enough.
+
+    The slice also ends early if the next handler call is expected to run
+    past _SLICE_DURATION_SEC, judging by the average handler call latency
+    seen so far in this slice.
+    """
+    elapsed = self._time() - self._start_time
+    expected_latency = 0
+    if self._handler_calls:
+      expected_latency = elapsed / self._handler_calls
+    if elapsed + expected_latency > _SLICE_DURATION_SEC:
+      logging.debug("Spent %s seconds. Rescheduling", elapsed)
+      return True
+    return False
+
+  def split_shard(self, shard_state, transient_shard_state):
+    """Hand off part of the shard's remaining input to a new shard.
+
+    Called at the start of a slice when the controller has flagged this
+    shard as a straggler. Only input readers with a split_remaining() method
+    can be split, and only for jobs without an output writer, since output
+    writers are created per shard when the job starts.
+
+    The new shard state is saved together with the task of its first slice.
+    Its number is derived from this shard and slice, so a retried slice
+    doesn't split off another shard.
+
+    Args:
+      shard_state: an instance of ShardState.
+      transient_shard_state: an instance of TransientShardState. Its input
+        reader is narrowed to the input this shard keeps.
+
+    Returns:
+      True if the shard was split, False otherwise.
+    """
+    if transient_shard_state.output_writer:
       return False
+    split_remaining = getattr(transient_shard_state.input_reader,
+                              "split_remaining", None)
+    if split_remaining is None:
+      return False
+    input_reader = split_remaining()
+    if input_reader is None:
+      return False
+
+    spec = transient_shard_state.mapreduce_spec
+    config = util.create_datastore_write_config(spec)
+    shard_number = ((shard_state.shard_number + 1) * _SPLIT_SHARD_NUMBER_BASE +
+                    transient_shard_state.slice_id)
+    new_shard_state = model.ShardState.create_new(
+        spec.mapreduce_id, shard_number)
+    new_shard_state.shard_description = str(input_reader)
+
+    def create_shard_state():
+      if model.ShardState.get_by_shard_id(new_shard_state.shard_id):
+        return
+      new_shard_state.put(config=config)
+      MapperWorkerCallbackHandler._schedule_slice(
+          new_shard_state,
+          model.TransientShardState(
+              transient_shard_state.base_path, spec, new_shard_state.shard_id,
+              0, input_reader),
+          transactional=True)
+
+    db.run_in_transaction(create_shard_state)
+    logging.info("Shard %d of job '%s' split off shard %d",
+                 shard_state.shard_number, spec.mapreduce_id, shard_number)
     return True
 
   @staticmethod
@@ -266,15 +521,19 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
     return "appengine-mrshard-%s-%s" % (
         shard_id, slice_id)
 
-  def reschedule(self, shard_state, transient_shard_state):
+  def reschedule(self, shard_state, transient_shard_state,
+                 transactional=False, countdown=None):
     """Reschedule worker task to continue scanning work.
 
     Args:
       transient_shard_state: an instance of TransientShardState.
+      transactional: whether to add the task within the current transaction.
+      countdown: delay in seconds before the task as int, or None.
     """
     transient_shard_state.slice_id += 1
     MapperWorkerCallbackHandler._schedule_slice(
-        shard_state, transient_shard_state)
+        shard_state, transient_shard_state, transactional=transactional,
+        countdown=countdown)
 
   @classmethod
   def _schedule_slice(cls,
@@ -282,7 +541,8 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
                       transient_shard_state,
                       queue_name=None,
                       eta=None,
-                      countdown=None):
+                      countdown=None,
+                      transactional=False):
     """Schedule slice scanning by adding it to the task queue.
 
     Args:
@@ -295,13 +555,17 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
         timezone-naive.
       countdown: Time in seconds into the future that this MR should execute.
         Defaults to zero.
+      transactional: whether to add the task within the current transaction.
+        Transactional tasks can't be named.
     """
     base_path = transient_shard_state.base_path
     mapreduce_spec = transient_shard_state.mapreduce_spec
 
-    task_name = MapperWorkerCallbackHandler.get_task_name(
-        transient_shard_state.shard_id,
-        transient_shard_state.slice_id)
+    task_name = None
+    if not transactional:
+      task_name = MapperWorkerCallbackHandler.get_task_name(
+          transient_shard_state.shard_id,
+          transient_shard_state.slice_id)
     queue_name = queue_name or os.environ.get("HTTP_X_APPENGINE_QUEUENAME",
                                               "default")
 
@@ -316,7 +580,8 @@ class MapperWorkerCallbackHandler(util.HugeTaskHandler):
                           worker_task,
                           queue_name):
       try:
-        worker_task.add(queue_name, parent=shard_state)
+        worker_task.add(queue_name, transactional=transactional,
+                        parent=shard_state)
       except (taskqueue.TombstonedTaskError,
               taskqueue.TaskAlreadyExistsError), e:
         logging.warning("Task %r with params %r already exists. %s: %s",
@@ -363,8 +628,23 @@ class ControllerCallbackHandler(util.HugeTaskHandler):
                     spec.mapreduce_id)
       return
 
-    shard_states = model.ShardState.find_by_mapreduce_id(spec.mapreduce_id)
-    if state.active and len(shard_states) != spec.mapper.shard_count:
+    last_summaries = self.last_shard_summaries(state.last_poll_time)
+    last_shard_counters = self.last_shard_counters(last_summaries)
+    if last_shard_counters is None:
+      # Aggregate from scratch.
+      last_summaries = None
+    shard_states, versions, changed = self.load_shard_states(
+        spec, last_summaries, last_shard_counters)
+    if state.active and not changed:
+      # Nothing to aggregate; check again later.
+      ControllerCallbackHandler.reschedule(
+          state, self.base_path(), spec, self.serial_id() + 1,
+          shard_summaries=last_summaries,
+          countdown=min(2 * self.poll_period(), _CONTROLLER_MAX_PERIOD_SEC))
+      return
+
+    # Straggler shards may have been split, adding shards to the job.
+    if state.active and len(shard_states) < spec.mapper.shard_count:
       # Some shards were lost
       logging.error("Incorrect number of shard states: %d vs %d; "
                     "aborting job '%s'",
@@ -384,6 +664,8 @@ class ControllerCallbackHandler(util.HugeTaskHandler):
       state.active_shards = len(active_shards)
       state.failed_shards = len(failed_shards)
       state.aborted_shards = len(aborted_shards)
+      if state.active:
+        self.request_splits(spec, shard_states, active_shards)
 
     if (not state.active and control and
         control.command == model.MapreduceControl.ABORT):
@@ -405,8 +687,8 @@ class ControllerCallbackHandler(util.HugeTaskHandler):
 
     # We don't need a transaction here, since we change only statistics data,
     # and we don't care if it gets overwritten/slightly inconsistent.
-    self.aggregate_state(state, shard_states)
-    poll_time = state.last_poll_time
+    shard_counters = self.aggregate_state(
+        state, shard_states, last_shard_counters)
     state.last_poll_time = datetime.datetime.utcfromtimestamp(self._time())
 
     config = util.create_datastore_write_config(spec)
@@ -441,56 +723,221 @@ class ControllerCallbackHandler(util.HugeTaskHandler):
     else:
       state.put(config=config)
 
-    processing_rate = int(spec.mapper.params.get(
-        "processing_rate") or model._DEFAULT_PROCESSING_RATE_PER_SEC)
-    self.refill_quotas(poll_time, processing_rate, active_shards)
+    # Shards missing from an eventually consistent query keep their summary.
+    # Only changed shard counters are saved again.
+    poll_time = str(state.last_poll_time)
+    shard_summaries = dict(last_summaries or {})
+    changed_counters = {}
+    for shard_state in shard_states:
+      shard_id = shard_state.shard_id
+      counters = shard_counters[shard_id]
+      if (last_summaries and shard_id in last_summaries and
+          counters == last_shard_counters.get(shard_id)):
+        counters_poll_time = last_summaries[shard_id]["counters_poll_time"]
+      else:
+        counters_poll_time = poll_time
+        changed_counters[shard_id] = (poll_time, counters)
+      shard_summaries[shard_id] = {
+          "version": versions.get(shard_id),
+          "active": shard_state.active,
+          "result_status": shard_state.result_status,
+          "split_requested": shard_state.split_requested,
+          "splittable": shard_state.splittable,
+          "slice_count": shard_state.slice_count,
+          "counters_poll_time": counters_poll_time}
+    memcache.set_multi(changed_counters, namespace=_SHARD_COUNTERS_NAMESPACE)
     ControllerCallbackHandler.reschedule(
-        state, self.base_path(), spec, self.serial_id() + 1)
+        state, self.base_path(), spec, self.serial_id() + 1,
+        shard_summaries=shard_summaries)
 
-  def aggregate_state(self, mapreduce_state, shard_states):
+  def aggregate_state(self, mapreduce_state, shard_states,
+                      last_shard_counters=None):
     """Update current mapreduce state by aggregating shard states.
 
     Args:
       mapreduce_state: current mapreduce state as MapreduceState.
       shard_states: all shard states (active and inactive). list of ShardState.
+      last_shard_counters: shard counter values already aggregated into
+        mapreduce_state, as a dict from shard id to a dict of counter values.
+        Only the changes since are added. If None, counters are aggregated
+        from scratch.
+
+    Returns:
+      The shard counter values now aggregated into mapreduce_state, in the
+      form of last_shard_counters.
     """
     processed_counts = []
-    mapreduce_state.counters_map.clear()
+    counters_map = mapreduce_state.counters_map
+    if last_shard_counters is None:
+      counters_map.clear()
+      last_shard_counters = {}
+    # Keep shards missing from this (eventually consistent) query, so their
+    # counters aren't added twice when they show up again.
+    shard_counters = dict(last_shard_counters)
 
     for shard_state in shard_states:
-      mapreduce_state.counters_map.add_map(shard_state.counters_map)
+      counters = shard_state.counters_map.counters
+      last_counters = last_shard_counters.get(shard_state.shard_id, {})
+      if counters != last_counters:
+        for counter_name, value in counters.iteritems():
+          delta = value - last_counters.get(counter_name, 0)
+          if delta:
+            counters_map.increment(counter_name, delta)
+      shard_counters[shard_state.shard_id] = counters
       processed_counts.append(shard_state.counters_map.get(
           context.COUNTER_MAPPER_CALLS))
 
     mapreduce_state.set_processed_counts(processed_counts)
+    return shard_counters
+
+  def load_shard_states(self, spec, last_summaries, last_shard_counters):
+    """Load the shard states of a job.
+
+    Only shards whose version changed since the previous poll are read from
+    the datastore; the others are rebuilt from their summaries. All shard
+    states are read on the first poll, every _FULL_POLL_INTERVAL polls, and
+    before deciding that no shard is active, since shards split off since
+    the previous full read are not known yet.
+
+    Args:
+      spec: mapreduce specification as MapreduceSpec.
+      last_summaries: shard summaries saved by the previous poll, as returned
+        by last_shard_summaries().
+      last_shard_counters: shard counter values of the previous poll, as
+        returned by last_shard_counters().
 
-  def refill_quotas(self,
-                    last_poll_time,
-                    processing_rate,
-                    active_shard_states):
-    """Refill quotas for all active shards.
+    Returns:
+      A tuple (shard_states, versions, changed): a list of ShardState, a dict
+      from shard id to its version, and whether any shard state changed.
+    """
+    if (last_summaries is not None and
+        self.serial_id() % _FULL_POLL_INTERVAL):
+      shard_ids = sorted(last_summaries)
+      versions = memcache.get_multi(shard_ids,
+                                    namespace=_SHARD_VERSION_NAMESPACE)
+      changed_ids = [shard_id for shard_id in shard_ids
+                     if versions.get(shard_id) is None or
+                     versions[shard_id] != last_summaries[shard_id]["version"]]
+      loaded = db.get([model.ShardState.get_key_by_shard_id(shard_id)
+                       for shard_id in changed_ids])
+      loaded = dict((s.shard_id, s) for s in loaded if s)
+      shard_states = [
+          loaded.get(shard_id) or self._shard_state_from_summary(
+              spec, shard_id, last_summaries[shard_id],
+              last_shard_counters[shard_id])
+          for shard_id in shard_ids]
+      if [s for s in shard_states if s.active]:
+        return shard_states, versions, bool(changed_ids)
+
+    shard_states = model.ShardState.find_by_mapreduce_id(spec.mapreduce_id)
+    versions = memcache.get_multi([s.shard_id for s in shard_states],
+                                  namespace=_SHARD_VERSION_NAMESPACE)
+    return shard_states, versions, True
+
+  @staticmethod
+  def _shard_state_from_summary(spec, shard_id, summary, counters):
+    """Rebuild an unchanged shard state from its summary. Never saved."""
+    return model.ShardState(
+        key_name=shard_id,
+        mapreduce_id=spec.mapreduce_id,
+        active=summary["active"],
+        result_status=summary["result_status"],
+        split_requested=summary["split_requested"],
+        splittable=summary.get("splittable", True),
+        slice_count=summary.get("slice_count", 0),
+        counters_map=model.CountersMap(dict(counters)))
+
+  def last_shard_summaries(self, last_poll_time):
+    """Get the shard summaries saved by the previous poll.
 
     Args:
-      last_poll_time: Datetime with the last time the job state was updated.
-      processing_rate: How many items to process per second overall.
-      active_shard_states: All active shard states, list of ShardState.
+      last_poll_time: last_poll_time of the loaded mapreduce state.
+
+    Returns:
+      A dict from shard id to a dict with the shard's "version", "active",
+      "result_status", "split_requested", "splittable" and "slice_count"
+      values, and the
+      "counters_poll_time" at which its counters were saved, as aggregated
+      into the mapreduce state. None if the request doesn't have them, or
+      they don't belong to the loaded mapreduce state (e.g. when this task is
+      retried after saving it).
     """
-    if not active_shard_states:
-      return
-    quota_manager = quota.QuotaManager(memcache.Client())
+    shard_summaries_json = self.request.get("shard_summaries")
+    if not shard_summaries_json:
+      return None
+    shard_summaries_json = simplejson.loads(shard_summaries_json)
+    if shard_summaries_json["poll_time"] != str(last_poll_time):
+      return None
+    return shard_summaries_json["shards"]
+
+  def last_shard_counters(self, last_summaries):
+    """Get the shard counter values aggregated by the previous poll.
+
+    Args:
+      last_summaries: shard summaries saved by the previous poll, as returned
+        by last_shard_summaries().
 
-    current_time = int(self._time())
-    last_poll_time = time.mktime(last_poll_time.timetuple())
-    total_quota_refill = processing_rate * max(0, current_time - last_poll_time)
-    quota_refill = int(math.ceil(
-        1.0 * total_quota_refill / len(active_shard_states)))
+    Returns:
+      A dict from shard id to a dict of counter values, or None if the
+      summaries or any of the counter values saved with them are missing.
+    """
+    if last_summaries is None:
+      return None
+    saved = memcache.get_multi(last_summaries.keys(),
+                               namespace=_SHARD_COUNTERS_NAMESPACE)
+    shard_counters = {}
+    for shard_id, summary in last_summaries.iteritems():
+      if (shard_id not in saved or
+          saved[shard_id][0] != summary["counters_poll_time"]):
+        return None
+      shard_counters[shard_id] = saved[shard_id][1]
+    return shard_counters
+
+  def poll_period(self):
+    """Get the delay in seconds before this task from request."""
+    return int(self.request.get("poll_period", _CONTROLLER_PERIOD_SEC))
+
+  def request_splits(self, spec, shard_states, active_shard_states):
+    """Ask straggler shards to split their remaining input.
+
+    Once most shards have finished, the shards still running hold up the
+    job, since they have the most input left. They are flagged, and split by
+    their workers at the start of their next slice (see
+    MapperWorkerCallbackHandler.split_shard). Shards which failed to split
+    before, or ran only a few slices so far, are left alone.
 
-    if not quota_refill:
+    Args:
+      spec: mapreduce specification as MapreduceSpec.
+      shard_states: all shard states (active and inactive). list of ShardState.
+      active_shard_states: all active shard states, list of ShardState.
+    """
+    if spec.mapper.output_writer_class():
       return
+    finished = len(shard_states) - len(active_shard_states)
+    if finished < len(shard_states) * _STRAGGLER_FINISHED_FRACTION:
+      return
+    # Every split request can add one shard.
+    budget = (spec.mapper.shard_count * _MAX_SHARD_SPLIT_FACTOR -
+              len(shard_states))
+    budget -= len([s for s in active_shard_states if s.split_requested])
+    stragglers = [
+        s for s in active_shard_states
+        if not s.split_requested and s.splittable and
+        s.slice_count >= _MIN_SLICES_BEFORE_SPLIT]
+    config = util.create_datastore_write_config(spec)
+
+    def request_split(shard_id):
+      shard_state = model.ShardState.get_by_shard_id(shard_id)
+      if (shard_state and shard_state.active and shard_state.splittable and
+          not shard_state.split_requested):
+        shard_state.split_requested = True
+        shard_state.put(config=config)
 
-    # TODO(user): use batch memcache API to refill quota in one API call.
-    for shard_state in active_shard_states:
-      quota_manager.put(shard_state.shard_id, quota_refill)
+    for shard_state in stragglers[:max(0, budget)]:
+      # The worker writes its shard state at the end of every slice, so
+      # only update a fresh copy of it.
+      db.run_in_transaction(request_split, shard_state.shard_id)
+      _bump_shard_version(shard_state)
 
   def serial_id(self):
     """Get serial unique identifier of this task from request.
@@ -516,7 +963,8 @@ class ControllerCallbackHandler(util.HugeTaskHandler):
         mapreduce_spec.mapreduce_id, serial_id)
 
   @staticmethod
-  def controller_parameters(mapreduce_spec, serial_id):
+  def controller_parameters(mapreduce_spec, serial_id, shard_summaries=None,
+                            poll_time=None, poll_period=_CONTROLLER_PERIOD_SEC):
     """Fill in  controller task parameters.
 
     Returned parameters map is to be used as task payload, and it contains
@@ -525,12 +973,22 @@ class ControllerCallbackHandler(util.HugeTaskHandler):
     Args:
       mapreduce_spec: specification of the mapreduce.
       serial_id: id of the invocation as int.
+      shard_summaries: shard summaries aggregated so far, as returned by
+        last_shard_summaries(), or None.
+      poll_time: last_poll_time of the mapreduce state holding the
+        aggregated shard_summaries.
+      poll_period: delay in seconds before the task as int.
 
     Returns:
       string->string map of parameters to be used as task payload.
     """
-    return {"mapreduce_spec": mapreduce_spec.to_json_str(),
-            "serial_id": str(serial_id)}
+    params = {"mapreduce_spec": mapreduce_spec.to_json_str(),
+              "serial_id": str(serial_id),
+              "poll_period": str(poll_period)}
+    if shard_summaries is not None:
+      params["shard_summaries"] = simplejson.dumps(
+          {"poll_time": str(poll_time), "shards": shard_summaries})
+    return params
 
   @classmethod
   def reschedule(cls,
@@ -538,7 +996,9 @@ class ControllerCallbackHandler(util.HugeTaskHandler):
                  base_path,
                  mapreduce_spec,
                  serial_id,
-                 queue_name=None):
+                 queue_name=None,
+                 shard_summaries=None,
+                 countdown=_CONTROLLER_PERIOD_SEC):
     """Schedule new update status callback task.
 
     Args:
@@ -548,18 +1008,22 @@ class ControllerCallbackHandler(util.HugeTaskHandler):
       serial_id: id of the invocation as int.
       queue_name: The queue to schedule this task on. Will use the current
         queue of execution if not supplied.
+      shard_summaries: shard summaries aggregated into mapreduce_state, as
+        returned by last_shard_summaries(), or None.
+      countdown: delay in seconds before the task as int.
     """
     task_name = ControllerCallbackHandler.get_task_name(
         mapreduce_spec, serial_id)
     task_params = ControllerCallbackHandler.controller_parameters(
-        mapreduce_spec, serial_id)
+        mapreduce_spec, serial_id, shard_summaries,
+        mapreduce_state.last_poll_time, countdown)
     if not queue_name:
       queue_name = os.environ.get("HTTP_X_APPENGINE_QUEUENAME", "default")
 
     controller_callback_task = util.HugeTask(
         url=base_path + "/controller_callback",
         name=task_name, params=task_params,
-        countdown=_CONTROLLER_PERIOD_SEC)
+        countdown=countdown)
 
     if not _run_task_hook(mapreduce_spec.get_hooks(),
                           "enqueue_controller_task",
@@ -688,14 +1152,6 @@ class KickOffJobHandler(util.HugeTaskHandler):
             if shard.key() not in existing_shard_keys),
            config=util.create_datastore_write_config(spec))
 
-    # Give each shard some quota to start with.
-    processing_rate = int(spec.mapper.params.get(
-        "processing_rate") or model._DEFAULT_PROCESSING_RATE_PER_SEC)
-    quota_refill = processing_rate / len(shard_states)
-    quota_manager = quota.QuotaManager(memcache.Client())
-    for shard_state in shard_states:
-      quota_manager.put(shard_state.shard_id, quota_refill)
-
     # Schedule shard tasks.
     for shard_number, (input_reader, output_writer) in enumerate(
         zip(input_readers, output_writers)):
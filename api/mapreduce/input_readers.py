@@ -39,6 +39,7 @@ __all__ = [
 # pylint: disable-msg=C6409
 
 import copy
+import heapq
 import StringIO
 import time
 import zipfile
@@ -171,6 +172,9 @@ class AbstractDatastoreInputReader(InputReader):
   # __scatter__ oversampling factor
   _OVERSAMPLING_FACTOR = 32
 
+  # Number of __scatter__ keys sampled to split an open-ended KeyRange.
+  _SPLIT_SAMPLE_SIZE = 64
+
   # The maximum number of namespaces that will be sharded by datastore key
   # before switching to a strategy where sharding is done lexographically by
   # namespace.
@@ -307,28 +311,135 @@ class AbstractDatastoreInputReader(InputReader):
     else:
       return repr(self._ns_range)
 
+  def split_remaining(self):
+    """Splits off part of the remaining input into a new input reader.
+
+    Used to rebalance a running job. The remaining KeyRanges are divided
+    between this reader and the returned one; a single remaining KeyRange is
+    split in half, or at a sampled key if it is open-ended. Readers over a
+    NamespaceRange are never split.
+
+    Returns:
+      A new InputReader of the same class for the split off input, or None
+      if the remaining input can't be split.
+    """
+    if self._key_ranges is None:
+      return None
+
+    # Remaining ranges in processing order.
+    remaining = list(reversed(self._key_ranges))
+    if self._current_key_range is not None:
+      remaining.insert(0, self._current_key_range)
+
+    if len(remaining) > 1:
+      middle = (len(remaining) + 1) / 2
+      kept, split_off = remaining[:middle], remaining[middle:]
+    elif remaining:
+      ranges = remaining[0].split_range()
+      if len(ranges) < 2:
+        # Open-ended ranges, like the last one of a kind, can't be bisected.
+        ranges = self._split_key_range_by_scatter(remaining[0])
+      if len(ranges) < 2:
+        return None
+      kept, split_off = ranges[:1], ranges[1:]
+    else:
+      return None
+
+    # Round trip through json so subclasses keep their own parameters.
+    reader = self.from_json(self.to_json())
+    reader._key_ranges = list(reversed(split_off))
+    reader._current_key_range = None
+    self._key_ranges = list(reversed(kept))
+    self._current_key_range = None
+    return reader
+
+  def _split_key_range_by_scatter(self, k_range):
+    """Split a KeyRange at the median of the sampled keys within it.
+
+    The start of the range is the last key processed, if any.
+
+    Args:
+      k_range: a key_range.KeyRange.
+
+    Returns:
+      A list of two KeyRanges covering k_range, or [k_range] if no sampled
+      key falls within it.
+    """
+    ds_query = datastore.Query(kind=util.get_short_name(self._entity_kind),
+                               namespace=k_range.namespace,
+                               _app=k_range._app,
+                               keys_only=True)
+    ds_query.Order("__scatter__")
+    keys = sorted(key for key in ds_query.Get(self._SPLIT_SAMPLE_SIZE)
+                  if (k_range.key_start is None or key > k_range.key_start) and
+                  (k_range.key_end is None or key < k_range.key_end))
+    if not keys:
+      return [k_range]
+    split_key = keys[len(keys) / 2]
+    return [key_range.KeyRange(key_start=k_range.key_start,
+                               key_end=split_key,
+                               direction=key_range.KeyRange.ASC,
+                               include_start=k_range.include_start,
+                               include_end=False,
+                               namespace=k_range.namespace,
+                               _app=k_range._app),
+            key_range.KeyRange(key_start=split_key,
+                               key_end=k_range.key_end,
+                               direction=key_range.KeyRange.ASC,
+                               include_start=True,
+                               include_end=k_range.include_end,
+                               namespace=k_range.namespace,
+                               _app=k_range._app)]
+
   @classmethod
   def _choose_split_points(cls, random_keys, shard_count):
     """Returns the best split points given a random set of db.Keys."""
+    return cls._choose_split_points_and_sizes(random_keys, shard_count)[0]
+
+  @classmethod
+  def _choose_split_points_and_sizes(cls, random_keys, shard_count):
+    """Returns split points and estimated sizes of the ranges between them.
+
+    The random keys are a __scatter__ sample, so the number of sampled keys
+    in a range is proportional to the number of entities in it.
+
+    Args:
+      random_keys: a list of db.Keys sampled by __scatter__ order.
+      shard_count: the number of ranges wanted.
+
+    Returns:
+      A tuple (split_points, sizes). split_points is a sorted list of db.Keys.
+      sizes is a list of len(split_points) + 1 sample counts, one for the
+      range before each split point and one for the range after the last.
+    """
+    random_keys = sorted(random_keys)
     if len(random_keys) < shard_count:
-      return sorted(random_keys)
+      indexes = range(len(random_keys))
+    else:
+      index_stride = len(random_keys) / float(shard_count)
+      indexes = [int(round(index_stride * i)) for i in range(1, shard_count)]
 
-    index_stride = len(random_keys) / float(shard_count)
-    return [sorted(random_keys)[int(round(index_stride * i))]
-            for i in range(1, shard_count)]
+    bounds = [0] + indexes + [len(random_keys)]
+    sizes = [bounds[i + 1] - bounds[i] for i in range(len(bounds) - 1)]
+    return [random_keys[i] for i in indexes], sizes
 
   # TODO(user): use query splitting functionality when it becomes available
   # instead.
   @classmethod
   def _split_input_from_namespace(cls, app, namespace, entity_kind_name,
                                   shard_count):
-    """Return KeyRange objects. Helper for _split_input_from_params."""
+    """Return KeyRange objects. Helper for _split_input_from_params.
+
+    Returns:
+      A tuple (key_ranges, sizes) of KeyRanges and their estimated relative
+      sizes.
+    """
 
     raw_entity_kind = util.get_short_name(entity_kind_name)
 
     if shard_count == 1:
       # With one shard we don't need to calculate any splitpoints at all.
-      return [key_range.KeyRange(namespace=namespace, _app=app)]
+      return [key_range.KeyRange(namespace=namespace, _app=app)], [1]
 
     # we use datastore.Query instead of ext.db.Query here, because we can't
     # erase ordering on db.Query once we set it.
@@ -341,9 +452,10 @@ class AbstractDatastoreInputReader(InputReader):
     if not random_keys:
       # This might mean that there are no entities with scatter property
       # or there are no entities at all.
-      return [key_range.KeyRange(namespace=namespace, _app=app)]
+      return [key_range.KeyRange(namespace=namespace, _app=app)], [1]
     else:
-      random_keys = cls._choose_split_points(random_keys, shard_count)
+      random_keys, sizes = cls._choose_split_points_and_sizes(
+          random_keys, shard_count)
 
     key_ranges = []
 
@@ -375,26 +487,71 @@ class AbstractDatastoreInputReader(InputReader):
         namespace=namespace,
         _app=app))
 
-    return key_ranges
+    return key_ranges, sizes
+
+  @classmethod
+  def _get_entity_count(cls, app, namespace, entity_kind_name):
+    """Return the number of entities of a kind in a namespace.
+
+    Returns:
+      The entity count from datastore statistics, or None if there are no
+      statistics for the kind yet.
+    """
+    stats_query = datastore.Query(
+        "__Stat_Ns_Kind__",
+        {"kind_name =": util.get_short_name(entity_kind_name)},
+        namespace=namespace,
+        _app=app)
+    stats = stats_query.Get(1)
+    if not stats:
+      return None
+    return stats[0]["count"]
 
   @classmethod
   def _split_input_from_params(cls, app, namespaces, entity_kind_name,
                                params, shard_count):
     """Return input reader objects. Helper for split_input."""
     key_ranges = []  # KeyRanges for all namespaces
+    sizes = []
+    ns_splits = []
     for namespace in namespaces:
-      key_ranges.extend(
-          cls._split_input_from_namespace(app,
-                                          namespace,
-                                          entity_kind_name,
-                                          shard_count))
+      ns_key_ranges, ns_sizes = cls._split_input_from_namespace(
+          app, namespace, entity_kind_name, shard_count)
+      entity_count = None
+      if len(namespaces) > 1:
+        entity_count = cls._get_entity_count(app, namespace, entity_kind_name)
+      ns_splits.append((ns_key_ranges, ns_sizes, entity_count))
+
+    # Sample counts are capped per namespace, so scale them to entity counts
+    # to compare ranges of different namespaces. Namespaces without
+    # statistics are scaled by the average entities per sampled key.
+    counted = [(sum(ns_sizes), entity_count)
+               for _, ns_sizes, entity_count in ns_splits
+               if entity_count is not None]
+    entities_per_sample = 1.0
+    if counted:
+      entities_per_sample = (float(sum(c for _, c in counted)) /
+                             max(1, sum(n for n, _ in counted)))
+    for ns_key_ranges, ns_sizes, entity_count in ns_splits:
+      if entity_count is None:
+        scale = entities_per_sample
+      else:
+        scale = float(entity_count) / max(1, sum(ns_sizes))
+      key_ranges.extend(ns_key_ranges)
+      sizes.extend(size * scale for size in ns_sizes)
 
     # Divide the KeyRanges into shard_count shards. The KeyRanges for different
-    # namespaces might be very different in size so the assignment of KeyRanges
-    # to shards is done round-robin.
-    shared_ranges = [[] for _ in range(shard_count)]
-    for i, k_range in enumerate(key_ranges):
-      shared_ranges[i % shard_count].append(k_range)
+    # namespaces might be very different in size, so they are assigned largest
+    # first, each to the shard with the smallest estimated size so far.
+    shard_loads = [(0, i) for i in range(shard_count)]
+    assignments = [[] for _ in range(shard_count)]
+    for index in sorted(range(len(key_ranges)), key=lambda i: -sizes[i]):
+      load, shard = heapq.heappop(shard_loads)
+      assignments[shard].append(index)
+      heapq.heappush(shard_loads, (load + sizes[index], shard))
+    # Each shard processes its KeyRanges in key order.
+    shared_ranges = [[key_ranges[i] for i in sorted(indexes)]
+                     for indexes in assignments]
     batch_size = int(params.get(cls.BATCH_SIZE_PARAM, cls._BATCH_SIZE))
     return [cls(entity_kind_name,
                 key_ranges=key_ranges,
@@ -1273,8 +1430,9 @@ class ConsistentKeyReader(DatastoreKeyInputReader):
                                   namespace,
                                   entity_kind_name,
                                   shard_count):
-    key_ranges = super(ConsistentKeyReader, cls)._split_input_from_namespace(
-        app, namespace, entity_kind_name, shard_count)
+    key_ranges, sizes = super(
+        ConsistentKeyReader, cls)._split_input_from_namespace(
+            app, namespace, entity_kind_name, shard_count)
 
     # The KeyRanges calculated by the base class may not include keys for
     # entities that have unapplied jobs. So use an open key range for the first
@@ -1284,7 +1442,7 @@ class ConsistentKeyReader(DatastoreKeyInputReader):
       key_ranges[0].include_start = False
       key_ranges[-1].key_end = None
       key_ranges[-1].include_end = False
-    return key_ranges
+    return key_ranges, sizes
 
   @classmethod
   def _split_input_from_params(cls, app, namespaces, entity_kind_name,
@@ -1474,15 +1632,17 @@ class RecordsReader(InputReader):
     Yields records as strings.
     """
     ctx = context.get()
+    if ctx:
+      count_read_msec = ctx.counters.get_handle(COUNTER_IO_READ_MSEC)
+      count_read_bytes = ctx.counters.get_handle(COUNTER_IO_READ_BYTES)
 
     while self._reader:
       try:
         start_time = time.time()
         record = self._reader.read()
         if ctx:
-          operation.counters.Increment(
-              COUNTER_IO_READ_MSEC, int((time.time() - start_time) * 1000))(ctx)
-          operation.counters.Increment(COUNTER_IO_READ_BYTES, len(record))(ctx)
+          count_read_msec(int((time.time() - start_time) * 1000))
+          count_read_bytes(len(record))
         yield record
       except EOFError:
         self._filenames.pop(0)
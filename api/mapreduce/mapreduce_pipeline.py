@@ -47,6 +47,14 @@ class MapPipeline(base_handler.PipelineBase):
     input_reader_spec: input reader specification as string.
     params: mapper and input reader parameters as dict.
     shards: number of shards to start as int.
+    combiner_spec: optional specification of the combiner function, which is
+      called as combiner(key, values) on buffered map output of each shard
+      and yields values of the same kind as the mapper.
+    partitioner_spec: optional specification of the partitioner assigning
+      keys to reduce shards, e.g. shuffler.RangePartitioner. Defaults to
+      shuffler.HashPartitioner.
+    reduce_shards: number of reduce shards as int. Defaults to the number of
+      map shards.
 
   Returns:
     list of filenames list sharded by hash code.
@@ -57,7 +65,17 @@ class MapPipeline(base_handler.PipelineBase):
           mapper_spec,
           input_reader_spec,
           params,
-          shards=None):
+          shards=None,
+          combiner_spec=None,
+          partitioner_spec=None,
+          reduce_shards=None):
+    params = dict(params or {})
+    if combiner_spec:
+      params[shuffler.COMBINER_SPEC_PARAM] = combiner_spec
+    if partitioner_spec:
+      params[shuffler.PARTITIONER_SPEC_PARAM] = partitioner_spec
+    if reduce_shards:
+      params[shuffler.REDUCE_SHARDS_PARAM] = reduce_shards
     yield MapperPipeline(
         job_name + "-map",
         mapper_spec,
@@ -162,6 +180,11 @@ class MapreducePipeline(base_handler.PipelineBase):
     mapper_params: parameters to use for mapper phase.
     reducer_params: parameters to use for reduce phase.
     shards: number of shards to use as int.
+    combiner_spec: optional specification of the combiner to run over map
+      output before the shuffle, see MapPipeline.
+    partitioner_spec: optional specification of the partitioner assigning
+      keys to reduce shards, see MapPipeline.
+    reduce_shards: number of reduce shards as int. Defaults to shards.
 
   Returns:
     filenames from output writer.
@@ -175,12 +198,18 @@ class MapreducePipeline(base_handler.PipelineBase):
           output_writer_spec=None,
           mapper_params=None,
           reducer_params=None,
-          shards=None):
+          shards=None,
+          combiner_spec=None,
+          partitioner_spec=None,
+          reduce_shards=None):
     map_pipeline = yield MapPipeline(job_name,
                                      mapper_spec,
                                      input_reader_spec,
                                      params=mapper_params,
-                                     shards=shards)
+                                     shards=shards,
+                                     combiner_spec=combiner_spec,
+                                     partitioner_spec=partitioner_spec,
+                                     reduce_shards=reduce_shards)
     shuffler_pipeline = yield ShufflePipeline(map_pipeline)
     reducer_pipeline = yield ReducePipeline(job_name,
                                             reducer_spec,
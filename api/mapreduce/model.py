@@ -30,6 +30,7 @@ __all__ = ["JsonMixin", "JsonProperty", "MapreduceState", "MapperSpec",
            "MapreduceControl", "MapreduceSpec", "ShardState", "CountersMap",
            "TransientShardState"]
 
+import base64
 import copy
 import datetime
 import logging
@@ -38,6 +39,7 @@ import os
 from mapreduce.lib import simplejson
 import time
 import types
+import zlib
 
 from google.appengine.api import datastore_errors
 from google.appengine.api import datastore_types
@@ -55,6 +57,15 @@ _DEFAULT_PROCESSING_RATE_PER_SEC = 1000000
 # Default number of shards to have.
 _DEFAULT_SHARD_COUNT = 8
 
+# Version of the TransientShardState task payload encoding.
+_TRANSIENT_STATE_VERSION = 1
+
+# Maximum number of MapreduceSpecs cached for TransientShardState.
+_MAX_CACHED_SPECS = 100
+
+# Maps mapreduce id to its MapreduceSpec, see TransientShardState.
+_spec_cache = {}
+
 
 class JsonMixin(object):
   """Simple, stateless json utilities mixin.
@@ -660,28 +671,79 @@ class TransientShardState(object):
     self.output_writer = output_writer
 
   def to_dict(self):
-    """Convert state to dictionary to save in task payload."""
-    result = {"mapreduce_spec": self.mapreduce_spec.to_json_str(),
-              "shard_id": self.shard_id,
-              "slice_id": str(self.slice_id),
-              "input_reader_state": self.input_reader.to_json_str()}
+    """Convert state to dictionary to save in task payload.
+
+    The MapreduceSpec doesn't change while the job runs and is saved in
+    its MapreduceState, so only the mapreduce id is included. The rest of
+    the state is encoded as versioned, compressed json in a single value.
+    """
+    state = {"shard_id": self.shard_id,
+             "slice_id": self.slice_id,
+             "input_reader_state": self.input_reader.to_json()}
     if self.output_writer:
-      result["output_writer_state"] = self.output_writer.to_json_str()
-    return result
+      state["output_writer_state"] = self.output_writer.to_json()
+    encoded_state = base64.urlsafe_b64encode(zlib.compress(
+        simplejson.dumps(state, separators=(",", ":"))))
+    return {"mapreduce_id": self.mapreduce_spec.mapreduce_id,
+            "state": "%d:%s" % (_TRANSIENT_STATE_VERSION, encoded_state)}
+
+  @classmethod
+  def _get_mapreduce_spec(cls, mapreduce_id):
+    """Get the MapreduceSpec of a job, cached in memory.
+
+    Args:
+      mapreduce_id: mapreduce id as string.
+
+    Returns:
+      MapreduceSpec of the job, or None if its MapreduceState is not found.
+    """
+    spec = _spec_cache.get(mapreduce_id)
+    if spec is None:
+      state = MapreduceState.get_by_job_id(mapreduce_id)
+      if state is None:
+        return None
+      spec = state.mapreduce_spec
+      if len(_spec_cache) >= _MAX_CACHED_SPECS:
+        _spec_cache.clear()
+      _spec_cache[mapreduce_id] = spec
+    return spec
 
   @classmethod
   def from_request(cls, request):
-    """Create new TransientShardState from webapp request."""
-    mapreduce_spec = MapreduceSpec.from_json_str(request.get("mapreduce_spec"))
+    """Create new TransientShardState from webapp request.
+
+    Returns:
+      A TransientShardState, or None if the state of the mapreduce it belongs
+      to no longer exists.
+    """
+    if request.get("state"):
+      version, encoded_state = request.get("state").split(":", 1)
+      if int(version) != _TRANSIENT_STATE_VERSION:
+        raise ValueError("Unsupported shard state version: %s" % version)
+      state = simplejson.loads(zlib.decompress(
+          base64.urlsafe_b64decode(str(encoded_state))))
+      mapreduce_spec = cls._get_mapreduce_spec(request.get("mapreduce_id"))
+      if mapreduce_spec is None:
+        return None
+    else:
+      # Payload of a task scheduled before the encoding above was used.
+      state = {"shard_id": request.get("shard_id"),
+               "slice_id": request.get("slice_id"),
+               "input_reader_state": simplejson.loads(
+                   request.get("input_reader_state")),
+               "output_writer_state": simplejson.loads(
+                   request.get("output_writer_state", "{}"))}
+      mapreduce_spec = MapreduceSpec.from_json_str(
+          request.get("mapreduce_spec"))
+
     mapper_spec = mapreduce_spec.mapper
-    input_reader_spec_dict = simplejson.loads(request.get("input_reader_state"))
     input_reader = mapper_spec.input_reader_class().from_json(
-        input_reader_spec_dict)
+        state["input_reader_state"])
 
     output_writer = None
     if mapper_spec.output_writer_class():
       output_writer = mapper_spec.output_writer_class().from_json(
-          simplejson.loads(request.get("output_writer_state", "{}")))
+          state.get("output_writer_state", {}))
       assert isinstance(output_writer, mapper_spec.output_writer_class()), (
           "%s.from_json returned an instance of wrong class: %s" % (
               mapper_spec.output_writer_class(),
@@ -692,8 +754,8 @@ class TransientShardState(object):
 
     return cls(base_path,
                mapreduce_spec,
-               str(request.get("shard_id")),
-               int(request.get("slice_id")),
+               str(state["shard_id"]),
+               int(state["slice_id"]),
                input_reader,
                output_writer=output_writer)
 
@@ -715,6 +777,10 @@ class ShardState(db.Model):
     update_time: The last time this shard state was updated.
     shard_description: A string description of the work this shard will do.
     last_work_item: A string description of the last work item processed.
+    split_requested: if the controller asked this shard to hand off part of
+      its remaining input to a new shard as boolean.
+    splittable: False once the shard failed to split its remaining input.
+    slice_count: number of slices this shard has run as int.
   """
 
   RESULT_SUCCESS = "success"
@@ -727,6 +793,9 @@ class ShardState(db.Model):
   active = db.BooleanProperty(default=True, indexed=False)
   counters_map = JsonProperty(CountersMap, default=CountersMap(), indexed=False)
   result_status = db.StringProperty(choices=_RESULTS, indexed=False)
+  split_requested = db.BooleanProperty(default=False, indexed=False)
+  splittable = db.BooleanProperty(default=True, indexed=False)
+  slice_count = db.IntegerProperty(default=0, indexed=False)
 
   # For UI purposes only.
   mapreduce_id = db.StringProperty(required=True)
@@ -18,10 +18,15 @@
 
 
 
+import time
+
 
 # Memcache namespace to use.
 _QUOTA_NAMESPACE = "quota"
 
+# Memcache namespace to use for token buckets.
+_TOKEN_BUCKET_NAMESPACE = "token_bucket"
+
 # Offset all quota values by this amount since memcache incr/decr
 # operate only with unsigned values.
 _OFFSET = 2**32
@@ -109,6 +114,157 @@ class QuotaManager(object):
     self.memcache_client.set(bucket, amount + _OFFSET,
                              namespace=_QUOTA_NAMESPACE)
 
+  def wait_time(self, bucket, amount):
+    """Get the time until the bucket may have enough quota.
+
+    Buckets are refilled manually, so this isn't known.
+
+    Args:
+      bucket: quota bucket as string.
+      amount: amount of quota as int.
+
+    Returns:
+      0.
+    """
+    return 0
+
+
+class TokenBucketManager(object):
+  """Token bucket rate limiter, backed by memcache storage.
+
+  Like QuotaManager, this is best effort only. It has the same interface, so
+  it can be used by a QuotaConsumer.
+
+  Each bucket gains tokens at a fixed rate, up to a burst limit. Nobody has
+  to refill buckets: the only stored value is the number of tokens consumed
+  since the epoch, and the number of available tokens is computed from it
+  and the current time when tokens are consumed. All managers of a bucket
+  must use the same rate.
+  """
+
+  def __init__(self, memcache_client, rate, burst=None,
+               time_function=time.time):
+    """Initialize new instance.
+
+    Args:
+      memcache_client: an instance of memcache client to use.
+      rate: tokens gained per second as float.
+      burst: maximum number of available tokens as int. Defaults to one
+        second worth of tokens.
+      time_function: time function to use to obtain current time.
+    """
+    self.memcache_client = memcache_client
+    self.rate = float(rate)
+    if burst is None:
+      burst = max(1, int(self.rate))
+    self.burst = int(burst)
+    self._time = time_function
+
+  def _granted(self):
+    """Returns the number of tokens gained since the epoch."""
+    return int(self.rate * self._time())
+
+  def put(self, bucket, amount):
+    """Put unused tokens back into the bucket.
+
+    Args:
+      bucket: bucket name as string.
+      amount: number of tokens as int.
+    """
+    if amount > 0:
+      self.memcache_client.decr(bucket, delta=amount,
+                                namespace=_TOKEN_BUCKET_NAMESPACE)
+
+  def consume(self, bucket, amount, consume_some=False):
+    """Consume tokens from the bucket.
+
+    Args:
+      bucket: bucket name as string.
+      amount: number of tokens to consume.
+      consume_some: specifies behavior in case of not enough tokens. If False,
+        the method will leave the bucket intact and return 0. If True, will try
+        to consume as much as possible.
+
+    Returns:
+      Number of tokens consumed.
+    """
+    granted = self._granted()
+    # A new bucket starts full.
+    consumed = self.memcache_client.incr(
+        bucket, delta=amount, initial_value=granted - self.burst,
+        namespace=_TOKEN_BUCKET_NAMESPACE)
+    if consumed is None:
+      return 0
+
+    available = granted - consumed + amount
+    if available > self.burst:
+      # The bucket was idle; drop the tokens over the burst limit.
+      self.memcache_client.incr(bucket, delta=available - self.burst,
+                                namespace=_TOKEN_BUCKET_NAMESPACE)
+      available = self.burst
+
+    if available >= amount:
+      return amount
+    if consume_some and available > 0:
+      self.put(bucket, amount - available)
+      return available
+    self.put(bucket, amount)
+    return 0
+
+  def get(self, bucket):
+    """Get the number of available tokens.
+
+    Args:
+      bucket: bucket name as string.
+
+    Returns:
+      current number of available tokens as int.
+    """
+    consumed = self.memcache_client.get(bucket,
+                                        namespace=_TOKEN_BUCKET_NAMESPACE)
+    if consumed is None:
+      return self.burst
+    return max(0, min(self.burst, self._granted() - int(consumed)))
+
+  def wait_time(self, bucket, amount):
+    """Get the time until the bucket gains enough tokens.
+
+    Args:
+      bucket: bucket name as string.
+      amount: number of tokens as int.
+
+    Returns:
+      time in seconds as float, assuming nobody else consumes tokens.
+    """
+    missing = min(amount, self.burst) - self.get(bucket)
+    return max(0.0, missing / self.rate)
+
+
+class LatencyThrottle(object):
+  """Quota cost factor derived from an observed latency.
+
+  Used as a QuotaConsumer throttle: while the latency is above the target,
+  every unit of quota costs proportionally more, which slows the consumer
+  down without changing the rate of the shared bucket.
+  """
+
+  def __init__(self, latency_function, target_latency, max_factor=10.0):
+    """Initialize new instance.
+
+    Args:
+      latency_function: function returning the current latency in seconds.
+      target_latency: latency in seconds below which there's no throttling.
+      max_factor: maximum cost factor as float.
+    """
+    self.latency_function = latency_function
+    self.target_latency = target_latency
+    self.max_factor = max_factor
+
+  def __call__(self):
+    """Returns the current cost factor as float, at least 1."""
+    factor = self.latency_function() / self.target_latency
+    return max(1.0, min(self.max_factor, factor))
+
 
 class QuotaConsumer(object):
   """Quota consumer wrapper for efficient quota consuming/reclaiming.
@@ -119,18 +275,43 @@ class QuotaConsumer(object):
   consistent.
   """
 
-  def __init__(self, quota_manager, bucket, batch_size):
+  def __init__(self, quota_manager, bucket, batch_size, throttle=None,
+               parent=None):
     """Initialize new instance.
 
     Args:
-      quota_manager: quota manager to use for quota operations as QuotaManager.
+      quota_manager: quota manager to use for quota operations as QuotaManager
+        or TokenBucketManager.
       bucket: quota bucket name as string.
       batch_size: batch size for quota consuming as int.
+      throttle: optional function returning a cost factor of at least 1 to
+        apply to consumed amounts, e.g. a LatencyThrottle. It is called once
+        per batch.
+      parent: optional QuotaConsumer which has to grant all quota consumed
+        from this one as well, e.g. for a bucket shared with other consumers.
     """
     self.quota_manager = quota_manager
     self.batch_size = batch_size
     self.bucket = bucket
+    self.throttle = throttle
+    self.parent = parent
     self.quota = 0
+    self.cost = 1.0
+
+  def _consume_batch(self):
+    """Consume a batch of quota from the buckets.
+
+    Returns:
+      Amount of quota consumed as int.
+    """
+    delta = self.quota_manager.consume(self.bucket, self.batch_size,
+                                       consume_some=True)
+    # The parent is charged for the items, not their throttled cost here.
+    if (delta and self.parent and
+        not self.parent.consume(delta / self.cost)):
+      self.quota_manager.put(self.bucket, delta)
+      return 0
+    return delta
 
   def consume(self, amount=1):
     """Consume quota.
@@ -142,12 +323,14 @@ class QuotaConsumer(object):
       True if quota was successfully consumed, False if there's not enough
       quota.
     """
+    amount *= self.cost
     while self.quota < amount:
-      delta = self.quota_manager.consume(self.bucket, self.batch_size,
-                                         consume_some=True)
+      delta = self._consume_batch()
       if not delta:
         return False
       self.quota += delta
+      if self.throttle:
+        self.cost = self.throttle()
 
     self.quota -= amount
     return True
@@ -158,7 +341,7 @@ class QuotaConsumer(object):
     Args:
       amount: amount of quota as int.
     """
-    self.quota += amount
+    self.quota += amount * self.cost
 
   def check(self, amount=1):
     """Check that we have enough quota right now.
@@ -173,13 +356,34 @@ class QuotaConsumer(object):
       True if we have enough quota to consume specified amount right now. False
       otherwise.
   """
+    amount *= self.cost
     if self.quota >= amount:
       return True
+    if (self.parent and
+        not self.parent.check((amount - self.quota) / self.cost)):
+      return False
     return self.quota + self.quota_manager.get(self.bucket) >= amount
 
+  def wait_time(self):
+    """Get the time until the next batch of quota may be available.
+
+    Returns:
+      time in seconds as float.
+    """
+    wait = 0.0
+    if self.quota < self.cost:
+      wait = self.quota_manager.wait_time(self.bucket, self.batch_size)
+    if self.parent:
+      wait = max(wait, self.parent.wait_time())
+    return wait
+
   def dispose(self):
     """Dispose QuotaConsumer and put all actually unconsumed quota back.
 
     This method has to be called for quota consistency!
     """
-    self.quota_manager.put(self.bucket, self.quota)
+    quota = int(self.quota)
+    self.quota_manager.put(self.bucket, quota)
+    if self.parent:
+      self.parent.put(self.quota / self.cost)
+      self.parent.dispose()
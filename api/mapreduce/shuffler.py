@@ -21,10 +21,12 @@ from __future__ import with_statement
 
 
 
+import bisect
 import gc
 import heapq
 import logging
 import time
+import zlib
 
 from mapreduce.lib import pipeline
 from mapreduce.lib import files
@@ -36,8 +38,134 @@ from mapreduce import context
 from mapreduce import errors
 from mapreduce import input_readers
 from mapreduce import mapper_pipeline
-from mapreduce import operation
 from mapreduce import output_writers
+from mapreduce import util
+
+
+# Mapper parameter with the combiner function specification, see
+# _CombinerPool.
+COMBINER_SPEC_PARAM = "combiner_spec"
+
+# Approximate number of bytes of map output buffered for the combiner.
+_COMBINER_BUFFER_SIZE = 1024 * 1024
+
+# Mapper parameter with the partitioner specification, see HashPartitioner.
+PARTITIONER_SPEC_PARAM = "partitioner_spec"
+
+# Mapper parameter with the number of reduce shards. Defaults to the number
+# of map shards.
+REDUCE_SHARDS_PARAM = "reduce_shards"
+
+# Mapper parameter with the sorted partition boundary keys of
+# RangePartitioner.
+PARTITION_KEYS_PARAM = "partition_keys"
+
+
+class HashPartitioner(object):
+  """Partitions keys by a stable hash of the key.
+
+  Partitioners are specified by the partitioner_spec mapper parameter. The
+  spec is resolved with util.for_name and called with the mapper parameters,
+  and the result is called as partitioner(key, num_partitions) for every key
+  to return the partition index. Unlike the builtin hash(), the hash used
+  here doesn't depend on the platform or the python version.
+  """
+
+  def __init__(self, params=None):
+    """Constructor.
+
+    Args:
+      params: mapper parameters as dict.
+    """
+
+  def __call__(self, key, num_partitions):
+    """Get the partition of a key.
+
+    Args:
+      key: key as string.
+      num_partitions: number of partitions as int.
+
+    Returns:
+      partition index as int.
+    """
+    return (zlib.crc32(key) & 0xffffffff) % num_partitions
+
+
+class RangePartitioner(object):
+  """Partitions keys into consecutive key ranges.
+
+  The ranges are bounded by the sorted partition_keys mapper parameter,
+  which has one key less than there are partitions, see
+  choose_partition_keys(). Since reducers see their keys in sorted order,
+  concatenating reduce outputs in shard order gives globally sorted output.
+  """
+
+  def __init__(self, params):
+    """Constructor.
+
+    Args:
+      params: mapper parameters as dict.
+
+    Raises:
+      BadWriterParamsError: if partition keys are missing or not sorted.
+    """
+    keys = params.get(PARTITION_KEYS_PARAM)
+    if not keys:
+      raise errors.BadWriterParamsError(
+          "Missing %s parameter." % PARTITION_KEYS_PARAM)
+    self._keys = [str(key) for key in keys]
+    if self._keys != sorted(self._keys):
+      raise errors.BadWriterParamsError(
+          "%s parameter should be sorted." % PARTITION_KEYS_PARAM)
+
+  def __call__(self, key, num_partitions):
+    """Get the partition of a key.
+
+    Args:
+      key: key as string.
+      num_partitions: number of partitions as int.
+
+    Returns:
+      partition index as int.
+    """
+    return min(bisect.bisect_right(self._keys, key), num_partitions - 1)
+
+
+def choose_partition_keys(sample_keys, num_partitions):
+  """Choose RangePartitioner boundaries from a sample of keys.
+
+  Args:
+    sample_keys: iterable of sampled keys as strings.
+    num_partitions: number of partitions as int.
+
+  Returns:
+    sorted list of at most num_partitions - 1 keys splitting the sample
+    into ranges of about the same size.
+  """
+  sample_keys = sorted(set(str(key) for key in sample_keys))
+  if not sample_keys or num_partitions < 2:
+    return []
+  partition_keys = []
+  for i in range(1, num_partitions):
+    key = sample_keys[i * len(sample_keys) // num_partitions]
+    if not partition_keys or partition_keys[-1] != key:
+      partition_keys.append(key)
+  return partition_keys
+
+
+def _create_partitioner(params):
+  """Create the partitioner of a job.
+
+  Args:
+    params: mapper parameters as dict.
+
+  Returns:
+    partitioner as a callable taking key and number of partitions.
+  """
+  partitioner_spec = params.get(PARTITIONER_SPEC_PARAM)
+  if partitioner_spec:
+    return util.for_name(partitioner_spec)(params)
+  return HashPartitioner(params)
 
 
 class _OutputFile(db.Model):
@@ -208,6 +336,10 @@ class _MergingReader(input_readers.InputReader):
     mapper_spec = ctx.mapreduce_spec.mapper
     shard_number = ctx.shard_state.shard_number
     filenames = mapper_spec.params[self.FILES_PARAM][shard_number]
+    count_read_bytes = ctx.counters.get_handle(
+        input_readers.COUNTER_IO_READ_BYTES)
+    count_read_msec = ctx.counters.get_handle(
+        input_readers.COUNTER_IO_READ_MSEC)
 
     if len(filenames) != len(self._offsets):
       raise Exception("Files list and offsets do not match.")
@@ -241,13 +373,8 @@ class _MergingReader(input_readers.InputReader):
         start_time = time.time()
         binary_record = reader.read()
         # update counters
-        if context.get():
-          operation.counters.Increment(
-              input_readers.COUNTER_IO_READ_BYTES,
-              len(binary_record))(context.get())
-          operation.counters.Increment(
-              input_readers.COUNTER_IO_READ_MSEC,
-              int((time.time() - start_time) * 1000))(context.get())
+        count_read_bytes(len(binary_record))
+        count_read_msec(int((time.time() - start_time) * 1000))
         proto = file_service_pb.KeyValue()
         proto.ParseFromString(binary_record)
         # Put read data back into heap.
@@ -288,13 +415,89 @@ class _MergingReader(input_readers.InputReader):
       raise errors.BadReaderParamsError("Missing files parameter.")
 
 
+class _CombinerPool(object):
+  """Pool combining map output by key before it is written.
+
+  Values are grouped by key in memory. Whenever the buffer is full, and at
+  the end of every slice, each key's values are passed to the combiner
+  function and only what it yields is written for the key. The combiner
+  is called as combiner(key, values) with strings, and yields values of the
+  same kind as the mapper, e.g. partial sums. The reducer then gets the
+  combined values of each map shard and slice instead of the raw ones.
+  """
+
+  # Approximate memory used by the Python objects holding each buffered
+  # key (dict entry and value list) and value (string and list slot),
+  # on top of their data, so that many tiny values still fill the buffer.
+  _KEY_OVERHEAD_BYTES = 100
+  _VALUE_OVERHEAD_BYTES = 40
+
+  def __init__(self, combiner, partitioner, filenames, ctx,
+               max_size=_COMBINER_BUFFER_SIZE):
+    """Constructor.
+
+    Args:
+      combiner: combiner function.
+      partitioner: partitioner choosing the file of a key.
+      filenames: list of filenames the writer outputs to.
+      ctx: mapreduce context as context.Context.
+      max_size: approximate buffer size in bytes as int, counting Python
+        object overhead. Buffered values are combined and written once this
+        size is reached.
+    """
+    self._combiner = combiner
+    self._partitioner = partitioner
+    self._filenames = filenames
+    self._ctx = ctx
+    self._max_size = max_size
+    self._groups = {}
+    self._size = 0
+
+  def append(self, key, value):
+    """Buffer a key/value pair.
+
+    Args:
+      key: key as string.
+      value: value as string.
+    """
+    values = self._groups.get(key)
+    if values is None:
+      values = self._groups[key] = []
+      self._size += len(key) + self._KEY_OVERHEAD_BYTES
+    values.append(value)
+    self._size += len(value) + self._VALUE_OVERHEAD_BYTES
+    if self._size >= self._max_size:
+      self.flush()
+
+  def flush(self):
+    """Combine buffered values and write them."""
+    # Records pools are flushed here rather than registered with the
+    # context, since the context may have flushed those already.
+    pools = {}
+    for key, values in self._groups.iteritems():
+      file_index = self._partitioner(key, len(self._filenames))
+      pool = pools.get(file_index)
+      if pool is None:
+        pool = pools[file_index] = output_writers.RecordsPool(
+            filename=self._filenames[file_index], ctx=self._ctx)
+      for value in self._combiner(key, values):
+        proto = file_service_pb.KeyValue()
+        proto.set_key(key)
+        proto.set_value(str(value))
+        pool.append(proto.Encode())
+    for pool in pools.itervalues():
+      pool.flush()
+    self._groups = {}
+    self._size = 0
+
+
 class _KeyValueBlobstoreOutputWriter(output_writers.BlobstoreOutputWriterBase):
   """An OutputWriter which outputs data into blobstore in key-value format.
 
   The output is tailored towards shuffler needs. Each mapper shard creates
-  number of outpupt files equal to the number of shards itself. On each
-  output it hashes the key and picks a file corresponding to a key. This way,
-  file 0 from all shards will have all key/values with the same hash key modulo.
+  number of output files equal to the number of reduce shards. On each
+  output it partitions the key and picks a file corresponding to a key. This
+  way, file 0 from all shards will have all key/values of partition 0.
   """
 
   def __init__(self, filenames):
@@ -304,6 +507,7 @@ class _KeyValueBlobstoreOutputWriter(output_writers.BlobstoreOutputWriterBase):
       filenames: list of filenames that this writer outputs to.
     """
     self._filenames = filenames
+    self._partitioner = None
 
   @classmethod
   def validate(cls, mapper_spec):
@@ -314,6 +518,25 @@ class _KeyValueBlobstoreOutputWriter(output_writers.BlobstoreOutputWriterBase):
     """
     if mapper_spec.output_writer_class() != cls:
       raise errors.BadWriterParamsError("Output writer class mismatch")
+    params = mapper_spec.params
+    reduce_shards = params.get(REDUCE_SHARDS_PARAM, mapper_spec.shard_count)
+    try:
+      reduce_shards = int(reduce_shards)
+      if reduce_shards < 1:
+        raise ValueError()
+    except (TypeError, ValueError):
+      raise errors.BadWriterParamsError(
+          "%s should be a positive integer." % REDUCE_SHARDS_PARAM)
+    try:
+      partitioner = _create_partitioner(params)
+    except ImportError, e:
+      raise errors.BadWriterParamsError("Bad partitioner spec: %s" % e)
+    if (isinstance(partitioner, RangePartitioner) and
+        len(params[PARTITION_KEYS_PARAM]) >= reduce_shards):
+      raise errors.BadWriterParamsError(
+          "%d %s for %d reduce shards, expected at most %d." %
+          (len(params[PARTITION_KEYS_PARAM]), PARTITION_KEYS_PARAM,
+           reduce_shards, reduce_shards - 1))
 
   @classmethod
   def init_job(cls, mapreduce_state):
@@ -323,8 +546,9 @@ class _KeyValueBlobstoreOutputWriter(output_writers.BlobstoreOutputWriterBase):
       mapreduce_state: an instance of model.MapreduceState describing current
       job. State can be modified during initialization.
     """
-    shards = mapreduce_state.mapreduce_spec.mapper.shard_count
-    subshards = shards
+    mapper_spec = mapreduce_state.mapreduce_spec.mapper
+    shards = mapper_spec.shard_count
+    subshards = int(mapper_spec.params.get(REDUCE_SHARDS_PARAM, shards))
 
     filenames = []
     for i in range(shards):
@@ -431,7 +655,15 @@ class _KeyValueBlobstoreOutputWriter(output_writers.BlobstoreOutputWriterBase):
       logging.error("Expecting a tuple, but got %s: %s",
                     data.__class__.__name__, data)
 
-    file_index = key.__hash__() % len(self._filenames)
+    if self._partitioner is None:
+      self._partitioner = _create_partitioner(ctx.mapreduce_spec.mapper.params)
+
+    combiner_pool = self._get_combiner_pool(ctx)
+    if combiner_pool:
+      combiner_pool.append(key, value)
+      return
+
+    file_index = self._partitioner(key, len(self._filenames))
     pool_name = "kv_pool%d" % file_index
     filename = self._filenames[file_index]
 
@@ -442,3 +674,21 @@ class _KeyValueBlobstoreOutputWriter(output_writers.BlobstoreOutputWriterBase):
     proto.set_key(key)
     proto.set_value(value)
     ctx.get_pool(pool_name).append(proto.Encode())
+
+  def _get_combiner_pool(self, ctx):
+    """Get the combiner pool of the context, if the job has a combiner.
+
+    Args:
+      ctx: an instance of context.Context.
+
+    Returns:
+      A _CombinerPool, or None if there's no combiner_spec mapper parameter.
+    """
+    combiner_pool = ctx.get_pool("combiner_pool")
+    if combiner_pool is None:
+      combiner_spec = ctx.mapreduce_spec.mapper.params.get(COMBINER_SPEC_PARAM)
+      if combiner_spec:
+        combiner_pool = _CombinerPool(util.for_name(combiner_spec),
+                                      self._partitioner, self._filenames, ctx)
+        ctx.register_pool("combiner_pool", combiner_pool)
+    return combiner_pool
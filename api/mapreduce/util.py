@@ -19,7 +19,8 @@
 
 
 __all__ = ["for_name", "is_generator_function", "get_short_name", "parse_bool",
-           "create_datastore_write_config",
+           "create_datastore_write_config", "batch_mapper",
+           "get_mapper_batch_size",
            "HugeTask", "HugeTaskHandler"]
 
 
@@ -128,6 +129,43 @@ def is_generator_function(obj):
                obj.func_code.co_flags & CO_GENERATOR))
 
 
+def batch_mapper(batch_size=100):
+  """Decorator for mapper handlers which take a list of inputs.
+
+  A batch mapper is called with a list of up to batch_size inputs, as
+  returned by the input reader (they are never expanded into separate
+  arguments), instead of with one input at a time. It may be a generator
+  yielding operations and outputs for the whole batch.
+
+  Args:
+    batch_size: maximum number of inputs per call as int.
+
+  Returns:
+    decorator which marks the handler function.
+  """
+  def decorator(func):
+    func.mapper_batch_size = batch_size
+    return func
+  return decorator
+
+
+def get_mapper_batch_size(handler):
+  """Return the batch size of a batch mapper handler, or None.
+
+  Args:
+    handler: a mapper handler function, method or callable instance.
+
+  Returns:
+    the batch_size given to batch_mapper() as int, or None if the handler
+    takes one input at a time.
+  """
+  batch_size = getattr(handler, "mapper_batch_size", None)
+  if batch_size is None and not inspect.isroutine(handler):
+    batch_size = getattr(getattr(handler, "__call__", None),
+                         "mapper_batch_size", None)
+  return batch_size
+
+
 def get_short_name(fq_name):
   """Returns the last component of the name."""
   return fq_name.split(".")[-1:][0]
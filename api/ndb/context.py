@@ -1,38 +1,86 @@
 """Context class."""
 
-# TODO: Handle things like request size limits.  E.g. what if we've
-# batched up 1000 entities to put and now the memcache call fails?
-
+import collections
 import logging
+import random
 import sys
+import time
 
 from google.appengine.api import datastore  # For taskqueue coordination
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 
 from google.appengine.datastore import datastore_rpc
+from google.appengine.datastore import entity_pb
 
 import ndb.key
 from ndb import model, tasklets, eventloop, utils
 
+# Value stored in memcache to mark a key as locked.  While a key is
+# locked, readers go straight to the datastore and don't write back.
+# Writers lock a key before writing the entity; readers lock a missing
+# key (using add(), so only one reader wins) before repopulating it.
+_LOCKED = 0
+
+# Expiration time (in seconds) for a lock.  This must exceed the time
+# a datastore write or a read-through may reasonably take.
+_LOCK_TIME = 32
+
+# Initial (and maximum) chunk sizes for the auto-batchers, matching the
+# datastore's per-RPC limits.
+_MAX_GET_KEYS = 1000
+_MAX_PUT_ENTITIES = 500
+_MAX_PUT_BYTES = 1024 * 1024
+
+# Transactions that fail to commit are retried after a random delay of
+# up to _TXN_BACKOFF_INITIAL * 2**(attempt-1) seconds, capped at
+# _TXN_BACKOFF_MAX seconds.
+_TXN_BACKOFF_INITIAL = 0.1
+_TXN_BACKOFF_MAX = 5.0
+
+# Bounds on what map_query() buffers: results fetched but not yet
+# handed to the callback, and callback Futures still running.
+_MAX_QUEUED_RESULTS = 1000
+_MAX_PENDING_CALLBACKS = 100
+
+# Number of retries for the transactions run on behalf of group_put().
+_GROUP_PUT_RETRIES = 5
+
 class AutoBatcher(object):
+  """Collects arguments for a tasklet and calls it with them in batches.
+
+  When the batch is run it is split into chunks of at most `limit`
+  items (and, if a sizer is given, at most `max_bytes` bytes), and up
+  to `max_concurrent` chunks are run at once.  The chunk limit adapts
+  to the observed latency of the tasklet: it is halved when a chunk
+  takes longer than `target_latency` seconds and doubled (up to the
+  initial limit) when a full chunk takes less than half of that.
+  """
 
-  def __init__(self, todo_tasklet):
+  def __init__(self, todo_tasklet, limit=1000, max_bytes=None, sizer=None,
+               max_concurrent=4, target_latency=1.0):
     # todo_tasklet is a tasklet to be called with list of (future, arg) pairs
     self._todo_tasklet = todo_tasklet
     self._todo = []  # List of (future, arg) pairs
     self._running = None  # Currently running tasklet, if any
+    self._max_limit = limit
+    self._limit = limit  # Current (adaptive) chunk limit
+    self._max_bytes = max_bytes
+    self._sizer = sizer  # Function mapping an arg to its size in bytes
+    self._max_concurrent = max_concurrent
+    self._target_latency = target_latency
+    self._histogram = collections.defaultdict(int)  # {bucket: count}
 
   def __repr__(self):
     return '%s(%s)' % (self.__class__.__name__, self._todo_tasklet.__name__)
 
   def add(self, arg):
-    fut = tasklets.Future('%s.add(%s)' % (self, arg))
+    fut = tasklets.Future(('%s.add(%s)', self, arg))
     if not self._todo:  # Schedule the callback
-      # We use the fact that regular tasklets are queued at time None,
-      # which puts them at absolute time 0 (i.e. ASAP -- still on a
-      # FIFO basis).  Callbacks explicitly scheduled with a delay of 0
-      # are only run after all immediately runnable tasklets have run.
+      # We use the fact that regular tasklets are queued with delay
+      # None, which puts them on the event loop's FIFO of immediately
+      # runnable calls.  Callbacks explicitly scheduled with a delay of
+      # 0 are only run after all immediately runnable tasklets have run.
       eventloop.queue_call(0, self._autobatcher_callback)
     self._todo.append((fut, arg))
     return fut
@@ -53,11 +101,71 @@ class AutoBatcher(object):
     # TODO: Use logging_debug(), at least if len(todo) == 1.
     logging.info('AutoBatcher(%s): %d items',
                  self._todo_tasklet.__name__, len(todo))
-    self._running = self._todo_tasklet(todo)
+    self._running = self._run_chunks(self._split(todo))
     # Add a callback to the Future to propagate exceptions,
     # since this Future is not normally checked otherwise.
     self._running.add_callback(self._running.check_success)
 
+  def _split(self, todo):
+    """Split a list of (future, arg) pairs into chunks.
+
+    Returns:
+      A deque of lists of (future, arg) pairs.
+    """
+    limit = self._limit
+    if self._sizer is None and len(todo) <= limit:
+      return collections.deque([todo])
+    chunks = collections.deque()
+    chunk = []
+    nbytes = 0
+    for item in todo:
+      size = 0
+      if self._sizer is not None:
+        size = self._sizer(item[1])
+      if chunk and (len(chunk) >= limit or
+                    (self._max_bytes is not None and
+                     nbytes + size > self._max_bytes)):
+        chunks.append(chunk)
+        chunk = []
+        nbytes = 0
+      chunk.append(item)
+      nbytes += size
+    if chunk:
+      chunks.append(chunk)
+    return chunks
+
+  @tasklets.tasklet
+  def _run_chunks(self, chunks):
+    @tasklets.tasklet
+    def worker():
+      while chunks:
+        chunk = chunks.popleft()
+        t0 = time.time()
+        yield self._todo_tasklet(chunk)
+        self._record_chunk(len(chunk), time.time() - t0)
+    nworkers = min(self._max_concurrent, len(chunks))
+    yield [worker() for _ in xrange(nworkers)]
+
+  def _record_chunk(self, size, latency):
+    """Update the histogram and the adaptive limit after a chunk ran."""
+    bucket = 1
+    while bucket < size:
+      bucket *= 2
+    self._histogram[bucket] += 1
+    if latency > self._target_latency:
+      self._limit = max(1, self._limit // 2)
+    elif latency < self._target_latency / 2 and size >= self._limit:
+      self._limit = min(self._max_limit, self._limit * 2)
+
+  def histogram(self):
+    """Return the chunk size histogram.
+
+    Returns:
+      A dict mapping a power of two N to the number of chunks run with
+      more than N/2 and at most N items.
+    """
+    return dict(self._histogram)
+
   @tasklets.tasklet
   def flush(self):
     while self._running or self._todo:
@@ -78,9 +186,20 @@ class Context(object):
       conn = model.make_connection()
     self._conn = conn
     self._auto_batcher_class = auto_batcher_class
-    self._get_batcher = auto_batcher_class(self._get_tasklet)
-    self._put_batcher = auto_batcher_class(self._put_tasklet)
-    self._delete_batcher = auto_batcher_class(self._delete_tasklet)
+    self._get_batcher = auto_batcher_class(self._get_tasklet,
+                                           limit=_MAX_GET_KEYS)
+    self._put_batcher = auto_batcher_class(self._put_tasklet,
+                                           limit=_MAX_PUT_ENTITIES,
+                                           max_bytes=_MAX_PUT_BYTES,
+                                           sizer=self._entity_size)
+    self._delete_batcher = auto_batcher_class(self._delete_tasklet,
+                                              limit=_MAX_PUT_ENTITIES)
+    # Chunks of group puts run one at a time, so that two chunks never
+    # contend for the same entity group.
+    self._group_put_batcher = auto_batcher_class(self._group_put_tasklet,
+                                                 limit=_MAX_PUT_ENTITIES,
+                                                 max_concurrent=1)
+    self._txn_stats = {}  # Maps entity group (or None) to a counts dict.
     self._cache = {}
     self._cache_policy = lambda key: True
     self._memcache_policy = lambda key: True
@@ -92,7 +211,37 @@ class Context(object):
   def flush(self):
     yield (self._get_batcher.flush(),
            self._put_batcher.flush(),
-           self._delete_batcher.flush())
+           self._delete_batcher.flush(),
+           self._group_put_batcher.flush())
+
+  def get_batch_histograms(self):
+    """Return the chunk size histograms of the auto-batchers.
+
+    Returns:
+      A dict mapping 'get', 'put' and 'delete' to the histogram of the
+      corresponding AutoBatcher; see AutoBatcher.histogram().
+    """
+    return {'get': self._get_batcher.histogram(),
+            'put': self._put_batcher.histogram(),
+            'delete': self._delete_batcher.histogram(),
+            'group_put': self._group_put_batcher.histogram()}
+
+  def get_transaction_stats(self):
+    """Return per-entity-group transaction statistics.
+
+    Returns:
+      A dict mapping the entity group Key passed to transaction() (or
+      None if none was given) to a dict with the keys 'attempts',
+      'commits', 'conflicts' (attempts whose commit failed), 'failures'
+      (transactions that ran out of retries) and 'backoff' (total
+      seconds spent waiting before retries).
+    """
+    return dict((group, dict(counts))
+                for group, counts in self._txn_stats.iteritems())
+
+  def _entity_size(self, ent_pb):
+    """Return the encoded size of an (entity, pb) pair, for the put batcher."""
+    return ent_pb[1].ByteSize()
 
   @tasklets.tasklet
   def _get_tasklet(self, todo):
@@ -101,36 +250,76 @@ class Context(object):
     keys = set(key for _, key in todo)
     memkeymap = dict((key, key.urlsafe())
                      for key in keys if self.should_memcache(key))
+    fillkeys = set()  # Memcache keys we hold the read-through lock for.
     if memkeymap:
       results = memcache.get_multi(memkeymap.values(),
                                    key_prefix=self._memcache_prefix)
       leftover = []
       for fut, key in todo:
         mkey = memkeymap.get(key)
-        if mkey is not None and mkey in results:
-          pb = results[mkey]
+        pb = results.get(mkey)
+        # Anything that isn't an entity (i.e. a lock) counts as a miss.
+        if isinstance(pb, entity_pb.EntityProto):
           ent = self._conn.adapter.pb_to_entity(pb)
           fut.set_result(ent)
         else:
           leftover.append((fut, key))
       todo = leftover
+      misses = [mkey for mkey in memkeymap.itervalues()
+                if mkey not in results]
+      if misses:
+        fillkeys = self._memcache_lock_for_fill(misses)
     if todo:
-      keys = [key for (_, key) in todo]
+      # Equal keys in the same batch are looked up only once; every
+      # Future waiting for such a key receives the same result.
+      keys = []
+      futmap = {}  # Maps key to list of Futures waiting for it.
+      for fut, key in todo:
+        futs = futmap.get(key)
+        if futs is None:
+          futs = futmap[key] = []
+          keys.append(key)
+        futs.append(fut)
       # TODO: What if async_get() created a non-trivial MultiRpc?
       results = yield self._conn.async_get(None, keys)
-      for ent, (fut, _) in zip(results, todo):
-        fut.set_result(ent)
+      for ent, key in zip(results, keys):
+        for fut in futmap[key]:
+          fut.set_result(ent)
+      if fillkeys:
+        # Write back what we read, grouped by timeout.  We use cas so
+        # that the write-back fails if a writer locked or updated the
+        # key since we took our lock.
+        mappings = {}  # Maps timeout value to {urlsafe_key: pb} mapping.
+        for ent, key in zip(results, keys):
+          mkey = memkeymap.get(key)
+          if ent is not None and mkey in fillkeys:
+            timeout = self._memcache_timeout_policy(key)
+            mapping = mappings.get(timeout)
+            if mapping is None:
+              mapping = mappings[timeout] = {}
+            mapping[mkey] = ent._to_pb(allow_partial=True)
+        for timeout, mapping in mappings.iteritems():
+          memcache.cas_multi(mapping, time=timeout,
+                             key_prefix=self._memcache_prefix)
+        # Locks for nonexistent entities are left to expire.
 
   @tasklets.tasklet
   def _put_tasklet(self, todo):
     assert todo
     # TODO: What if the same entity is being put twice?
     # TODO: What if two entities with the same key are being put?
-    # TODO: Clear entities from memcache before starting the write?
-    # TODO: Attempt to prevent dogpile effect while keeping cache consistent?
-    ents = [ent for (_, ent) in todo]
-    results = yield self._conn.async_put(None, ents)
-    for key, (fut, ent) in zip(results, todo):
+    # Entities were encoded once by put(); the adapter passes the
+    # protobufs through.
+    ents = [ent for (_, (ent, _)) in todo]
+    pbs = [pb for (_, (_, pb)) in todo]
+    # Lock the memcache entries for entities we are about to update, so
+    # that readers can neither see the old value nor write it back while
+    # the datastore write is in progress.  New entities (incomplete
+    # keys) can't be in memcache yet.
+    incomplete = set(id(ent) for ent in ents if not ent._has_complete_key())
+    self._memcache_lock(ent._key for ent in ents if id(ent) not in incomplete)
+    results = yield self._conn.async_put(None, pbs)
+    for key, (fut, (ent, _)) in zip(results, todo):
       if key != ent._key:
         if ent._has_complete_key():
           raise datastore_errors.BadKeyError(
@@ -138,13 +327,13 @@ class Context(object):
               'Expected %r, got %r' % (key, ent._key))
         ent._key = key
       fut.set_result(key)
-    # Now update memcache.
-    # TODO: Could we update memcache *before* calling async_put()?
-    # (Hm, not for new entities but possibly for updated ones.)
+    # Now update memcache.  This replaces the locks set above.
     mappings = {}  # Maps timeout value to {urlsafe_key: pb} mapping.
-    for _, ent in todo:
+    for _, (ent, pb) in todo:
       if self.should_memcache(ent._key):
-        pb = self._conn.adapter.entity_to_pb(ent)
+        if id(ent) in incomplete:
+          # Re-encode new entities, now that they have their key.
+          pb = self._conn.adapter.entity_to_pb(ent)
         timeout = self._memcache_timeout_policy(ent._key)
         mapping = mappings.get(timeout)
         if mapping is None:
@@ -167,15 +356,52 @@ class Context(object):
   def _delete_tasklet(self, todo):
     assert todo
     keys = set(key for (_, key) in todo)
+    # Lock the memcache entries rather than deleting them, so readers
+    # that started before the delete can't write the entity back.  The
+    # locks simply expire.
+    self._memcache_lock(keys)
     yield self._conn.async_delete(None, keys)
     for fut, _ in todo:
       fut.set_result(None)
-    # Now update memcache.
+
+  def _memcache_lock(self, keys):
+    """Internal helper to lock the memcache entries for some keys.
+
+    Args:
+      keys: An iterable of Key instances; keys for which the memcache
+        policy is off are skipped.
+    """
     memkeys = [key.urlsafe() for key in keys if self.should_memcache(key)]
     if memkeys:
-      memcache.delete_multi(memkeys, key_prefix=self._memcache_prefix)
-      # The value returned by delete_multi() is pretty much useless, it
-      # could be the keys were never cached in the first place.
+      memcache.set_multi(dict.fromkeys(memkeys, _LOCKED), time=_LOCK_TIME,
+                         key_prefix=self._memcache_prefix)
+
+  def _memcache_lock_for_fill(self, memkeys):
+    """Internal helper to lock missing memcache entries for a read-through.
+
+    This uses add(), so at most one reader gets to repopulate a given
+    key (which prevents the dogpile effect); readers that lose just use
+    the datastore.  The locks we did get are read back to obtain their
+    CAS ids, to be used by cas_multi() once the entities are read.
+
+    Args:
+      memkeys: A list of urlsafe key strings missing from memcache.
+
+    Returns:
+      A set containing the subset of memkeys that we locked.
+    """
+    failures = memcache.add_multi(dict.fromkeys(memkeys, _LOCKED),
+                                  time=_LOCK_TIME,
+                                  key_prefix=self._memcache_prefix)
+    locked = set(memkeys).difference(failures)
+    if not locked:
+      return locked
+    results = memcache.get_multi(list(locked), for_cas=True,
+                                 key_prefix=self._memcache_prefix)
+    # A writer may have replaced our lock already; then it's not ours.
+    return set(mkey for mkey in locked
+               if mkey in results and
+               not isinstance(results[mkey], entity_pb.EntityProto))
 
   def get_cache_policy(self):
     """Returns the current context cache policy function.
@@ -283,7 +509,9 @@ class Context(object):
 
   @tasklets.tasklet
   def put(self, entity):
-    key = yield self._put_batcher.add(entity)
+    # Encode the entity now, rather than once for sizing the batch and
+    # again for the RPC.
+    key = yield self._put_batcher.add((entity, entity._to_pb()))
     if entity._key != key:
       logging.info('replacing key %s with %s', entity._key, key)
       entity._key = key
@@ -313,9 +541,12 @@ class Context(object):
     @tasklets.tasklet
     def helper():
       try:
-        inq = tasklets.SerialQueueFuture()
+        inq = tasklets.SerialQueueFuture(maxsize=_MAX_QUEUED_RESULTS)
         query.run_to_queue(inq, self._conn, options)
         is_ancestor_query = query.ancestor is not None
+        bounded = isinstance(mfut, (tasklets.QueueFuture,
+                                    tasklets.SerialQueueFuture))
+        pending = collections.deque()  # Callback Futures still running.
         while True:
           try:
             batch, i, ent = yield inq.getq()
@@ -341,15 +572,22 @@ class Context(object):
                 continue
               # Replace the entity the callback will see with the one
               # from the cache.
-              if ent != self._cache[key]:
-                logging.info('Conflict: entity %s was modified', key)
-              ent = self._cache[key]
+              if ent._projection is not None:
+                # A partial entity from a projection query; project the
+                # cached entity the same way.
+                ent = self._cache[key]._project(ent._projection)
+              else:
+                if ent != self._cache[key]:
+                  logging.info('Conflict: entity %s was modified', key)
+                ent = self._cache[key]
             else:
               # Cache the entity only if this is an ancestor query;
               # non-ancestor queries may return stale results, since in
               # the HRD these queries are "eventually consistent".
+              # Partial entities from projection queries are never cached.
               # TODO: Shouldn't we check this before considering cache hits?
-              if is_ancestor_query and self.should_cache(key):
+              if (is_ancestor_query and ent._projection is None and
+                  self.should_cache(key)):
                 self._cache[key] = ent
           if callback is None:
             val = ent
@@ -360,6 +598,15 @@ class Context(object):
             else:
               val = callback(ent)
           mfut.putq(val)
+          # Don't run ahead of slow callbacks or a slow consumer.
+          if isinstance(val, tasklets.Future) and not val.done():
+            pending.append(val)
+            while pending and pending[0].done():
+              pending.popleft()
+            if len(pending) >= _MAX_PENDING_CALLBACKS:
+              yield pending.popleft()
+          if bounded and mfut.full():
+            yield mfut.wait_not_full()
       except Exception, err:
         _, _, tb = sys.exc_info()
         mfut.set_exception(err, tb)
@@ -373,19 +620,92 @@ class Context(object):
   @datastore_rpc._positional(2)
   def iter_query(self, query, callback=None, options=None):
     return self.map_query(query, callback=callback, options=options,
-                          merge_future=tasklets.SerialQueueFuture())
+                          merge_future=tasklets.SerialQueueFuture(
+                              maxsize=_MAX_QUEUED_RESULTS))
+
+  @tasklets.tasklet
+  def group_put(self, entity):
+    """Put an entity transactionally, together with its entity group.
+
+    Entities passed to group_put() in the same batch are grouped by the
+    root of their key, and each group is written in a single
+    transaction (retried with backoff on contention).  This spends one
+    entity group commit on many small writes.  Entities with no key or
+    an incomplete root key are each written in their own transaction.
+
+    Returns:
+      A Future whose result is the entity's key.
+    """
+    key = yield self._group_put_batcher.add(entity)
+    raise tasklets.Return(key)
+
+  @tasklets.tasklet
+  def _group_put_tasklet(self, todo):
+    assert todo
+    groups = {}  # Maps root key to list of (future, entity) pairs.
+    singles = []
+    for fut, ent in todo:
+      root = None
+      if ent._key is not None:
+        root = ent._key.root()
+      if root is None or root.id() is None:
+        singles.append([(fut, ent)])
+      else:
+        groups.setdefault(root, []).append((fut, ent))
+    yield ([self._put_group(items, root)
+            for root, items in groups.iteritems()] +
+           [self._put_group(items, None) for items in singles])
+
+  @tasklets.tasklet
+  def _put_group(self, todo, entity_group):
+    """Put a list of (future, entity) pairs in one transaction."""
+    ents = [ent for _, ent in todo]
+    @tasklets.tasklet
+    def callback():
+      ctx = tasklets.get_context()
+      keys = yield [ctx.put(ent) for ent in ents]
+      raise tasklets.Return(keys)
+    try:
+      keys = yield self._run_transaction(callback, _GROUP_PUT_RETRIES,
+                                         entity_group)
+    except Exception, err:
+      _, _, tb = sys.exc_info()
+      for fut, _ in todo:
+        fut.set_exception(err, tb)
+    else:
+      for (fut, _), key in zip(todo, keys):
+        fut.set_result(key)
 
   @tasklets.tasklet
   def transaction(self, callback, retry=3, entity_group=None):
     # Will invoke callback() one or more times with the default
     # context set to a new, transactional Context.  Returns a Future.
     # Callback may be a tasklet.
+    yield self.flush()
+    result = yield self._run_transaction(callback, retry, entity_group)
+    raise tasklets.Return(result)
+
+  @tasklets.tasklet
+  def _run_transaction(self, callback, retry, entity_group):
+    """Internal helper for transaction(); doesn't flush first."""
     if entity_group is not None:
       app = entity_group.app()
     else:
       app = ndb.key._DefaultAppId()
-    yield self.flush()
+    stats = self._txn_stats.get(entity_group)
+    if stats is None:
+      stats = self._txn_stats[entity_group] = {
+        'attempts': 0, 'commits': 0, 'conflicts': 0, 'failures': 0,
+        'backoff': 0.0}
     for i in range(1 + max(0, retry)):
+      if i:
+        # Back off before retrying, with jitter so that competing
+        # writers don't collide again.
+        delay = random.uniform(0, min(_TXN_BACKOFF_MAX,
+                                      _TXN_BACKOFF_INITIAL * 2**(i-1)))
+        stats['backoff'] += delay
+        yield tasklets.sleep(delay)
+      stats['attempts'] += 1
       transaction = yield self._conn.async_begin_transaction(None, app)
       tconn = datastore_rpc.TransactionalConnection(
         adapter=self._conn.adapter,
@@ -416,14 +736,17 @@ class Context(object):
         else:
           ok = yield tconn.async_commit(None)
           if ok:
+            stats['commits'] += 1
             # TODO: This is questionable when self is transactional.
             self._cache.update(tctx._cache)
             self._clear_memcache(tctx._cache)
             raise tasklets.Return(result)
+          stats['conflicts'] += 1
       finally:
         datastore._SetConnection(old_ds_conn)
 
     # Out of retries
+    stats['failures'] += 1
     raise datastore_errors.TransactionFailedError(
       'The transaction could not be committed. Please try again.')
 
@@ -469,6 +792,55 @@ class Context(object):
       ent = yield self.transaction(txn)
     raise tasklets.Return(ent)
 
+  @tasklets.tasklet
+  def get_or_insert_multi(self, entities):
+    """Get or insert many entities at once.
+
+    This first gets all keys in one batch.  Only the entities that
+    weren't found are inserted, using one transaction per entity group
+    (the transactions for different groups run in parallel).
+
+    Args:
+      entities: A sequence of Model instances with complete keys; an
+        entity is inserted if its key doesn't exist yet.
+
+    Returns:
+      A Future whose result is a list with, for each input entity, the
+      existing entity or the inserted one, in input order.
+    """
+    keys = [ent._key for ent in entities]
+    for key in keys:
+      assert key is not None and key.id() is not None, key
+    # TODO: Can (and should) the cache be trusted here?
+    results = yield [self.get(key) for key in keys]
+    missing = {}  # Maps root key to list of indexes into entities.
+    for i, ent in enumerate(results):
+      if ent is None:
+        missing.setdefault(keys[i].root(), []).append(i)
+    if not missing:
+      raise tasklets.Return(results)
+
+    @tasklets.tasklet
+    def insert_group(root, indexes):
+      @tasklets.tasklet
+      def txn():
+        ctx = tasklets.get_context()
+        found = yield [ctx.get(keys[i]) for i in indexes]
+        inserted = {}  # Maps key to entity; takes care of duplicate keys.
+        for i, ent in zip(indexes, found):
+          if ent is None and keys[i] not in inserted:
+            inserted[keys[i]] = entities[i]
+        yield [ctx.put(ent) for ent in inserted.itervalues()]
+        raise tasklets.Return([ent or inserted[keys[i]]
+                               for i, ent in zip(indexes, found)])
+      ents = yield self.transaction(txn, entity_group=root)
+      for i, ent in zip(indexes, ents):
+        results[i] = ent
+
+    yield [insert_group(root, indexes)
+           for root, indexes in missing.iteritems()]
+    raise tasklets.Return(results)
+
 
 def toplevel(func):
   """A sync tasklet that sets a fresh default Context.
@@ -488,4 +860,8 @@ def toplevel(func):
       return tasklets.synctasklet(func)(*args, **kwds)
     finally:
       eventloop.run()  # Ensure writes are flushed, etc.
+      stats = eventloop.get_stats()
+      if stats is not None:
+        logging.debug('Event loop stats for %s:\n%s',
+                     func.__name__, stats.summary())
   return add_context_wrapper
@@ -28,11 +28,11 @@ class MyAutoBatcher(context.AutoBatcher):
   def reset_log(cls):
     cls._log = []
 
-  def __init__(self, todo_tasklet):
+  def __init__(self, todo_tasklet, **kwds):
     def wrap(*args):
       self.__class__._log.append(args)
       return todo_tasklet(*args)
-    super(MyAutoBatcher, self).__init__(wrap)
+    super(MyAutoBatcher, self).__init__(wrap, **kwds)
 
 
 class ContextTests(test_utils.DatastoreTest):
@@ -68,6 +68,60 @@ class ContextTests(test_utils.DatastoreTest):
     self.assertEqual(ents, [None, None, None])
     self.assertEqual(len(MyAutoBatcher._log), 1)
 
+  def testContext_AutoBatcher_GetDuplicates(self):
+    ent = model.Model(key=model.Key('Foo', 1))
+    self.ctx.put(ent).get_result()
+    self.ctx.set_cache_policy(lambda key: False)
+    self.ctx.set_memcache_policy(lambda key: False)
+    @tasklets.tasklet
+    def foo():
+      futs = [self.ctx.get(model.Key('Foo', i)) for i in (1, 2, 1, 1)]
+      ents = yield futs
+      raise tasklets.Return(ents)
+    ents = foo().get_result()
+    self.assertEqual(ents, [ent, None, ent, ent])
+    self.assertTrue(ents[0] is ents[2])
+
+  def testAutoBatcher_Chunks(self):
+    log = []
+    @tasklets.tasklet
+    def todo_tasklet(todo):
+      log.append([arg for _, arg in todo])
+      for fut, arg in todo:
+        fut.set_result(arg)
+    ab = context.AutoBatcher(todo_tasklet, limit=3)
+    futs = [ab.add(i) for i in range(8)]
+    self.assertEqual([fut.get_result() for fut in futs], range(8))
+    self.assertEqual(log, [[0, 1, 2], [3, 4, 5], [6, 7]])
+    self.assertEqual(ab.histogram(), {2: 1, 4: 2})
+
+  def testAutoBatcher_Sizer(self):
+    log = []
+    @tasklets.tasklet
+    def todo_tasklet(todo):
+      log.append([arg for _, arg in todo])
+      for fut, arg in todo:
+        fut.set_result(arg)
+    ab = context.AutoBatcher(todo_tasklet, max_bytes=10, sizer=len)
+    args = ['aaaa', 'bbbb', 'cccc', 'd' * 12, 'e']
+    futs = [ab.add(arg) for arg in args]
+    self.assertEqual([fut.get_result() for fut in futs], args)
+    self.assertEqual(log, [['aaaa', 'bbbb'], ['cccc'], ['d' * 12], ['e']])
+
+  def testAutoBatcher_AdaptiveLimit(self):
+    log = []
+    @tasklets.tasklet
+    def todo_tasklet(todo):
+      log.append(len(todo))
+      for fut, arg in todo:
+        fut.set_result(arg)
+    # Every chunk is "too slow", so the limit keeps shrinking.
+    ab = context.AutoBatcher(todo_tasklet, limit=4, target_latency=-1)
+    tasklets.Future.wait_all([ab.add(i) for i in range(4)])
+    tasklets.Future.wait_all([ab.add(i) for i in range(4)])
+    self.assertEqual(log, [4, 2, 2])
+    self.assertEqual(ab._limit, 1)  # Whitebox.
+
   @tasklets.tasklet
   def create_entities(self):
     key0 = model.Key(flat=['Foo', None])
@@ -224,13 +278,18 @@ class ContextTests(test_utils.DatastoreTest):
       memcache.set_multi = tracking_set_multi
       memcache.flush_all()
 
+      lock = {'key_prefix': 'NDB:', 'time': context._LOCK_TIME}
       track = []
       foo().check_success()
-      self.assertEqual(len(track), 1)
+      self.assertEqual(len(track), 2)
       self.assertEqual(track[0][0],
+                       ({key1.urlsafe(): context._LOCKED,
+                         key2.urlsafe(): context._LOCKED},))
+      self.assertEqual(track[0][1], lock)
+      self.assertEqual(track[1][0],
                        ({key1.urlsafe(): ent1._to_pb(),
                          key2.urlsafe(): ent2._to_pb()},))
-      self.assertEqual(track[0][1], {'key_prefix': 'NDB:', 'time': 0})
+      self.assertEqual(track[1][1], {'key_prefix': 'NDB:', 'time': 0})
       memcache.flush_all()
 
       track = []
@@ -242,35 +301,83 @@ class ContextTests(test_utils.DatastoreTest):
       track = []
       self.ctx.set_memcache_policy(lambda key: key == key1)
       foo().check_success()
-      self.assertEqual(len(track), 1)
-      self.assertEqual(track[0][0],
+      self.assertEqual(len(track), 2)
+      self.assertEqual(track[0][0], ({key1.urlsafe(): context._LOCKED},))
+      self.assertEqual(track[0][1], lock)
+      self.assertEqual(track[1][0],
                        ({key1.urlsafe(): ent1._to_pb()},))
-      self.assertEqual(track[0][1], {'key_prefix': 'NDB:', 'time': 0})
+      self.assertEqual(track[1][1], {'key_prefix': 'NDB:', 'time': 0})
       memcache.flush_all()
 
       track = []
       self.ctx.set_memcache_policy(lambda key: True)
       self.ctx.set_memcache_timeout_policy(lambda key: key.id())
       foo().check_success()
-      self.assertEqual(len(track), 2)
-      self.assertEqual(track[0][0],
-                       ({key1.urlsafe(): ent1._to_pb()},))
-      self.assertEqual(track[0][1], {'key_prefix': 'NDB:', 'time': 1})
+      self.assertEqual(len(track), 3)
+      self.assertEqual(track[0][1], lock)
       self.assertEqual(track[1][0],
+                       ({key1.urlsafe(): ent1._to_pb()},))
+      self.assertEqual(track[1][1], {'key_prefix': 'NDB:', 'time': 1})
+      self.assertEqual(track[2][0],
                        ({key2.urlsafe(): ent2._to_pb()},))
-      self.assertEqual(track[1][1], {'key_prefix': 'NDB:', 'time': 2})
+      self.assertEqual(track[2][1], {'key_prefix': 'NDB:', 'time': 2})
       memcache.flush_all()
 
       track = []
       badkeys = [key2.urlsafe()]
       self.ctx.set_memcache_timeout_policy(lambda key: 0)
       foo().check_success()
-      self.assertEqual(len(track), 1)
-      self.assertEqual(track[0][2], badkeys)
+      self.assertEqual(len(track), 2)
+      self.assertEqual(track[1][2], badkeys)
       memcache.flush_all()
     finally:
       memcache.set_multi = save_set_multi
 
+  def testContext_MemcacheReadThrough(self):
+    self.ctx.set_cache_policy(lambda key: False)
+    key1 = model.Key('Foo', 1)
+    ent1 = model.Expando(key=key1, foo=42)
+    self.ctx.set_memcache_policy(lambda key: False)
+    self.ctx.put(ent1).get_result()
+    self.assertEqual(memcache.get(key1.urlsafe(), key_prefix='NDB:'), None)
+    # A miss locks the key, reads the datastore and writes back.
+    self.ctx.set_memcache_policy(lambda key: True)
+    self.assertEqual(self.ctx.get(key1).get_result(), ent1)
+    self.assertEqual(memcache.get(key1.urlsafe(), key_prefix='NDB:'),
+                     ent1._to_pb())
+    # The next get is served from memcache.
+    self.assertEqual(self.ctx.get(key1).get_result(), ent1)
+    # Nonexistent entities aren't written back.
+    key2 = model.Key('Foo', 2)
+    self.assertEqual(self.ctx.get(key2).get_result(), None)
+    self.assertEqual(memcache.get(key2.urlsafe(), key_prefix='NDB:'),
+                     context._LOCKED)
+
+  def testContext_MemcacheLocked(self):
+    self.ctx.set_cache_policy(lambda key: False)
+    key1 = model.Key('Foo', 1)
+    ent1 = model.Expando(key=key1, foo=42)
+    self.ctx.set_memcache_policy(lambda key: False)
+    self.ctx.put(ent1).get_result()
+    self.ctx.set_memcache_policy(lambda key: True)
+    # Somebody else holds the lock: read the datastore, don't write back.
+    memcache.set(key1.urlsafe(), context._LOCKED, key_prefix='NDB:')
+    self.assertEqual(self.ctx.get(key1).get_result(), ent1)
+    self.assertEqual(memcache.get(key1.urlsafe(), key_prefix='NDB:'),
+                     context._LOCKED)
+
+  def testContext_MemcacheDelete(self):
+    self.ctx.set_cache_policy(lambda key: False)
+    key1 = model.Key('Foo', 1)
+    ent1 = model.Expando(key=key1, foo=42)
+    self.ctx.put(ent1).get_result()
+    self.assertEqual(memcache.get(key1.urlsafe(), key_prefix='NDB:'),
+                     ent1._to_pb())
+    self.ctx.delete(key1).get_result()
+    self.assertEqual(memcache.get(key1.urlsafe(), key_prefix='NDB:'),
+                     context._LOCKED)
+    self.assertEqual(self.ctx.get(key1).get_result(), None)
+
   def testContext_CacheQuery(self):
     @tasklets.tasklet
     def foo():
@@ -469,6 +576,23 @@ class ContextTests(test_utils.DatastoreTest):
       yield self.ctx.transaction(callback)
     foo().check_success()
 
+  def testContext_GroupPut(self):
+    parent = model.Key('Parent', 1)
+    @tasklets.tasklet
+    def foo():
+      ents = [model.Expando(parent=parent, bar=i) for i in range(3)]
+      ents.append(model.Expando(bar=3))
+      keys = yield [self.ctx.group_put(ent) for ent in ents]
+      raise tasklets.Return(keys)
+    keys = foo().get_result()
+    self.assertEqual([key.parent() for key in keys], [parent] * 3 + [None])
+    self.assertEqual([key.get().bar for key in keys], range(4))
+    stats = self.ctx.get_transaction_stats()
+    self.assertEqual(stats[parent]['attempts'], 1)
+    self.assertEqual(stats[parent]['commits'], 1)
+    self.assertEqual(stats[parent]['conflicts'], 0)
+    self.assertEqual(stats[None]['commits'], 1)
+
   def testContext_GetOrInsert(self):
     # This also tests Context.transaction()
     class Mod(model.Model):
@@ -481,6 +605,27 @@ class ContextTests(test_utils.DatastoreTest):
       assert ent2 == ent
     foo().check_success()
 
+  def testContext_GetOrInsertMulti(self):
+    class Mod(model.Model):
+      data = model.StringProperty()
+    parent = model.Key('Parent', 1)
+    old = Mod(id='b', parent=parent, data='old')
+    self.ctx.put(old).get_result()
+    ents = [Mod(id='a', parent=parent, data='a'),
+            Mod(id='b', parent=parent, data='b'),
+            Mod(id='c', data='c'),
+            Mod(id='a', parent=parent, data='dup')]
+    res = self.ctx.get_or_insert_multi(ents).get_result()
+    self.assertEqual([ent.data for ent in res], ['a', 'old', 'c', 'a'])
+    self.assertTrue(res[0] is res[3])
+    self.assertEqual(self.ctx.get(ents[0].key).get_result().data, 'a')
+    stats = self.ctx.get_transaction_stats()
+    self.assertEqual(stats[parent]['commits'], 1)
+    self.assertEqual(stats[model.Key(Mod, 'c')]['commits'], 1)
+    res = self.ctx.get_or_insert_multi(ents).get_result()
+    self.assertEqual([ent.data for ent in res], ['a', 'old', 'c', 'a'])
+    self.assertEqual(self.ctx.get_transaction_stats()[parent]['attempts'], 1)
+
   def testContext_GetOrInsertWithParent(self):
     # This also tests Context.transaction()
     class Mod(model.Model):
@@ -10,10 +10,13 @@ enforcement of this requirement.
 The API here is inspired by Monocle.
 """
 
-import bisect
+import collections
+import heapq
+import itertools
 import logging
 import os
 import time
+import types
 
 from google.appengine.api.apiproxy_rpc import RPC
 
@@ -27,27 +30,110 @@ IDLE = RPC.IDLE
 RUNNING = RPC.RUNNING
 FINISHING = RPC.FINISHING
 
+class EventLoopStats(object):
+  """Profiling data collected by an EventLoop.
+
+  This is only collected after EventLoop.enable_stats() is called,
+  since timing every callback has a cost.  Callbacks that resume a
+  tasklet are attributed to the tasklet's generator function.
+  """
+
+  def __init__(self):
+    self.start = time.time()
+    self.calls = {}  # Maps callable name to [count, total seconds].
+    self.rpc_counts = {}  # Maps RPC method name to completion count.
+    self.rpc_wait = 0.0  # Total seconds blocked in MultiRpc.wait_any().
+    self.sync_waits = 0  # Number of Future.wait() calls that blocked.
+    self.sync_wait = 0.0  # Total seconds blocked in Future.wait().
+    self.max_current = 0  # Maximum depth of the immediate queue.
+    self.max_queue = 0  # Maximum depth of the timer queue.
+    self.max_rpcs = 0  # Maximum number of pending RPCs.
+
+  def add_call(self, name, seconds):
+    entry = self.calls.get(name)
+    if entry is None:
+      entry = self.calls[name] = [0, 0.0]
+    entry[0] += 1
+    entry[1] += seconds
+
+  def add_rpc(self, method, seconds):
+    self.rpc_counts[method] = self.rpc_counts.get(method, 0) + 1
+    self.rpc_wait += seconds
+
+  def add_depths(self, current, queue, rpcs):
+    if current > self.max_current:
+      self.max_current = current
+    if queue > self.max_queue:
+      self.max_queue = queue
+    if rpcs > self.max_rpcs:
+      self.max_rpcs = rpcs
+
+  def short_summary(self):
+    """Return a one-line summary, e.g. for use in a response header."""
+    ncalls = sum(count for count, _ in self.calls.itervalues())
+    cpu = sum(seconds for _, seconds in self.calls.itervalues())
+    rpcs = ','.join('%s:%d' % item for item in sorted(self.rpc_counts.items()))
+    return ('wall=%.3f calls=%d calls_time=%.3f rpc_wait=%.3f '
+            'sync_wait=%.3f rpcs=%s' %
+            (time.time() - self.start, ncalls, cpu, self.rpc_wait,
+             self.sync_wait, rpcs or '-'))
+
+  def summary(self, limit=10):
+    """Return a multi-line summary, listing the most expensive callables."""
+    lines = [self.short_summary(),
+             'max depth: current=%d queue=%d rpcs=%d; sync waits: %d' %
+             (self.max_current, self.max_queue, self.max_rpcs,
+              self.sync_waits)]
+    items = sorted(self.calls.iteritems(), key=lambda item: -item[1][1])
+    for name, (count, seconds) in items[:limit]:
+      lines.append('%8.3f %7d  %s' % (seconds, count, name))
+    return '\n'.join(lines)
+
+
+def _callable_name(callable, args):
+  """Internal helper to name a callback for EventLoopStats."""
+  for arg in args:
+    if isinstance(arg, types.GeneratorType):
+      # A Future method resuming a tasklet; blame the tasklet.
+      return 'tasklet ' + utils.code_info(arg.gi_code)
+  return getattr(callable, '__name__', None) or repr(callable)
+
+
 class EventLoop(object):
   """An event loop."""
 
-  # TODO: Use a separate queue for tasklets with delay=None.
-
   def __init__(self):
     """Constructor."""
-    self.queue = []
+    self.current = collections.deque()  # FIFO of (callable, args, kwds)
+    self.queue = []  # Heap of (when, seq, callable, args, kwds)
     self.rpcs = {}
+    # Tie-breaker for self.queue, so that callbacks scheduled for the
+    # same time run in FIFO order and callables are never compared.
+    self.seq = itertools.count()
+    self.stats = None  # EventLoopStats instance, if enabled.
+
+  def enable_stats(self):
+    """Start collecting profiling data; return the EventLoopStats object."""
+    if self.stats is None:
+      self.stats = EventLoopStats()
+    return self.stats
 
   # TODO: Rename to queue_callback?
   def queue_call(self, delay, callable, *args, **kwds):
-    """Schedule a function call at a specific time in the future."""
+    """Schedule a function call at a specific time in the future.
+
+    Calls with delay=None are run as soon as possible, in FIFO order,
+    before any calls scheduled with an explicit delay (even a delay of 0).
+    """
     if delay is None:
-      when = 0
-    elif delay < 1e9:
+      self.current.append((callable, args, kwds))
+      return
+    if delay < 1e9:
       when = delay + time.time()
     else:
       # Times over a billion seconds are assumed to be absolute.
       when = delay
-    bisect.insort(self.queue, (when, callable, args, kwds))
+    heapq.heappush(self.queue, (when, self.seq.next(), callable, args, kwds))
 
   def queue_rpc(self, rpc, callable=None, *args, **kwds):
     """Schedule an RPC with an optional callback.
@@ -86,30 +172,54 @@ class EventLoop(object):
       A time to sleep if something happened (may be 0);
       None if all queues are empty.
     """
+    stats = self.stats
+    if stats is not None:
+      stats.add_depths(len(self.current), len(self.queue), len(self.rpcs))
+    if self.current:
+      callable, args, kwds = self.current.popleft()
+      logging_debug('event: %s', callable.__name__)
+      self._call(stats, callable, args, kwds)
+      # TODO: What if it raises an exception?
+      return 0
     delay = None
     if self.queue:
       delay = self.queue[0][0] - time.time()
-      if delay is None or delay <= 0:
-        when, callable, args, kwds = self.queue.pop(0)
+      if delay <= 0:
+        when, _, callable, args, kwds = heapq.heappop(self.queue)
         logging_debug('event: %s', callable.__name__)
-        callable(*args, **kwds)
+        self._call(stats, callable, args, kwds)
         # TODO: What if it raises an exception?
         return 0
     if self.rpcs:
+      if stats is not None:
+        t0 = time.time()
       rpc = datastore_rpc.MultiRpc.wait_any(self.rpcs)
       if rpc is not None:
-        logging.info('rpc: %s', rpc.method)  # XXX Should be debug
+        logging_debug('rpc: %s', rpc.method)
+        if stats is not None:
+          stats.add_rpc(rpc.method, time.time() - t0)
         # Yes, wait_any() may return None even for a non-empty argument.
         # But no, it won't ever return an RPC not in its argument.
         assert rpc in self.rpcs, (rpc, self.rpcs)
         callable, args, kwds = self.rpcs[rpc]
         del self.rpcs[rpc]
         if callable is not None:
-          callable(*args, **kwds)
+          self._call(stats, callable, args, kwds)
           # TODO: Again, what about exceptions?
       return 0
     return delay
 
+  def _call(self, stats, callable, args, kwds):
+    """Internal helper to run a callback, timing it if stats are enabled."""
+    if stats is None:
+      callable(*args, **kwds)
+      return
+    t0 = time.time()
+    try:
+      callable(*args, **kwds)
+    finally:
+      stats.add_call(_callable_name(callable, args), time.time() - t0)
+
   def run1(self):
     """Run one item (a callback or an RPC wait_any) or sleep.
 
@@ -171,3 +281,11 @@ def run1():
 def run0():
   ev = get_event_loop()
   return ev.run0()
+
+def enable_stats():
+  ev = get_event_loop()
+  return ev.enable_stats()
+
+def get_stats():
+  ev = get_event_loop()
+  return ev.stats
@@ -0,0 +1,39 @@
+"""Benchmark for the event loop: run a long chain of tasklets.
+
+Each tasklet in the chain yields the next one, so every step schedules
+a few callbacks (all with delay=None).  This measures the cost of
+queue_call() and run0().
+
+Usage: python eventloop_bench.py [number_of_tasklets]
+"""
+
+import sys
+import time
+
+from ndb import eventloop, tasklets
+
+
+@tasklets.tasklet
+def chain(n):
+  if n <= 0:
+    raise tasklets.Return(0)
+  result = yield chain(n - 1)
+  raise tasklets.Return(result + 1)
+
+
+def main():
+  n = 100000
+  if sys.argv[1:]:
+    n = int(sys.argv[1])
+  t0 = time.time()
+  result = chain(n).get_result()
+  t1 = time.time()
+  assert result == n, (result, n)
+  ev = eventloop.get_event_loop()
+  assert not ev.current and not ev.queue and not ev.rpcs
+  print '%d tasklets in %.3f seconds (%.1f usec per tasklet)' % (
+    n, t1 - t0, (t1 - t0) * 1e6 / n)
+
+
+if __name__ == '__main__':
+  main()
@@ -26,7 +26,8 @@ class EventLoopTests(test_utils.DatastoreTest):
     eventloop.queue_call(2, g, 100, 'abc')
     t_after = time.time()
     self.assertEqual(len(self.ev.queue), 3)
-    [(t1, f1, a1, k1), (t2, f2, a2, k2), (t3, f3, a3, k3)] = self.ev.queue
+    [(t1, _, f1, a1, k1), (t2, _, f2, a2, k2),
+     (t3, _, f3, a3, k3)] = sorted(self.ev.queue)
     self.assertTrue(t1 < t2)
     self.assertTrue(t2 < t3)
     self.assertTrue(abs(t1 - (t_before + 1)) < t_after - t_before)
@@ -43,6 +44,7 @@ class EventLoopTests(test_utils.DatastoreTest):
     self.assertEqual(k3, {'c': 3, 'd': 4})
     # Delete queued events (they would fail or take a long time).
     ev = eventloop.get_event_loop()
+    ev.current.clear()
     ev.queue = []
     ev.rpcs = {}
 
@@ -55,6 +57,29 @@ class EventLoopTests(test_utils.DatastoreTest):
     eventloop.run()
     self.assertEqual(record, ['hello', 42])
 
+  def testQueueCurrent(self):
+    record = []
+    def foo(arg):
+      record.append(arg)
+    eventloop.queue_call(0, foo, 'zero')
+    eventloop.queue_call(None, foo, 1)
+    eventloop.queue_call(None, foo, 2)
+    self.assertEqual(len(self.ev.current), 2)
+    self.assertEqual(len(self.ev.queue), 1)
+    eventloop.run()
+    # Calls with delay=None run first, in FIFO order.
+    self.assertEqual(record, [1, 2, 'zero'])
+
+  def testRunSameTime(self):
+    record = []
+    def foo(arg):
+      record.append(arg)
+    when = time.time() + 0.1
+    for i in range(5):
+      eventloop.queue_call(when, foo, i)
+    eventloop.run()
+    self.assertEqual(record, range(5))
+
   def testRunWithRpcs(self):
     record = []
     def foo(arg):
@@ -68,6 +93,26 @@ class EventLoopTests(test_utils.DatastoreTest):
     self.assertEqual(record, [rpc.rpcs[0], 42])
     self.assertEqual(rpc.state, 2)  # TODO: Use apiproxy_rpc.RPC.FINISHING.
 
+  def testStats(self):
+    self.assertEqual(self.ev.stats, None)
+    stats = eventloop.enable_stats()
+    self.assertTrue(eventloop.get_stats() is stats)
+    def foo():
+      pass
+    eventloop.queue_call(None, foo)
+    eventloop.queue_call(None, foo)
+    eventloop.queue_call(0, foo)
+    rpc = self.conn.async_get(None, [])
+    eventloop.queue_rpc(rpc)
+    eventloop.run()
+    self.assertEqual(stats.calls['foo'][0], 3)
+    self.assertEqual(stats.max_current, 2)
+    self.assertEqual(stats.max_queue, 1)
+    self.assertEqual(stats.max_rpcs, 1)
+    self.assertEqual(stats.rpc_counts, {'Get': 1})
+    self.assertTrue(stats.short_summary().startswith('wall='))
+    self.assertTrue('foo' in stats.summary())
+
 def main():
   unittest.main()
 
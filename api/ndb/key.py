@@ -189,9 +189,15 @@ class Key(object):
   Keys may be pickled.
 
   Subclassing Key is best avoided; it would be hard to get right.
+
+  Internally a Key holds a tuple of normalized (kind, id) pairs plus
+  the app and namespace, and a precomputed hash.  The Reference and
+  its serialized and url-safe forms are only computed when first
+  needed, and then memoized.
   """
 
-  __slots__ = ['__reference']
+  __slots__ = ['__pairs', '__app', '__namespace', '__hash', '__reference',
+               '__serialized', '__urlsafe']
 
   def __new__(cls, *_args, **kwargs):
     """Constructor.  See the class docstring for arguments."""
@@ -205,9 +211,33 @@ class Key(object):
         assert 'flat' not in kwargs
         kwargs['flat'] = _args
     self = super(Key, cls).__new__(cls)
-    self.__reference = _ConstructReference(cls, **kwargs)
+    self.__init_parts(*_ConstructKeyParts(cls, **kwargs))
     return self
 
+  @classmethod
+  def _from_parts(cls, pairs, app, namespace):
+    """Internal constructor taking already normalized values.
+
+    Args:
+      pairs: A tuple of normalized (kind, id) pairs.
+      app: The application id (not empty).
+      namespace: The namespace ('' for none).
+    """
+    self = super(Key, cls).__new__(cls)
+    self.__init_parts(pairs, app, namespace)
+    return self
+
+  def __init_parts(self, pairs, app, namespace,
+                   reference=None, serialized=None, urlsafe=None):
+    """Private helper to initialize all slots."""
+    self.__pairs = pairs
+    self.__app = app
+    self.__namespace = namespace
+    self.__hash = hash(pairs)
+    self.__reference = reference
+    self.__serialized = serialized
+    self.__urlsafe = urlsafe
+
   def __repr__(self):
     """String representation, used by str() and repr().
 
@@ -238,15 +268,18 @@ class Key(object):
     # doesn't need to return a unique value -- it only needs to ensure
     # that the hashes of equal keys are equal, not the other way
     # around.
-    return hash(tuple(self._pairs()))
+    return self.__hash
 
   def __eq__(self, other):
     """Equality comparison operation."""
     if not isinstance(other, Key):
       return NotImplemented
-    return (tuple(self._pairs()) == tuple(other._pairs()) and
-            self.app() == other.app() and
-            self.namespace() == other.namespace())
+    if self is other:
+      return True
+    return (self.__hash == other.__hash and
+            self.__pairs == other.__pairs and
+            self.__app == other.__app and
+            self.__namespace == other.__namespace)
 
   def __ne__(self, other):
     """The opposite of __eq__."""
@@ -265,7 +298,7 @@ class Key(object):
     assert len(state) == 1
     kwargs = state[0]
     assert isinstance(kwargs, dict)
-    self.__reference = _ConstructReference(self.__class__, **kwargs)
+    self.__init_parts(*_ConstructKeyParts(self.__class__, **kwargs))
 
   def __getnewargs__(self):
     """Private API used for pickling."""
@@ -278,25 +311,25 @@ class Key(object):
 
     If there is only one (kind, id) pair, return None.
     """
-    pairs = self.pairs()
+    pairs = self.__pairs
     if len(pairs) <= 1:
       return None
-    return Key(pairs=pairs[:-1], app=self.app(), namespace=self.namespace())
+    return Key._from_parts(pairs[:-1], self.__app, self.__namespace)
 
   def root(self):
     """Return the root key.  This is either self or the highest parent."""
-    pairs = self.pairs()
+    pairs = self.__pairs
     if len(pairs) <= 1:
       return self
-    return Key(pairs=pairs[:1], app=self.app(), namespace=self.namespace())
+    return Key._from_parts(pairs[:1], self.__app, self.__namespace)
 
   def namespace(self):
     """Return the namespace."""
-    return self.__reference.name_space()
+    return self.__namespace
 
   def app(self):
     """Return the application id."""
-    return self.__reference.app()
+    return self.__app
 
   def id(self):
     """Return the string or integer id in the last (kind, id) pair, if any.
@@ -304,8 +337,7 @@ class Key(object):
     Returns:
       A string or integer id, or None if the key is incomplete.
     """
-    elem = self.__reference.path().element(-1)
-    return elem.name() or elem.id() or None
+    return self.__pairs[-1][1]
 
   def string_id(self):
     """Return the string id in the last (kind, id) pair, if any.
@@ -313,8 +345,10 @@ class Key(object):
     Returns:
       A string id, or None if the key has an integer id or is incomplete.
     """
-    elem = self.__reference.path().element(-1)
-    return elem.name() or None
+    idorname = self.__pairs[-1][1]
+    if isinstance(idorname, basestring):
+      return idorname
+    return None
 
   def integer_id(self):
     """Return the integer id in the last (kind, id) pair, if any.
@@ -322,41 +356,36 @@ class Key(object):
     Returns:
       An integer id, or None if the key has a string id or is incomplete.
     """
-    elem = self.__reference.path().element(-1)
-    return elem.id() or None
+    idorname = self.__pairs[-1][1]
+    if isinstance(idorname, (int, long)):
+      return idorname
+    return None
 
   def pairs(self):
     """Return a list of (kind, id) pairs."""
-    return list(self._pairs())
+    return list(self.__pairs)
 
   def _pairs(self):
     """Iterator yielding (kind, id) pairs."""
-    for elem in self.__reference.path().element_list():
-      kind = elem.type()
-      if elem.has_id():
-        idorname = elem.id()
-      else:
-        idorname = elem.name()
-      if not idorname:
-        idorname = None
-      yield (kind, idorname)
+    return iter(self.__pairs)
 
   def flat(self):
     """Return a list of alternating kind and id values."""
-    return list(self._flat())
+    flat = []
+    for pair in self.__pairs:
+      flat.extend(pair)
+    return flat
 
   def _flat(self):
     """Iterator yielding alternating kind and id values."""
-    for kind, idorname in self._pairs():
-      yield kind
-      yield idorname
+    return iter(self.flat())
 
   def kind(self):
     """Return the kind of the entity referenced.
 
     This is the kind from the last (kind, id) pair.
     """
-    return self.__reference.path().element(-1).type()
+    return self.__pairs[-1][0]
 
   def reference(self):
     """Return a copy of the Reference object for this Key.
@@ -364,7 +393,7 @@ class Key(object):
     This is a entity_pb.Reference instance -- a protocol buffer class
     used by the lower-level API to the datastore.
     """
-    return _ReferenceFromReference(self.__reference)
+    return _ReferenceFromReference(self._reference())
 
   def _reference(self):
     """Return the Reference object for this Key.
@@ -372,11 +401,20 @@ class Key(object):
     This is a backdoor API for internal use only.  The caller should
     not mutate the return value.
     """
-    return self.__reference
+    reference = self.__reference
+    if reference is None:
+      reference = _ReferenceFromNormalizedPairs(
+        self.__pairs, entity_pb.Reference(), self.__app, self.__namespace)
+      self.__reference = reference
+    return reference
 
   def serialized(self):
     """Return a serialized Reference object for this Key."""
-    return self.__reference.Encode()
+    serialized = self.__serialized
+    if serialized is None:
+      serialized = self._reference().Encode()
+      self.__serialized = serialized
+    return serialized
 
   def urlsafe(self):
     """Return a url-safe string encoding this Key's Reference.
@@ -385,9 +423,13 @@ class Key(object):
     the strings used to represent Keys in GQL and in the App Engine
     Admin Console.
     """
-    # This is 3-4x faster than urlsafe_b64decode()
-    urlsafe = base64.b64encode(self.__reference.Encode())
-    return urlsafe.rstrip('=').replace('+', '-').replace('/', '_')
+    urlsafe = self.__urlsafe
+    if urlsafe is None:
+      # This is 3-4x faster than urlsafe_b64decode()
+      urlsafe = base64.b64encode(self.serialized())
+      urlsafe = urlsafe.rstrip('=').replace('+', '-').replace('/', '_')
+      self.__urlsafe = urlsafe
+    return urlsafe
 
   # Datastore API using the default context.
   # These use local import since otherwise they'd be recursive imports.
@@ -430,10 +472,16 @@ class Key(object):
 # The remaining functions in this module are private.
 
 @datastore_rpc._positional(1)
-def _ConstructReference(cls, pairs=None, flat=None,
-                        reference=None, serialized=None, urlsafe=None,
-                        app=None, namespace=None, parent=None):
-  """Construct a Reference; the signature is the same as for Key."""
+def _ConstructKeyParts(cls, pairs=None, flat=None,
+                       reference=None, serialized=None, urlsafe=None,
+                       app=None, namespace=None, parent=None):
+  """Construct the parts of a Key; the signature is the same as for Key.
+
+  Returns:
+    A tuple (pairs, app, namespace, reference, serialized, urlsafe)
+    where pairs is a tuple of normalized (kind, id) pairs; reference,
+    serialized and urlsafe may be None if they weren't given.
+  """
   assert cls is Key
   howmany = (bool(pairs) + bool(flat) +
              bool(reference) + bool(serialized) + bool(urlsafe))
@@ -443,11 +491,15 @@ def _ConstructReference(cls, pairs=None, flat=None,
       assert len(flat) % 2 == 0
       pairs = [(flat[i], flat[i+1]) for i in xrange(0, len(flat), 2)]
     assert pairs
+    pairs = _NormalizePairs(pairs)
     if parent is not None:
       if not isinstance(parent, Key):
         raise datastore_errors.BadValueError(
             'Expected Key instance, got %r' % parent)
-      pairs[:0] = parent.pairs()
+      if parent.id() is None:
+        raise datastore_errors.BadArgumentError(
+            'Incomplete Key entry must be last')
+      pairs = tuple(parent._pairs()) + pairs
       if app:
         assert app == parent.app(), (app, parent.app())
       else:
@@ -457,39 +509,53 @@ def _ConstructReference(cls, pairs=None, flat=None,
                                                  parent.namespace())
       else:
         namespace = parent.namespace()
-    reference = _ReferenceFromPairs(pairs, app=app, namespace=namespace)
-  else:
-    # You can't combine parent= with reference=, serialized= or urlsafe=.
-    assert parent is None
-    if urlsafe:
-      serialized = _DecodeUrlSafe(urlsafe)
-    if serialized:
-      reference = _ReferenceFromSerialized(serialized)
-    assert reference.path().element_size()
-    # TODO: assert that each element has a type and either an id or a name
-    if not serialized:
-      reference = _ReferenceFromReference(reference)
-    # You needn't specify app= or namespace= together with reference=,
-    # serialized= or urlsafe=, but if you do, their values must match
-    # what is already in the reference.
-    if app is not None:
-      assert app == reference.app(), (app, reference.app())
-    if namespace is not None:
-      assert namespace == reference.name_space(), (namespace,
-                                                   reference.name_space())
-  return reference
-
-
-def _ReferenceFromPairs(pairs, reference=None, app=None, namespace=None):
-  """Construct a Reference from a list of pairs.
-
-  If a Reference is passed in as the second argument, it is modified
-  in place.  The app and namespace are set from the corresponding
-  keyword arguments, with the customary defaults.
+    # An empty app id means to use the default app id.
+    if not app:
+      app = _DefaultAppId()
+    # An empty namespace overrides the default namespace.
+    if namespace is None:
+      namespace = _DefaultNamespace()
+    return pairs, app, namespace, None, None, None
+
+  # You can't combine parent= with reference=, serialized= or urlsafe=.
+  assert parent is None
+  if urlsafe:
+    if isinstance(urlsafe, unicode):
+      urlsafe = urlsafe.encode('utf8')
+    serialized = _DecodeUrlSafe(urlsafe)
+    if '=' in urlsafe:
+      urlsafe = None  # Not in canonical form; don't memoize it.
+  if serialized:
+    if isinstance(serialized, unicode):
+      serialized = serialized.encode('utf8')
+    reference = _ReferenceFromSerialized(serialized)
+  assert reference.path().element_size()
+  # TODO: assert that each element has a type and either an id or a name
+  if not serialized:
+    reference = _ReferenceFromReference(reference)
+  # You needn't specify app= or namespace= together with reference=,
+  # serialized= or urlsafe=, but if you do, their values must match
+  # what is already in the reference.
+  if app is not None:
+    assert app == reference.app(), (app, reference.app())
+  if namespace is not None:
+    assert namespace == reference.name_space(), (namespace,
+                                                 reference.name_space())
+  return (_PairsFromReference(reference), reference.app(),
+          reference.name_space(), reference, serialized or None,
+          urlsafe or None)
+
+
+def _NormalizePairs(pairs):
+  """Validate and normalize a list of (kind, id) pairs.
+
+  Kinds given as Model classes are replaced by their kind name, and
+  Unicode kinds and string ids are encoded as UTF-8.
+
+  Returns:
+    A tuple of (kind, id) tuples.
   """
-  if reference is None:
-    reference = entity_pb.Reference()
-  path = reference.mutable_path()
+  result = []
   last = False
   for kind, idorname in pairs:
     if last:
@@ -506,29 +572,68 @@ def _ReferenceFromPairs(pairs, reference=None, app=None, namespace=None):
     if isinstance(kind, unicode):
       kind = kind.encode('utf8')
     assert 1 <= len(kind) <= 500
-    elem = path.add_element()
-    elem.set_type(kind)
     if isinstance(idorname, (int, long)):
       assert 1 <= idorname < 2**63
-      elem.set_id(idorname)
     elif isinstance(idorname, basestring):
       if isinstance(idorname, unicode):
         idorname = idorname.encode('utf8')
       assert 1 <= len(idorname) <= 500
-      elem.set_name(idorname)
     elif idorname is None:
-      elem.set_id(0)
       last = True
     else:
       assert False, 'bad idorname (%r)' % (idorname,)
+    result.append((kind, idorname))
+  return tuple(result)
+
+
+def _PairsFromReference(reference):
+  """Extract a tuple of (kind, id) pairs from a Reference."""
+  pairs = []
+  for elem in reference.path().element_list():
+    kind = elem.type()
+    if elem.has_id():
+      idorname = elem.id()
+    else:
+      idorname = elem.name()
+    if not idorname:
+      idorname = None
+    pairs.append((kind, idorname))
+  return tuple(pairs)
+
+
+def _ReferenceFromPairs(pairs, reference=None, app=None, namespace=None):
+  """Construct a Reference from a list of pairs.
+
+  If a Reference is passed in as the second argument, it is modified
+  in place.  The app and namespace are set from the corresponding
+  keyword arguments, with the customary defaults.
+  """
+  if reference is None:
+    reference = entity_pb.Reference()
   # An empty app id means to use the default app id.
   if not app:
     app = _DefaultAppId()
-  # Always set the app id, since it is mandatory.
-  reference.set_app(app)
   # An empty namespace overrides the default namespace.
   if namespace is None:
     namespace = _DefaultNamespace()
+  return _ReferenceFromNormalizedPairs(_NormalizePairs(pairs), reference,
+                                       app, namespace)
+
+
+def _ReferenceFromNormalizedPairs(pairs, reference, app, namespace):
+  """Fill in a Reference from normalized pairs, an app and a namespace."""
+  path = reference.mutable_path()
+  for kind, idorname in pairs:
+    elem = path.add_element()
+    elem.set_type(kind)
+    if idorname is None:
+      elem.set_id(0)
+    elif isinstance(idorname, basestring):
+      elem.set_name(idorname)
+    else:
+      elem.set_id(idorname)
+  # Always set the app id, since it is mandatory.
+  reference.set_app(app)
   # Only set the namespace if it is not empty.
   if namespace:
     reference.set_name_space(namespace)
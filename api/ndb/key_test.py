@@ -210,6 +210,23 @@ class KeyTests(unittest.TestCase):
     k = key.Key(flat=flat)
     self.assertEqual(hash(k), hash(tuple(pairs)))
 
+  def testMemoizedEncodings(self):
+    k = key.Key('Kind', 1, 'Subkind', 'foobar')
+    self.assertTrue(k.serialized() is k.serialized())
+    self.assertTrue(k.urlsafe() is k.urlsafe())
+    self.assertTrue(k._reference() is k._reference())
+    self.assertFalse(k.reference() is k._reference())
+    urlsafe = k.urlsafe()
+    kk = key.Key(urlsafe=urlsafe)
+    self.assertTrue(kk.urlsafe() is urlsafe)
+    self.assertEqual(kk, k)
+    self.assertEqual(hash(kk), hash(k))
+    self.assertEqual(kk.pairs(), k.pairs())
+    self.assertEqual(kk.parent(), key.Key('Kind', 1))
+    self.assertEqual(kk.string_id(), 'foobar')
+    self.assertEqual(kk.integer_id(), None)
+    self.assertEqual(kk.parent().integer_id(), 1)
+
   def testPickling(self):
     flat = ['Kind', 1, 'Subkind', 'foobar']
     pairs = [(flat[i], flat[i+1]) for i in xrange(0, len(flat), 2)]
@@ -290,6 +290,7 @@ __all__ = ['Key', 'ModelAdapter', 'ModelKey', 'MetaModel', 'Model', 'Expando',
            'get_multi', 'get_multi_async',
            'put_multi', 'put_multi_async',
            'delete_multi', 'delete_multi_async',
+           'get_or_insert_multi', 'get_or_insert_multi_async',
            ]
 
 
@@ -347,11 +348,10 @@ class ModelAdapter(datastore_rpc.AbstractAdapter):
   def pb_to_entity(self, pb):
     kind = None
     if pb.has_key():
-      # TODO: Fix the inefficiency here: we extract the key just so we
-      # can get the kind just so we can find the intended model class,
-      # but the key is extracted again and stored in the entity by _from_pb().
-      key = Key(reference=pb.key())
-      kind = key.kind()
+      # Read the kind straight from the last path element; _from_pb()
+      # constructs the Key that is stored in the entity.
+      path = pb.key().path()
+      kind = path.element(path.element_size() - 1).type()
     modelclass = Model._kind_map.get(kind, self.default_model)
     if modelclass is None:
       raise KindError("No implementation found for kind '%s'" % kind)
@@ -361,6 +361,8 @@ class ModelAdapter(datastore_rpc.AbstractAdapter):
     return entity
 
   def entity_to_pb(self, ent):
+    if isinstance(ent, entity_pb.EntityProto):
+      return ent  # Already encoded, e.g. by Context.put().
     pb = ent._to_pb()
     return pb
 
@@ -617,6 +619,8 @@ class Property(object):
     This assumes validation has already taken place.  For a repeated
     Property the value should be a list.
     """
+    if entity._pending is not None:
+      entity._pending.pop(self._name, None)  # Overwritten; never decode it.
     entity._values[self._name] = value
 
   def _set_value(self, entity, value):
@@ -625,6 +629,9 @@ class Property(object):
     This performs validation first.  For a repeated Property the value
     should be a list.
     """
+    if entity._projection is not None:
+      raise datastore_errors.BadRequestError(
+        'Cannot modify a partial entity returned by a projection query')
     if self._repeated:
       if not isinstance(value, (list, tuple)):
         raise datastore_errors.BadValueError('Expected list or tuple, got %r' %
@@ -640,7 +647,9 @@ class Property(object):
 
   def _has_value(self, entity):
     """Internal helper to ask if the entity has a value for this Property."""
-    return self._name in entity._values
+    if self._name in entity._values:
+      return True
+    return entity._pending is not None and self._name in entity._pending
 
   def _retrieve_value(self, entity):
     """Internal helper to retrieve the value for this Property from an entity.
@@ -648,6 +657,8 @@ class Property(object):
     This returns None if no value is set.  For a repeated Property
     this returns a list if a value is set, otherwise None.
     """
+    if entity._pending is not None:
+      entity._load_pending(self._name)
     return entity._values.get(self._name, self._default)
 
   def _get_value(self, entity):
@@ -669,6 +680,8 @@ class Property(object):
     not be serialized but requesting their value will return None (or
     an empty list in the case of a repeated Property).
     """
+    if entity._pending is not None:
+      entity._pending.pop(self._name, None)
     if self._name in entity._values:
       del entity._values[self._name]
 
@@ -728,6 +741,36 @@ class Property(object):
       if val is not None:
         self._db_set_value(v, p, val)
 
+  def _serializer_entry(self):
+    """Internal helper to precompute how Model._to_pb() serializes this.
+
+    Returns:
+      A tuple (prop, name, indexed, repeated, validate, db_set_value).
+      If this Property overrides _serialize(), name is None and the
+      caller must call prop._serialize() instead.
+    """
+    if self.__class__._serialize.im_func is not Property._serialize.im_func:
+      return (self, None, None, None, None, None)
+    validate = self._do_validate
+    if self._validator is None and self._choices is None:
+      validate = self._validate
+    return (self, self._name, self._indexed, self._repeated,
+            validate, self._db_set_value)
+
+  def _deserializer_entry(self):
+    """Internal helper to precompute how Model._from_pb() deserializes this.
+
+    Returns:
+      A tuple (prop, repeated, db_get_value), or None if this Property
+      overrides one of the methods that Model._from_pb() bypasses.
+    """
+    cls = self.__class__
+    for method in ('_deserialize', '_store_value', '_has_value',
+                   '_retrieve_value'):
+      if getattr(cls, method).im_func is not getattr(Property, method).im_func:
+        return None
+    return (self, self._repeated, self._db_get_value)
+
   def _deserialize(self, entity, p, depth=1):
     """Internal helper to deserialize this property from a protocol buffer.
 
@@ -1631,6 +1674,14 @@ class Model(object):
       @classmethod
       def _get_kind(cls):
         return 'AnotherKind'
+
+  Entities read from the datastore normally have all their properties
+  decoded up front.  For wide entities of which only a few properties
+  are used, set _lazy_deserialize = True in the class; each property is
+  then decoded from the protobuf the first time it is accessed:
+
+    class MyModel(Model):
+      _lazy_deserialize = True
   """
 
   __metaclass__ = MetaModel
@@ -1639,10 +1690,20 @@ class Model(object):
   _properties = None
   _has_repeated = False
   _kind_map = {}  # Dict mapping {kind: Model subclass}
+  _serializer_plan = ()  # List of Property._serializer_entry(), by name.
+  _serializer_entries = None  # Dict mapping {name: serializer entry}.
+  _dynamic_serializer_entries = None  # Cache for Expando dynamic properties.
+  _MAX_DYNAMIC_SERIALIZER_ENTRIES = 1000  # Bound on that cache, per class.
+  _deserializer_plan = None  # Dict mapping {name: deserializer entry}.
+
+  # Set this to True (in a Model subclass) to decode properties lazily.
+  _lazy_deserialize = False
 
   # Defaults for instance variables.
   _key = None
   _values = None
+  _pending = None  # Dict mapping {name: [(Property, pb Property), ...]}.
+  _projection = None  # Tuple of property names, for a partial entity.
 
   # Hardcoded pseudo-property for the key.
   key = ModelKey()
@@ -1840,8 +1901,44 @@ class Model(object):
       if elem.id() or elem.name():
         group.add_element().CopyFrom(elem)
 
-    for name, prop in sorted(self._properties.iteritems()):
-      prop._serialize(self, pb)
+    properties = self._properties
+    if properties is self.__class__._properties:
+      plan = self._serializer_plan
+    else:
+      # An Expando with dynamic properties.
+      plan = self._dynamic_serializer_plan(properties)
+    for prop, name, indexed, repeated, validate, db_set_value in plan:
+      if name is None:
+        prop._serialize(self, pb)
+        continue
+      value = prop._retrieve_value(self)
+      if not repeated:
+        if indexed:
+          p = pb.add_property()
+        else:
+          p = pb.add_raw_property()
+        p.set_name(name)
+        p.set_multiple(False)
+        v = p.mutable_value()
+        if value is not None:
+          db_set_value(v, p, value)
+        continue
+      if value is None:
+        continue
+      assert isinstance(value, list)
+      for val in value:
+        # Re-validate repeated values, since the user could have
+        # appended values to the list, bypassing validation.
+        val = validate(val)
+        if indexed:
+          p = pb.add_property()
+        else:
+          p = pb.add_raw_property()
+        p.set_name(name)
+        p.set_multiple(True)
+        v = p.mutable_value()
+        if val is not None:
+          db_set_value(v, p, val)
 
     return pb
 
@@ -1858,15 +1955,56 @@ class Model(object):
       if set_key or key.id() or key.parent():
         ent._key = key
 
+    pending = None
+    plan = cls._deserializer_plan
+    if cls._lazy_deserialize:
+      pending = {}
+      plan = None
+    values = ent._values
     indexed_properties = pb.property_list()
     unindexed_properties = pb.raw_property_list()
     for plist in [indexed_properties, unindexed_properties]:
       for p in plist:
+        if plan:
+          # Fast path for the common cases; see _deserializer_entry().
+          entry = plan.get(p.name())
+          if entry is not None:
+            prop, repeated, db_get_value = entry
+            name = prop._name
+            if name not in values:
+              val = db_get_value(p.value(), p)
+              if repeated:
+                val = [val]
+              values[name] = val
+              continue
+            if repeated:
+              vlist = values[name]
+              if isinstance(vlist, list):
+                vlist.append(db_get_value(p.value(), p))
+                continue
         prop = ent._get_property_for(p, plist is indexed_properties)
-        prop._deserialize(ent, p)
+        if pending is None:
+          prop._deserialize(ent, p)
+        else:
+          pending.setdefault(prop._name, []).append((prop, p))
+    if pending:
+      ent._pending = pending
 
     return ent
 
+  def _load_pending(self, name):
+    """Internal helper to decode a lazily deserialized property.
+
+    This is a no-op if there is nothing pending for the name.
+    """
+    pending = self._pending
+    items = pending.pop(name, None)
+    if not pending:
+      self._pending = None
+    if items:
+      for prop, p in items:
+        prop._deserialize(self, p)
+
   def _get_property_for(self, p, indexed=True, depth=0):
     """Internal helper to get the Property for a protobuf-level property."""
     name = p.name()
@@ -1878,6 +2016,24 @@ class Model(object):
       prop = self._fake_property(p, next, indexed)
     return prop
 
+  def _project(self, projection):
+    """Internal helper to make a read-only partial copy of this entity.
+
+    Only the properties whose names are in projection are copied.
+    """
+    ent = self.__class__()
+    ent._key = self._key
+    for name in projection:
+      prop = self._properties.get(name)
+      if prop is None or not prop._has_value(self):
+        continue
+      if prop is not ent._properties.get(name):
+        ent._clone_properties()
+        ent._properties[name] = prop
+      ent._values[name] = prop._retrieve_value(self)
+    ent._projection = tuple(projection)
+    return ent
+
   def _clone_properties(self):
     """Internal helper to clone self._properties if necessary."""
     cls = self.__class__
@@ -1930,8 +2086,52 @@ class Model(object):
         if prop._repeated:
           cls._has_repeated = True
         cls._properties[prop._name] = prop
+    cls._compile_plans()
     cls._kind_map[cls._get_kind()] = cls
 
+  @classmethod
+  def _compile_plans(cls):
+    """Internal helper to precompute the serializer and deserializer plans.
+
+    These let _to_pb() and _from_pb() skip most per-property dispatch.
+    This is called by _fix_up_properties().
+    """
+    cls._serializer_plan = [prop._serializer_entry()
+                            for _, prop in sorted(cls._properties.iteritems())]
+    cls._serializer_entries = dict((entry[0]._name, entry)
+                                   for entry in cls._serializer_plan)
+    cls._dynamic_serializer_entries = {}
+    plan = {}
+    for name, prop in cls._properties.iteritems():
+      entry = prop._deserializer_entry()
+      if entry is not None:
+        plan[name] = entry
+    cls._deserializer_plan = plan
+
+  @classmethod
+  def _dynamic_serializer_plan(cls, properties):
+    """Internal helper to build the serializer plan for an Expando.
+
+    Entries for the class's own properties come from the precompiled
+    plan.  Entries for dynamic properties are cached on the class by
+    name, type and options, since Expando creates a new Property object
+    for them in every entity.
+    """
+    static = cls._serializer_entries
+    cache = cls._dynamic_serializer_entries
+    plan = []
+    for name, prop in sorted(properties.iteritems()):
+      entry = static.get(name)
+      if entry is None or entry[0] is not prop:
+        cache_key = (name, prop.__class__, prop._indexed, prop._repeated)
+        entry = cache.get(cache_key)
+        if entry is None:
+          entry = prop._serializer_entry()
+          if len(cache) < cls._MAX_DYNAMIC_SERIALIZER_ENTRIES:
+            cache[cache_key] = entry
+      plan.append(entry)
+    return plan
+
   # Datastore API using the default context.
   # These use local import since otherwise they'd be recursive imports.
 
@@ -1971,6 +2171,9 @@ class Model(object):
     This is the asynchronous version of Model._put().
     """
     from ndb import tasklets
+    if self._projection is not None:
+      raise datastore_errors.BadRequestError(
+        'Cannot put a partial entity returned by a projection query')
     return tasklets.get_context().put(self)
   put_async = _put_async
 
@@ -2245,6 +2448,34 @@ def delete_multi(keys):
   return [future.get_result() for future in delete_multi_async(keys)]
 
 
+def get_or_insert_multi_async(entities):
+  """Fetches a sequence of entities, inserting those that don't exist.
+
+  Args:
+    entities: A sequence of Model instances with complete keys.
+
+  Returns:
+    A future whose result is a list of Model instances.
+  """
+  from ndb import tasklets
+  return tasklets.get_context().get_or_insert_multi(entities)
+
+
+def get_or_insert_multi(entities):
+  """Fetches a sequence of entities, inserting those that don't exist.
+
+  Only the missing entities are inserted, in one transaction per entity
+  group.
+
+  Args:
+    entities: A sequence of Model instances with complete keys.
+
+  Returns:
+    A list with, for each entity, the existing or the inserted entity.
+  """
+  return get_or_insert_multi_async(entities).get_result()
+
+
 # Update __all__ to contain all Property and Exception subclasses.
 for _name, _object in globals().items():
   if ((_name.endswith('Property') and issubclass(_object, Property)) or
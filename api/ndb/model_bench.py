@@ -0,0 +1,74 @@
+"""Benchmark for Model._to_pb() and Model._from_pb().
+
+This uses an Expando shaped like RecordIndex in api.py: a large
+repeated 'corpus' property plus a few dozen dynamic string properties.
+It compares the precompiled serializer/deserializer plans built by
+Model._compile_plans() against the generic per-Property code paths.
+
+Usage: python model_bench.py [count]
+"""
+
+import sys
+import time
+
+from google.appengine.datastore import entity_pb
+
+from ndb import model
+
+
+class RecordIndex(model.Expando):
+  corpus = model.StringProperty('c', repeated=True)
+
+
+def make_entity():
+  rec = dict(('concept%d' % i, 'value %d' % i) for i in range(40))
+  corpus = ['word%d' % i for i in range(200)]
+  ent = RecordIndex(id='bench', corpus=corpus)
+  for name, value in rec.iteritems():
+    setattr(ent, name, value)
+  return ent
+
+
+def generic_to_pb(ent):
+  # What _to_pb() did before it used the serializer plan.
+  pb = entity_pb.EntityProto()
+  pb.mutable_key().CopyFrom(ent._key._reference())
+  pb.mutable_entity_group()
+  for name, prop in sorted(ent._properties.iteritems()):
+    prop._serialize(ent, pb)
+  return pb
+
+
+def generic_from_pb(pb):
+  # What _from_pb() did before it used the deserializer plan.
+  ent = RecordIndex()
+  ent._key = model.Key(reference=pb.key())
+  for plist in [pb.property_list(), pb.raw_property_list()]:
+    for p in plist:
+      prop = ent._get_property_for(p, plist is pb.property_list())
+      prop._deserialize(ent, p)
+  return ent
+
+
+def timeit(func, arg, n):
+  t0 = time.time()
+  for i in xrange(n):
+    func(arg)
+  return (time.time() - t0) * 1e6 / n
+
+
+def main():
+  n = 1000
+  if sys.argv[1:]:
+    n = int(sys.argv[1])
+  ent = make_entity()
+  pb = ent._to_pb()
+  assert generic_from_pb(pb) == RecordIndex._from_pb(pb)
+  print 'to_pb:   generic %.1f usec, plan %.1f usec' % (
+    timeit(generic_to_pb, ent, n), timeit(RecordIndex._to_pb, ent, n))
+  print 'from_pb: generic %.1f usec, plan %.1f usec' % (
+    timeit(generic_from_pb, pb, n), timeit(RecordIndex._from_pb, pb, n))
+
+
+if __name__ == '__main__':
+  main()
@@ -1173,6 +1173,73 @@ class ModelTests(test_utils.DatastoreTest):
 
     self.assertRaises(AttributeError, getattr, p, 'foo')
 
+  def testSerializerPlans(self):
+    class Stamped(model.Model):
+      name = model.StringProperty('n')
+      tags = model.StringProperty(repeated=True, choices=['a', 'b'])
+      when = model.DateTimeProperty(auto_now=True)
+    plan = Stamped._serializer_plan
+    self.assertEqual([entry[1] for entry in plan], ['n', 'tags', None])
+    self.assertEqual(plan[1][4], Stamped.tags._do_validate)
+    self.assertEqual(plan[0][4], Stamped.name._validate)
+    self.assertEqual(sorted(Stamped._deserializer_plan), ['n', 'tags', 'when'])
+    ent = Stamped(name='x', tags=['a', 'b'])
+    ent.tags.append('c')  # Bypasses validation.
+    self.assertRaises(datastore_errors.BadValueError, ent._to_pb)
+    ent.tags.pop()
+    pb = ent._to_pb()
+    self.assertTrue(ent.when is not None)
+    self.assertEqual(Stamped._from_pb(pb), ent)
+
+  def testExpandoSerializerPlan(self):
+    class Ex(model.Expando):
+      static = model.StringProperty()
+    e1 = Ex(static='s', dyn=1)
+    e2 = Ex(static='t', dyn=2, more=['a'])
+    pb1 = e1._to_pb()
+    pb2 = e2._to_pb()
+    self.assertEqual(sorted(Ex._dynamic_serializer_entries),
+                     [('dyn', model.GenericProperty, True, False),
+                      ('more', model.GenericProperty, True, True)])
+    self.assertEqual(Ex._from_pb(pb1), e1)
+    self.assertEqual(Ex._from_pb(pb2), e2)
+
+  def testLazyDeserialize(self):
+    class Person(model.Model):
+      _lazy_deserialize = True
+      name = model.StringProperty()
+      bio = model.TextProperty()
+      tags = model.StringProperty(repeated=True)
+    p = Person(name='Fred', bio='x' * 1000, tags=['a', 'b'])
+    pb = p._to_pb()
+    q = Person._from_pb(pb)
+    self.assertEqual(q._values, {})
+    self.assertEqual(sorted(q._pending), ['bio', 'name', 'tags'])
+    self.assertEqual(q.name, 'Fred')
+    self.assertEqual(q._values, {'name': 'Fred'})
+    self.assertEqual(sorted(q._pending), ['bio', 'tags'])
+    # Assigning a value discards the pending protobuf without decoding it.
+    q.bio = 'short'
+    self.assertEqual(q._values, {'name': 'Fred', 'bio': 'short'})
+    self.assertEqual(sorted(q._pending), ['tags'])
+    self.assertTrue(Person.tags._has_value(q))
+    self.assertEqual(q.tags, ['a', 'b'])
+    self.assertEqual(q._pending, None)
+    q.bio = p.bio
+    self.assertEqual(q, p)
+
+  def testLazyDeserialize_Expando(self):
+    class Wide(model.Expando):
+      _lazy_deserialize = True
+    w = Wide(a=1, b='b', c=[1, 2])
+    pb = w._to_pb()
+    x = Wide._from_pb(pb)
+    self.assertEqual(x._values, {})
+    self.assertEqual(x.b, 'b')
+    self.assertEqual(x._values, {'b': 'b'})
+    self.assertEqual(x, w)
+    self.assertEqual(x._pending, None)
+
   def testModel_RenameSwap(self):
     class Person(model.Model):
       foo = model.StringProperty('bar')
@@ -95,9 +95,12 @@ options=QueryOptions(...).  The most important query options are:
   offset: int, skips this many results first
   start_cursor: Cursor, start returning results after this position
   end_cursor: Cursor, stop returning results after this position
-  batch_size: int, hint for the number of results returned per RPC
+  batch_size: int, hint for the number of results returned per RPC;
+    if not set, batches double in size as a long query proceeds
   prefetch_size: int, hint for the number of results in the first RPC
   produce_cursors: bool, return Cursor objects with the results
+  projection: list of Properties (or property names); if set the
+    results are read-only partial entities with only those properties
 
 For additional (obscure) query options and more details on them,
 including an explanation of Cursors, see datastore_query.py.
@@ -126,6 +129,7 @@ from __future__ import with_statement
 
 __author__ = 'guido@google.com (Guido van Rossum)'
 
+import collections
 import heapq
 import itertools
 import sys
@@ -160,6 +164,54 @@ _OPS = frozenset(['=', '!=', '<', '<=', '>', '>=', 'in'])
 # Default limit value.  (Yes, the datastore uses int32!)
 _MAX_LIMIT = 2**31 - 1
 
+# When no batch_size is given, successive batches of a query double in
+# size, starting from the datastore's default and up to this maximum.
+_INITIAL_BATCH_SIZE = 20
+_MAX_BATCH_SIZE = 1000
+
+# How many results the queue of each _MultiQuery subquery may buffer
+# before that subquery stops fetching more (see tasklets._FlowControl).
+_MAX_QUEUED_RESULTS = 1000
+
+# How many recent keys an ordered _MultiQuery remembers to drop
+# duplicates when it can't rely on duplicates being adjacent.
+_MAX_DEDUPE_WINDOW = 10000
+
+
+# Query.split() picks its split points from a sample of __scatter__
+# keys, like the mapreduce library's DatastoreInputReader.
+_SCATTER_PROPERTY = '__scatter__'
+_SPLIT_OVERSAMPLING_FACTOR = 32
+
+
+def _has_inequality_filter(node):
+  """Return True if a filter tree has an inequality on a property.
+
+  Inequalities on __key__ don't count; they combine with the key range
+  filters added by Query.split().
+  """
+  if isinstance(node, FilterNode):
+    name, opsymbol, _ = node._sort_key()
+    return name != _KEY and opsymbol not in ('=', 'in')
+  if isinstance(node, (ConjunctionNode, DisjunctionNode)):
+    for subnode in node:
+      if _has_inequality_filter(subnode):
+        return True
+  return False
+
+
+def _choose_split_keys(sample, shards):
+  """Return up to shards - 1 sorted, distinct keys evenly spaced in sample."""
+  sample = sorted(sample)
+  split_keys = []
+  for i in xrange(1, shards):
+    if not sample:
+      break
+    key = sample[len(sample) * i // shards]
+    if not split_keys or key != split_keys[-1]:
+      split_keys.append(key)
+  return split_keys
+
 
 # TODO: Once CL/21689469 is submitted, get rid of this and its callers.
 def _make_unsorted_key_value_map(pb, property_names):
@@ -261,6 +313,52 @@ class CompositePostFilter(datastore_query.CompositeFilter):
     return self._apply(key_value_map)
 
 
+def _strip_properties(pb, names):
+  """Remove properties whose (top-level) name isn't in names from an EntityProto.
+
+  This modifies pb in place.
+  """
+  for plist in pb.property_list(), pb.raw_property_list():
+    plist[:] = [p for p in plist
+                if p.name() in names or p.name().split('.', 1)[0] in names]
+
+
+class _ProjectionAdapter(datastore_rpc.AbstractAdapter):
+  """Adapter wrapper used to run a projection query.
+
+  The datastore doesn't support projection natively, so this strips
+  unneeded properties from each EntityProto before the wrapped adapter
+  turns it into an entity.  The resulting entities are marked as
+  read-only partial entities.
+  """
+
+  def __init__(self, adapter, names, projection):
+    self.adapter = adapter
+    self.names = names  # Properties to keep (includes filters and orders).
+    self.projection = projection
+
+  def __enter__(self):
+    self.adapter.__enter__()
+
+  def __exit__(self, *args):
+    self.adapter.__exit__(*args)
+
+  def pb_to_key(self, pb):
+    return self.adapter.pb_to_key(pb)
+
+  def key_to_pb(self, key):
+    return self.adapter.key_to_pb(key)
+
+  def pb_to_entity(self, pb):
+    _strip_properties(pb, self.names)
+    ent = self.adapter.pb_to_entity(pb)
+    ent._projection = self.projection
+    return ent
+
+  def entity_to_pb(self, ent):
+    return self.adapter.entity_to_pb(ent)
+
+
 class Binding(object):
   """Used with GQL; for now unsupported."""
 
@@ -648,7 +746,8 @@ class Query(object):
   """
 
   @datastore_rpc._positional(1)
-  def __init__(self, kind=None, ancestor=None, filters=None, orders=None):
+  def __init__(self, kind=None, ancestor=None, filters=None, orders=None,
+               projection=None):
     """Constructor.
 
     Args:
@@ -656,6 +755,7 @@ class Query(object):
       ancestor: Optional ancestor Key.
       filters: Optional Node representing a filter expression tree.
       orders: Optional datastore_query.Order object.
+      projection: Optional sequence of Properties or property names.
     """
     if ancestor is not None and not isinstance(ancestor, Binding):
       lastid = ancestor.pairs()[-1][1]
@@ -668,6 +768,9 @@ class Query(object):
     self.__ancestor = ancestor  # Key
     self.__filters = filters  # None or Node subclass
     self.__orders = orders  # None or datastore_query.Order instance
+    if projection is not None:
+      projection = _projection_to_names(projection)
+    self.__projection = projection  # None or tuple of property names
 
   def __repr__(self):
     args = []
@@ -679,6 +782,8 @@ class Query(object):
       args.append('filters=%r' % self.__filters)
     if self.__orders is not None:
       args.append('orders=...')  # PropertyOrder doesn't have a good repr().
+    if self.__projection is not None:
+      args.append('projection=%r' % (self.__projection,))
     return '%s(%s)' % (self.__class__.__name__, ', '.join(args))
 
   def _get_query(self, connection):
@@ -716,15 +821,32 @@ class Query(object):
 
       if dsquery is None:
         dsquery = self._get_query(conn)
-      orig_options = options
+      project = None
+      if self.__projection is not None and not (options is not None and
+                                                options.keys_only):
+        conn, project = self._get_projection_connection(conn)
+      # Unless a batch_size was given, grow the batches of a long scan
+      # so it takes fewer roundtrips.
+      grow = options is None or options.batch_size is None
+      batch_size = None
+      next_options = options
       rpc = dsquery.run_async(conn, options)
-      skipped = 0
-      count = 0
       while rpc is not None:
         batch = yield rpc
-        rpc = batch.next_batch_async(options)
+        if grow:
+          size = max(batch_size or _INITIAL_BATCH_SIZE, len(batch.results))
+          batch_size = min(2 * size, _MAX_BATCH_SIZE)
+          next_options = QueryOptions(config=options, batch_size=batch_size)
+        # Request the next batch before handing out this one, so the
+        # RPC overlaps with the consumer's processing of these results.
+        rpc = batch.next_batch_async(next_options)
         for i, result in enumerate(batch.results):
+          if project is not None:
+            result = result._project(project)
           queue.putq((batch, i, result))
+        if _queue_is_full(queue):
+          # Let the consumer catch up before fetching more.
+          yield queue.wait_not_full()
       queue.complete()
 
     except Exception:
@@ -733,6 +855,40 @@ class Query(object):
         queue.set_exception(e, tb)
       raise
 
+  def _get_projection_connection(self, conn):
+    """Internal helper to set up a projection query.
+
+    Returns:
+      A tuple (conn, project).  If possible, conn is a new connection
+      whose adapter strips properties before entities are created, and
+      project is None.  Otherwise (in a transaction), conn is unchanged
+      and project is the projection to apply to each entity instead.
+    """
+    if conn.__class__ is not datastore_rpc.Connection:
+      return conn, self.__projection
+    # Keep the properties needed for filtering and for merging ordered
+    # results (see _MultiQuery), in addition to the projection.
+    names = set(self.__projection)
+    if self.__orders is not None:
+      names |= self.__orders._get_prop_names()
+    filters = self.__filters
+    if filters is not None:
+      bindings = {}
+      filters = filters.resolve()
+      for post in False, True:
+        pred = filters._to_filter(bindings, post=post)
+        if pred is not None:
+          names |= pred._get_prop_names()
+    adapter = _ProjectionAdapter(conn.adapter, frozenset(names),
+                                 self.__projection)
+    return datastore_rpc.Connection(adapter=adapter, config=conn.config), None
+
+  def _with_projection(self, projection):
+    """Internal helper to return a copy of this Query with a projection."""
+    return self.__class__(kind=self.kind, ancestor=self.ancestor,
+                          filters=self.filters, orders=self.orders,
+                          projection=projection)
+
   def _maybe_multi_query(self):
     filters = self.__filters
     if filters is not None:
@@ -742,7 +898,8 @@ class Query(object):
         subqueries = []
         for subfilter in filters:
           subquery = Query(kind=self.__kind, ancestor=self.__ancestor,
-                           filters=subfilter, orders=self.__orders)
+                           filters=subfilter, orders=self.__orders,
+                           projection=self.__projection)
           subqueries.append(subquery)
         return _MultiQuery(subqueries)
     return None
@@ -767,6 +924,11 @@ class Query(object):
     """Accessor for the filters (a datastore_query.Order or None)."""
     return self.__orders
 
+  @property
+  def projection(self):
+    """Accessor for the projection (a tuple of property names or None)."""
+    return self.__projection
+
   def filter(self, *args):
     """Return a new Query with additional filter(s) applied."""
     if not args:
@@ -785,7 +947,8 @@ class Query(object):
     else:
       pred = ConjunctionNode(*preds)
     return self.__class__(kind=self.kind, ancestor=self.ancestor,
-                          orders=self.orders, filters=pred)
+                          orders=self.orders, filters=pred,
+                          projection=self.projection)
 
   def order(self, *args):
     """Return a new Query with additional sort order(s) applied."""
@@ -810,7 +973,8 @@ class Query(object):
     else:
       orders = datastore_query.CompositeOrder(orders)
     return self.__class__(kind=self.kind, ancestor=self.ancestor,
-                          filters=self.filters, orders=orders)
+                          filters=self.filters, orders=orders,
+                          projection=self.projection)
 
   # Datastore API using the default context.
 
@@ -823,6 +987,9 @@ class Query(object):
     Returns:
       A QueryIterator object.
     """
+    projection = q_options.pop('projection', None)
+    if projection is not None:
+      return QueryIterator(self._with_projection(projection), **q_options)
     return QueryIterator(self, **q_options)
 
   __iter__ = iter
@@ -867,10 +1034,131 @@ class Query(object):
 
     This is the asynchronous version of Query.map().
     """
-    return tasklets.get_context().map_query(self, callback,
+    qry = self
+    projection = q_options.pop('projection', None)
+    if projection is not None:
+      qry = self._with_projection(projection)
+    return tasklets.get_context().map_query(qry, callback,
                                             options=_make_options(q_options),
                                             merge_future=merge_future)
 
+  @datastore_rpc._positional(2)
+  def split(self, shards):
+    """Split this query into subqueries over disjoint key ranges.
+
+    The split points are chosen from a random sample of the kind's keys
+    (its __scatter__ property), so the subqueries cover roughly equal
+    numbers of entities of the kind.  Each subquery adds __key__ range
+    filters to this query; it can be run as a separate tasklet or
+    handed to a separate task queue worker.
+
+    Only queries with a kind, and without sort orders or inequality
+    filters on properties, can be split, since the datastore can't
+    combine those with __key__ range filters without a composite index.
+
+    Args:
+      shards: The desired number of subqueries.
+
+    Returns:
+      A list of at most that many Query objects, in key order, whose
+      results together are exactly the results of this query.  If no
+      sample is available (e.g. the kind is small) the list just
+      contains this query.
+
+    Raises:
+      BadArgumentError if the query has a sort order or an inequality
+      filter on a property.
+    """
+    return self.split_async(shards).get_result()
+
+  @tasklets.tasklet
+  @datastore_rpc._positional(2)
+  def split_async(self, shards):
+    """Split this query into subqueries over disjoint key ranges.
+
+    This is the asynchronous version of Query.split().
+    """
+    assert shards >= 1, shards
+    if self.__orders is not None:
+      raise datastore_errors.BadArgumentError(
+        'Cannot split a query with sort orders')
+    if self.__filters is not None and _has_inequality_filter(self.__filters):
+      raise datastore_errors.BadArgumentError(
+        'Cannot split a query with inequality filters')
+    if shards == 1 or self.__kind is None:
+      raise tasklets.Return([self])
+    # Sample the whole kind; an ancestor or filters on the sample query
+    # would need a composite index with __scatter__.
+    scatter = Query(kind=self.__kind,
+                    orders=datastore_query.PropertyOrder(_SCATTER_PROPERTY,
+                                                         _ASC))
+    sample = yield scatter.fetch_async(shards * _SPLIT_OVERSAMPLING_FACTOR,
+                                       keys_only=True)
+    if self.__ancestor is not None:
+      pairs = self.__ancestor.pairs()
+      sample = [key for key in sample if key.pairs()[:len(pairs)] == pairs]
+    split_keys = _choose_split_keys(
+      [datastore_types.Key(key.urlsafe()) for key in sample], shards)
+    if not split_keys:
+      raise tasklets.Return([self])
+    queries = [self.filter(FilterNode(_KEY, '<', split_keys[0]))]
+    for start, end in zip(split_keys, split_keys[1:]):
+      queries.append(self.filter(FilterNode(_KEY, '>=', start),
+                                 FilterNode(_KEY, '<', end)))
+    queries.append(self.filter(FilterNode(_KEY, '>=', split_keys[-1])))
+    raise tasklets.Return(queries)
+
+  @datastore_rpc._positional(3)
+  def map_multi(self, callback, shards, reducer=None, **q_options):
+    """Map a callback over the query results using parallel subqueries.
+
+    The query is split into subqueries (see split()), which are mapped
+    concurrently.
+
+    Args:
+      callback: A function or tasklet to be applied to each result; see
+        map().
+      shards: The desired number of subqueries.
+      reducer: Optional function taking a list of callback results and
+        returning a single value, like sum(); see tasklets.ReducingFuture.
+        It is applied incrementally to the results of each subquery and
+        then once more to the results of all subqueries.
+      **q_options: All query options keyword arguments are supported.
+
+    Returns:
+      Without a reducer, the list of callback results in key order;
+      with a reducer, the reduced value (None if there were no results).
+    """
+    return self.map_multi_async(callback, shards, reducer=reducer,
+                                **q_options).get_result()
+
+  @tasklets.tasklet
+  @datastore_rpc._positional(3)
+  def map_multi_async(self, callback, shards, reducer=None, **q_options):
+    """Map a callback over the query results using parallel subqueries.
+
+    This is the asynchronous version of Query.map_multi().
+    """
+    queries = yield self.split_async(shards)
+    if reducer is None:
+      results = yield [qry.map_async(callback, **dict(q_options))
+                       for qry in queries]
+      raise tasklets.Return(list(itertools.chain(*results)))
+    results = yield [qry.map_async(callback,
+                                   merge_future=tasklets.ReducingFuture(reducer),
+                                   **dict(q_options))
+                     for qry in queries]
+    # Combine the per-subquery values the way ReducingFuture does.
+    results = [res for res in results if res is not None]
+    if not results:
+      raise tasklets.Return(None)
+    if len(results) == 1:
+      raise tasklets.Return(results[0])
+    res = reducer(results)
+    if isinstance(res, tasklets.Future):
+      res = yield res
+    raise tasklets.Return(res)
+
   @datastore_rpc._positional(2)
   def fetch(self, limit=None, **q_options):
     """Fetch a list of query results, up to a limit.
@@ -957,6 +1245,7 @@ class Query(object):
     """
     # TODO: Support offset by incorporating it to the limit.
     assert 'offset' not in q_options, q_options
+    q_options.pop('projection', None)  # Irrelevant for counting.
     assert 'limit' not in q_options, q_options
     if limit is None:
       limit = _MAX_LIMIT
@@ -1036,6 +1325,25 @@ class Query(object):
     raise tasklets.Return(results, cursor, it.probably_has_next())
 
 
+def _projection_to_names(projection):
+  """Helper to convert a projection to a tuple of property names.
+
+  Args:
+    projection: A sequence of Property instances or property names.
+  """
+  if isinstance(projection, (basestring, model.Property)):
+    projection = [projection]
+  names = []
+  for prop in projection:
+    if isinstance(prop, model.Property):
+      prop = prop._name
+    assert isinstance(prop, basestring), repr(prop)
+    names.append(prop)
+  if not names:
+    raise datastore_errors.BadArgumentError('projection cannot be empty')
+  return tuple(names)
+
+
 def _make_options(q_options):
   """Helper to construct a QueryOptions object from keyword arguents.
 
@@ -1058,6 +1366,16 @@ def _make_options(q_options):
   return QueryOptions(**q_options)
 
 
+def _queue_is_full(queue):
+  """Helper to tell whether a bounded result queue is full.
+
+  Queues other than QueueFuture and SerialQueueFuture are never full.
+  """
+  return (isinstance(queue, (tasklets.QueueFuture,
+                             tasklets.SerialQueueFuture)) and
+          queue.full())
+
+
 class QueryIterator(object):
   """This iterator works both for synchronous and async callers!
 
@@ -1311,53 +1629,71 @@ class _MultiQuery(object):
           raise datastore_errors.BadArgumentError(
             '_MultiQuery with cursors requires __key__ order')
 
+    if offset is None:
+      offset = 0
+
+    if limit is None:
+      limit = _MAX_LIMIT
+
     # Decide if we need to modify the options passed to subqueries.
     # NOTE: It would seem we can sometimes let the datastore handle
     # the offset natively, but this would thwart the duplicate key
     # detection, so we always have to emulate the offset here.
     # We can set the limit we pass along to offset + limit though,
     # since that is the maximum number of results from a single
-    # subquery we will ever have to consider.
+    # subquery we will ever have to consider.  With a limit, each
+    # subquery's first batch is only its share of that, so the first
+    # results arrive sooner; later batches are at most offset + limit.
     modifiers = {}
     if offset:
       modifiers['offset'] = None
-      if limit is not None:
+      if limit < _MAX_LIMIT:
         modifiers['limit'] = min(_MAX_LIMIT, offset + limit)
+    if limit < _MAX_LIMIT:
+      wanted = min(_MAX_LIMIT, offset + limit)
+      share = max(1, -(-wanted // len(self.__subqueries)))
+      if options.prefetch_size is None or options.prefetch_size > share:
+        modifiers['prefetch_size'] = share
+      if options.batch_size is None or options.batch_size > wanted:
+        modifiers['batch_size'] = wanted
     if keys_only and self.__orders is not None:
       modifiers['keys_only'] = None
     if modifiers:
       options = QueryOptions(config=options, **modifiers)
 
-    if offset is None:
-      offset = 0
-
-    if limit is None:
-      limit = _MAX_LIMIT
-
     if self.__orders is None:
-      # Run the subqueries sequentially; there is no order to keep.
-      keys_seen = set()
+      # Run the subqueries concurrently; there is no order to keep, so
+      # results are passed on in the order in which they arrive.
+      merged = tasklets.QueueFuture('_MultiQuery.run_to_queue[unord]')
+      active = 0
       for subq in self.__subqueries:
-        if limit <= 0:
-          break
-        subit = tasklets.SerialQueueFuture('_MultiQuery.run_to_queue[ser]')
+        subit = tasklets.SerialQueueFuture('_MultiQuery.run_to_queue[ser]',
+                                           maxsize=_MAX_QUEUED_RESULTS)
         subq.run_to_queue(subit, conn, options=options)
-        while limit > 0:
-          try:
-            batch, index, result = yield subit.getq()
-          except EOFError:
-            break
-          if keys_only:
-            key = result
+        merged.add_dependent(self._next_result(subit))
+        active += 1
+      keys_seen = set()
+      while active and limit > 0:
+        subit, thing = yield merged.getq()
+        if thing is None:
+          active -= 1
+          continue
+        merged.add_dependent(self._next_result(subit))
+        batch, index, result = thing
+        if keys_only:
+          key = result
+        else:
+          key = result._key
+        if key not in keys_seen:
+          keys_seen.add(key)
+          if offset > 0:
+            offset -= 1
           else:
-            key = result._key
-          if key not in keys_seen:
-            keys_seen.add(key)
-            if offset > 0:
-              offset -= 1
-            else:
-              limit -= 1
-              queue.putq((None, None, result))
+            limit -= 1
+            queue.putq((None, None, result))
+            if _queue_is_full(queue):
+              yield queue.wait_not_full()
+      merged.complete()
       queue.complete()
       return
 
@@ -1366,16 +1702,20 @@ class _MultiQuery(object):
     # TODO: Does this interact properly with the cache?
     with conn.adapter:
       # Create a list of (first-entity, subquery-iterator) tuples.
-      state = []
+      # All subqueries are started before waiting for the first one.
+      dsqueries = []
+      futures = []
       for subq in self.__subqueries:
         dsquery = subq._get_query(conn)
-        subit = tasklets.SerialQueueFuture('_MultiQuery.run_to_queue[par]')
+        subit = tasklets.SerialQueueFuture('_MultiQuery.run_to_queue[par]',
+                                           maxsize=_MAX_QUEUED_RESULTS)
         subq.run_to_queue(subit, conn, options=options, dsquery=dsquery)
-        try:
-          thing = yield subit.getq()
-        except EOFError:
-          continue
-        else:
+        dsqueries.append(dsquery)
+        futures.append(self._next_result(subit))
+      firsts = yield futures
+      state = []
+      for dsquery, (subit, thing) in zip(dsqueries, firsts):
+        if thing is not None:
           state.append(_SubQueryIteratorState(thing, subit, dsquery,
                                               self.__orders))
 
@@ -1386,22 +1726,34 @@ class _MultiQuery(object):
 
       # Repeatedly yield the lowest entity from the state vector,
       # filtering duplicates.  This is essentially a multi-way merge
-      # sort.  One would think it should be possible to filter
-      # duplicates simply by dropping other entities already in the
-      # state vector that are equal to the lowest entity, but because of
-      # the weird sorting of repeated properties, we have to explicitly
-      # keep a set of all keys, so we can remove later occurrences.
-      # Note that entities will still be sorted correctly, within the
-      # constraints given by the sort order.
+      # sort.  If no sort order property can have multiple values,
+      # duplicates of an entity have equal sort keys and so come out
+      # of the heap adjacent to each other; then we only need to
+      # remember the keys in the current run of equal sort keys.
+      # Otherwise, because of the weird sorting of repeated properties,
+      # duplicates may be far apart, and we remember a bounded window
+      # of recent keys.  Note that entities will still be sorted
+      # correctly, within the constraints given by the sort order.
+      adjacent = self._duplicates_are_adjacent()
       keys_seen = set()
+      window = collections.deque()
+      group = None  # Snapshot of the first item of the current run.
       while state and limit > 0:
         item = heapq.heappop(state)
         batch = item.batch
         index = item.index
         entity = item.entity
         key = entity._key
+        if adjacent and (group is None or cmp(group, item) != 0):
+          keys_seen.clear()
+          group = _SubQueryIteratorState((batch, index, entity), None,
+                                         item.dsquery, self.__orders)
         if key not in keys_seen:
           keys_seen.add(key)
+          if not adjacent:
+            window.append(key)
+            if len(window) > _MAX_DEDUPE_WINDOW:
+              keys_seen.discard(window.popleft())
           if offset > 0:
             offset -= 1
           else:
@@ -1410,6 +1762,8 @@ class _MultiQuery(object):
               queue.putq((batch, index, key))
             else:
               queue.putq((batch, index, entity))
+            if _queue_is_full(queue):
+              yield queue.wait_not_full()
         subit = item.iterator
         try:
           batch, index, entity = yield subit.getq()
@@ -1422,6 +1776,36 @@ class _MultiQuery(object):
           heapq.heappush(state, item)
       queue.complete()
 
+  @tasklets.tasklet
+  def _next_result(self, subit):
+    """Helper to get the next result from a subquery.
+
+    Returns:
+      A tuple (subit, (batch, index, result)), or (subit, None) at EOF.
+    """
+    try:
+      thing = yield subit.getq()
+    except EOFError:
+      thing = None
+    raise tasklets.Return(subit, thing)
+
+  def _duplicates_are_adjacent(self):
+    """Helper to tell whether duplicates will have equal sort keys.
+
+    This is true if the model class is known and none of the sort
+    order properties can have multiple values.
+    """
+    modelclass = model.Model._kind_map.get(self.__subqueries[0].kind)
+    if modelclass is None or issubclass(modelclass, model.Expando):
+      return False
+    for name in self.__orders._get_prop_names():
+      if name == _KEY:
+        continue
+      prop = modelclass._properties.get(name)
+      if prop is None or prop._repeated:
+        return False
+    return True
+
   # Datastore API using the default context.
 
   def iter(self, **q_options):
@@ -361,6 +361,91 @@ class QueryTests(test_utils.DatastoreTest):
       self.assertEqual(res, [self.jill])
     foo()
 
+  def testFetchProjection(self):
+    q = query.Query(kind='Foo').filter(Foo.tags == 'jill').order(Foo.name)
+    res = q.fetch(10, projection=[Foo.name])
+    self.assertEqual([ent.name for ent in res], ['jill', 'joe'])
+    self.assertEqual([ent.key for ent in res], [self.jill.key, self.joe.key])
+    for ent in res:
+      self.assertEqual(ent._projection, ('name',))
+      self.assertEqual(ent.rate, None)
+      self.assertRaises(datastore_errors.BadRequestError,
+                        setattr, ent, 'name', 'x')
+      self.assertRaises(datastore_errors.BadRequestError, ent.put)
+
+  def testFetchProjectionUncached(self):
+    # Without the context cache the properties are stripped from the
+    # protobufs before the entities are created.
+    tasklets.get_context()._cache.clear()
+    q = Foo.query().order(Foo.name)
+    res = q.fetch(10, projection=['rate'])
+    self.assertEqual([ent.rate for ent in res], [2, 1, 1])
+    # Properties needed for the sort order are kept too.
+    self.assertEqual([ent.name for ent in res], ['jill', 'joe', 'moe'])
+    for ent in res:
+      self.assertEqual(ent._projection, ('rate',))
+      self.assertFalse(Foo.tags._has_value(ent))
+      self.assertFalse(ent.key in tasklets.get_context()._cache)
+    q = q.filter(Foo.tags.IN(['joe', 'jack']))
+    self.assertEqual(q.projection, None)
+    q = q._with_projection(Foo.rate)
+    self.assertEqual(q.projection, ('rate',))
+    self.assertEqual([ent.rate for ent in q], [2, 1])
+
+  def testBatchSizeGrowth(self):
+    model.put_multi([Foo(name='x%02d' % i, rate=i) for i in range(30)])
+    sizes = []
+    orig_next_batch_async = datastore_query.Batch.next_batch_async
+    def next_batch_async(batch, config=None):
+      sizes.append(config and config.batch_size)
+      return orig_next_batch_async(batch, config)
+    datastore_query.Batch.next_batch_async = next_batch_async
+    try:
+      q = Foo.query()
+      self.assertEqual(len(list(q.iter(prefetch_size=2))), 33)
+      self.assertEqual(sizes[0], 2 * query._INITIAL_BATCH_SIZE)
+      self.assertEqual(sizes, sorted(sizes))
+      del sizes[:]
+      self.assertEqual(len(list(q.iter(batch_size=5))), 33)
+      self.assertEqual(set(sizes), set([5]))
+    finally:
+      datastore_query.Batch.next_batch_async = orig_next_batch_async
+
+  def testSplit(self):
+    model.put_multi([Foo(name='x%02d' % i, rate=i) for i in range(20)])
+    q = Foo.query()
+    subqueries = q.split(4)
+    self.assertTrue(1 <= len(subqueries) <= 4)
+    keys = []
+    for subq in subqueries:
+      keys.extend(subq.fetch(keys_only=True))
+    self.assertEqual(keys, q.fetch(keys_only=True))
+    empty = q.filter(Foo.name == 'nobody')
+    self.assertEqual(len(empty.split(4)), 1)
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      q.order(Foo.name).split, 2)
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      q.filter(Foo.rate > 5).split, 2)
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      q.filter(Foo.name != 'x01').split, 2)
+    q.filter(Foo.name.IN(['x01', 'x02'])).split(2)
+
+  def testChooseSplitKeys(self):
+    self.assertEqual(query._choose_split_keys([], 4), [])
+    self.assertEqual(query._choose_split_keys(range(8, 0, -1), 4), [3, 5, 7])
+    self.assertEqual(query._choose_split_keys([1, 1, 1, 2], 4), [1, 2])
+    self.assertEqual(query._choose_split_keys([5], 4), [5])
+
+  def testMapMulti(self):
+    model.put_multi([Foo(name='x%02d' % i, rate=i) for i in range(20)])
+    q = Foo.query()
+    self.assertEqual(q.map_multi(lambda ent: ent.rate, 4),
+                     q.map(lambda ent: ent.rate))
+    self.assertEqual(q.map_multi(lambda ent: ent.rate, 4, reducer=sum),
+                     sum(range(20)) + 4)
+    self.assertEqual(q.filter(Foo.name == 'nobody').map_multi(
+        lambda ent: ent.rate, 4, reducer=sum), None)
+
   def testFetchEmpty(self):
     q = query.Query(kind='Foo').filter(Foo.tags == 'jillian')
     self.assertEqual(q.fetch(1), [])
@@ -577,6 +662,20 @@ class QueryTests(test_utils.DatastoreTest):
     self.assertEqual(q.fetch(1, offset=1), expected[1:])
     self.assertEqual(q.fetch(10, keys_only=True), [e._key for e in expected])
 
+  def testMultiQueryDuplicatesAreAdjacent(self):
+    q = Foo.query(Foo.tags.IN(['joe', 'jill']))
+    self.assertTrue(q.order(Foo.name)._maybe_multi_query()
+                    ._duplicates_are_adjacent())
+    self.assertTrue(q.order(Foo.rate, Foo.key)._maybe_multi_query()
+                    ._duplicates_are_adjacent())
+    self.assertFalse(q.order(Foo.tags)._maybe_multi_query()
+                     ._duplicates_are_adjacent())
+    # Repeated sort order: duplicates are found through the key window.
+    res = q.order(Foo.tags).fetch()
+    self.assertEqual(len(res), 2)
+    self.assertEqual(set(r.key for r in res),
+                     set([self.jill.key, self.joe.key]))
+
   def testMultiQueryCount(self):
     q = Foo.query(Foo.tags.IN(['joe', 'jill'])).order(Foo.name)
     self.assertEqual(q.count(10), 2)
@@ -63,6 +63,7 @@ import collections
 import logging
 import os
 import sys
+import time
 import types
 
 from google.appengine.api.apiproxy_stub_map import UserRPC
@@ -73,6 +74,9 @@ from ndb import eventloop, utils
 
 logging_debug = utils.logging_debug
 
+# Things a tasklet may yield to wait for an RPC.
+_RPC_TYPES = (UserRPC, datastore_rpc.MultiRpc)
+
 def is_generator(obj):
   """Helper to test for a generator object.
 
@@ -98,17 +102,26 @@ class Future(object):
   RUNNING = RPC.RUNNING  # Not yet completed.
   FINISHING = RPC.FINISHING  # Completed.
 
-  _all_pending = set()  # Set of all pending Future instances.
+  # Set of all pending Future instances.  This (like the stack saved in
+  # _where) is only maintained when utils.DEBUG is true.
+  _all_pending = set()
 
   # XXX Add docstrings to all methods.  Separate PEP 3148 API from RPC API.
 
-  _geninfo = None  # Extra info about suspended generator.
+  # Subclasses don't use __slots__; they are created far less often.
+  __slots__ = ('_info', '_where', '_context', '_done', '_result',
+               '_exception', '_traceback', '_callbacks', '_next', '_geninfo')
 
   def __init__(self, info=None):
     # TODO: Make done a method, to match PEP 3148?
     __ndb_debug__ = 'SKIP'  # Hide this frame from self._where
-    self._info = info  # Info from the caller about this Future's purpose.
-    self._where = utils.get_stack()
+    # Info from the caller about this Future's purpose.  This may be a
+    # tuple (format, arg, ...), which is only formatted by __repr__().
+    self._info = info
+    if utils.DEBUG:
+      self._where = utils.get_stack()
+    else:
+      self._where = ()
     self._context = None
     self._reset()
 
@@ -118,9 +131,11 @@ class Future(object):
     self._exception = None
     self._traceback = None
     self._callbacks = []
-    logging_debug('_all_pending: add %s', self)
-    self._all_pending.add(self)
     self._next = None  # Links suspended Futures together in a stack.
+    self._geninfo = None  # Extra info about suspended generator.
+    if utils.DEBUG:
+      logging_debug('_all_pending: add %s', self)
+      self._all_pending.add(self)
 
   # TODO: Add a __del__ that complains if neither get_exception() nor
   # check_success() was ever called?  What if it's not even done?
@@ -138,8 +153,11 @@ class Future(object):
     for line in self._where:
       if 'ndb/tasklets.py' not in line:
         break
-    if self._info:
-      line += ' for %s;' % self._info
+    info = self._info
+    if info:
+      if isinstance(info, tuple):
+        info = info[0] % info[1:]
+      line += ' for %s;' % info
     if self._geninfo:
       line += ' %s;' % self._geninfo
     return '<%s %x created by %s %s>' % (
@@ -186,8 +204,9 @@ class Future(object):
     assert not self._done
     self._result = result
     self._done = True
-    logging_debug('_all_pending: remove successful %s', self)
-    self._all_pending.remove(self)
+    if utils.DEBUG:
+      logging_debug('_all_pending: remove successful %s', self)
+      self._all_pending.discard(self)
     for callback, args, kwds  in self._callbacks:
       eventloop.queue_call(None, callback, *args, **kwds)
 
@@ -197,11 +216,12 @@ class Future(object):
     self._exception = exc
     self._traceback = tb
     self._done = True
-    if self in self._all_pending:
-      logging_debug('_all_pending: remove failing %s', self)
-      self._all_pending.remove(self)
-    else:
-      logging_debug('_all_pending: not found %s', self)
+    if utils.DEBUG:
+      if self in self._all_pending:
+        logging_debug('_all_pending: remove failing %s', self)
+        self._all_pending.remove(self)
+      else:
+        logging_debug('_all_pending: not found %s', self)
     for callback, args, kwds in self._callbacks:
       eventloop.queue_call(None, callback, *args, **kwds)
 
@@ -221,6 +241,9 @@ class Future(object):
     if self._done:
       return
     ev = eventloop.get_event_loop()
+    stats = ev.stats
+    if stats is not None:
+      t0 = time.time()
     while not self._done:
       if not ev.run1():
         logging.info('Deadlock in %s', self)
@@ -228,6 +251,9 @@ class Future(object):
         logging_debug('All pending Futures (verbose):\n%s',
                       self.dump_all_pending(verbose=True))
         self.set_exception(RuntimeError('Deadlock waiting for %s' % self))
+    if stats is not None:
+      stats.sync_waits += 1
+      stats.sync_wait += time.time() - t0
 
   def get_exception(self):
     self.wait()
@@ -269,12 +295,19 @@ class Future(object):
 
   def _help_tasklet_along(self, gen, val=None, exc=None, tb=None):
     # XXX Docstring
-    info = utils.gen_info(gen)
-    __ndb_debug__ = info
+    # This runs for every step of every tasklet, so it avoids work that
+    # is only needed for debugging unless utils.DEBUG is set.
+    global _context
+    info = None
+    if utils.DEBUG:
+      info = utils.gen_info(gen)
+      __ndb_debug__ = info
     try:
+      # get_context() marks os.environ, so after this call it's safe to
+      # swap the context by assigning the global directly.
       save_context = get_context()
       try:
-        set_context(self._context)
+        _context = self._context
         if exc is not None:
           logging_debug('Throwing %s(%s) into %s',
                         exc.__class__.__name__, exc, info)
@@ -284,7 +317,7 @@ class Future(object):
           value = gen.send(val)
           self._context = get_context()
       finally:
-        set_context(save_context)
+        _context = save_context
 
     except StopIteration, err:
       result = get_return_value(err)
@@ -295,28 +328,30 @@ class Future(object):
     except Exception, err:
       _, _, tb = sys.exc_info()
       logging.warning('%s raised %s(%s)',
-                      info, err.__class__.__name__, err,
+                      info or utils.gen_info(gen), err.__class__.__name__, err,
                       exc_info=(logging.getLogger().level <= logging.INFO))
       self.set_exception(err, tb)
       return
 
     else:
       logging_debug('%s yielded %r', info, value)
-      if isinstance(value, (UserRPC, datastore_rpc.MultiRpc)):
-        # TODO: Tail recursion if the RPC is already complete.
-        eventloop.queue_rpc(value, self._on_rpc_completion, value, gen)
-        return
       if isinstance(value, Future):
         # TODO: Tail recursion if the Future is already done.
         assert not self._next, self._next
         self._next = value
-        self._geninfo = utils.gen_info(gen)
+        if info is not None:
+          self._geninfo = info
         logging_debug('%s is now blocked waiting for %s', self, value)
         value.add_callback(self._on_future_completion, value, gen)
         return
+      if isinstance(value, _RPC_TYPES):
+        # TODO: Tail recursion if the RPC is already complete.
+        eventloop.queue_rpc(value, self._on_rpc_completion, value, gen)
+        return
       if isinstance(value, (tuple, list)):
         # Arrange for yield to return a list of results (not Futures).
-        info = 'multi-yield from ' + utils.gen_info(gen)
+        if info is not None:
+          info = 'multi-yield from ' + info
         mfut = MultiFuture(info)
         try:
           for subfuture in value:
@@ -358,7 +393,7 @@ def sleep(dt):
   Example:
     yield tasklets.sleep(0.5)  # Sleep for half a sec.
   """
-  fut = Future('sleep(%.3f)' % dt)
+  fut = Future(('sleep(%.3f)', dt))
   eventloop.queue_call(dt, fut.set_result, None)
   return fut
 
@@ -463,7 +498,48 @@ class MultiFuture(Future):
       self._finish()
 
 
-class QueueFuture(Future):
+class _FlowControl(object):
+  """Mixin adding optional flow control to QueueFuture and friends.
+
+  A queue created with maxsize > 0 is full() once that many results
+  are buffered.  putq() never blocks; instead, a producer tasklet
+  should yield the Future returned by wait_not_full(), which completes
+  once consumers have drained the queue to half of maxsize (or the
+  queue has failed).
+  """
+
+  _maxsize = 0
+  _not_full = None  # List of Futures returned by wait_not_full().
+
+  def qsize(self):
+    """Return the number of buffered results."""
+    raise NotImplementedError
+
+  def full(self):
+    """Return whether maxsize results are buffered."""
+    return self._maxsize > 0 and self.qsize() >= self._maxsize
+
+  def wait_not_full(self):
+    """Return a Future that completes when the queue has room again."""
+    fut = Future()
+    if not self.full() or self._done:
+      fut.set_result(None)
+    else:
+      if self._not_full is None:
+        self._not_full = []
+      self._not_full.append(fut)
+    return fut
+
+  def _drained(self, force=False):
+    """Wake up waiting producers after results were removed."""
+    waiters = self._not_full
+    if waiters and (force or self.qsize() <= self._maxsize // 2):
+      self._not_full = None
+      for fut in waiters:
+        fut.set_result(None)
+
+
+class QueueFuture(_FlowControl, Future):
   """A Queue following the same protocol as MultiFuture.
 
   However, instead of returning results as a list, it lets you
@@ -482,13 +558,16 @@ class QueueFuture(Future):
   the result instead of raising EOFError.  However, other exceptions
   are still passed through.
 
-  NOTE: Values can also be pushed directly via .putq(value).  However
-  there is no flow control -- if the producer is faster than the
-  consumer, the queue will grow unbounded.
+  NOTE: Values can also be pushed directly via .putq(value).  There
+  is no flow control unless a maxsize is given -- if the producer is
+  faster than the consumer, the queue will grow unbounded.  With a
+  maxsize, the producer should yield q.wait_not_full() when q.full()
+  returns True; pending dependents count towards the size.
   """
   # TODO: Refactor to share code with MultiFuture.
 
-  def __init__(self, info=None):
+  def __init__(self, info=None, maxsize=0):
+    self._maxsize = maxsize
     self._full = False
     self._dependents = set()
     self._completed = collections.deque()
@@ -509,9 +588,13 @@ class QueueFuture(Future):
   def set_exception(self, exc, tb=None):
     self._full = True
     super(QueueFuture, self).set_exception(exc, tb)
+    self._drained(force=True)
     if not self._dependents:
       self._mark_finished()
 
+  def qsize(self):
+    return len(self._completed) + len(self._dependents)
+
   def putq(self, value):
     if isinstance(value, Future):
       fut = value
@@ -538,6 +621,7 @@ class QueueFuture(Future):
     if self._waiting:
       waiter = self._waiting.popleft()
       self._pass_result(waiter, exc, tb, val)
+      self._drained()
     else:
       self._completed.append((exc, tb, val))
     if self._full and not self._dependents and not self._done:
@@ -555,6 +639,7 @@ class QueueFuture(Future):
     if self._completed:
       exc, tb, val = self._completed.popleft()
       self._pass_result(fut, exc, tb, val)
+      self._drained()
     elif self._full and not self._dependents:
       self._pass_eof(fut)
     else:
@@ -578,7 +663,7 @@ class QueueFuture(Future):
         fut.set_result(val)
 
 
-class SerialQueueFuture(Future):
+class SerialQueueFuture(_FlowControl, Future):
   """Like QueueFuture but maintains the order of insertion.
 
   This class is used by Query operations.
@@ -630,9 +715,14 @@ class SerialQueueFuture(Future):
 
   If, instead of complete(), set_exception() is called, the exception
   and traceback set there will be used instead of EOFError.
+
+  If maxsize is given, full() returns True once that many Futures are
+  in _queue, and producers should yield wait_not_full() to let
+  consumers catch up (see _FlowControl).
   """
 
-  def __init__(self, info=None):
+  def __init__(self, info=None, maxsize=0):
+    self._maxsize = maxsize
     self._full = False
     self._queue = collections.deque()
     self._waiting = collections.deque()
@@ -655,6 +745,10 @@ class SerialQueueFuture(Future):
     while self._waiting:
       waiter = self._waiting.popleft()
       waiter.set_exception(exc, tb)
+    self._drained(force=True)
+
+  def qsize(self):
+    return len(self._queue)
 
   def putq(self, value):
     if isinstance(value, Future):
@@ -683,6 +777,7 @@ class SerialQueueFuture(Future):
       # TODO: Isn't it better to call self.set_result(None) in complete()?
       if not self._queue and self._full and not self._done:
         self.set_result(None)
+      self._drained()
     else:
       fut = Future()
       if self._full:
@@ -722,12 +817,25 @@ class ReducingFuture(Future):
 
   NOTE: The reducer input values may be reordered compared to the
   order in which they were added to the queue.
+
+  If batch_size is None, it adapts to the cost of the reducer: it
+  starts at 20, doubles (up to 1000) while a reducer call takes less
+  than target_latency seconds, and is halved when a call takes longer.
   """
   # TODO: Refactor to reuse some code with MultiFuture.
 
-  def __init__(self, reducer, info=None, batch_size=20):
+  _MIN_BATCH_SIZE = 2
+  _INITIAL_BATCH_SIZE = 20
+  _MAX_BATCH_SIZE = 1000
+
+  def __init__(self, reducer, info=None, batch_size=None,
+               target_latency=0.01):
     self._reducer = reducer
+    self._adaptive = batch_size is None
+    if batch_size is None:
+      batch_size = self._INITIAL_BATCH_SIZE
     self._batch_size = batch_size
+    self._target_latency = target_latency
     self._full = False
     self._dependents = set()
     self._completed = collections.deque()
@@ -780,12 +888,15 @@ class ReducingFuture(Future):
     if len(self._queue) >= self._batch_size:
       todo = list(self._queue)
       self._queue.clear()
+      t0 = time.time()
       try:
         nval = self._reducer(todo)
       except Exception, err:
         _, _, tb = sys.exc_info()
         self.set_exception(err, tb)
         return
+      if self._adaptive:
+        self._adapt_batch_size(time.time() - t0)
       if isinstance(nval, Future):
         self._internal_add_dependent(nval)
       else:
@@ -793,6 +904,13 @@ class ReducingFuture(Future):
     if self._full and not self._dependents:
       self._mark_finished()
 
+  def _adapt_batch_size(self, latency):
+    """Grow or shrink the batch size after a reducer call."""
+    if latency > self._target_latency:
+      self._batch_size = max(self._MIN_BATCH_SIZE, self._batch_size // 2)
+    else:
+      self._batch_size = min(self._MAX_BATCH_SIZE, self._batch_size * 2)
+
   def _mark_finished(self):
     if not self._queue:
       self.set_result(None)
@@ -836,6 +954,8 @@ def get_return_value(err):
 def tasklet(func):
   # XXX Docstring
 
+  info = 'tasklet %s' % utils.func_info(func)
+
   @utils.wrapping(func)
   def tasklet_wrapper(*args, **kwds):
     # XXX Docstring
@@ -844,7 +964,7 @@ def tasklet(func):
     # generator and turn it into a tasklet dynamically.  (Monocle has
     # this I believe.)
     # __ndb_debug__ = utils.func_info(func)
-    fut = Future('tasklet %s' % utils.func_info(func))
+    fut = Future(info)
     fut._context = get_context()
     try:
       result = func(*args, **kwds)
@@ -52,6 +52,30 @@ class TaskletTests(test_utils.DatastoreTest):
                              repr(f)),
                     repr(f))
 
+  def testFuture_Repr_LazyInfo(self):
+    f = tasklets.Future(('%s+%s', 'a', 'b'))
+    self.assertTrue(' for a+b; pending>' in repr(f), repr(f))
+
+  def testFuture_ProductionMode(self):
+    from ndb import utils
+    save_debug = utils.DEBUG
+    utils.DEBUG = False
+    try:
+      f = tasklets.Future('prod')
+      self.assertEqual(f._where, ())
+      self.assertFalse(f in Future._all_pending)
+      f.set_result(42)
+      self.assertEqual(f.get_result(), 42)
+      @tasklets.tasklet
+      def add(a, b):
+        yield tasklets.sleep(0), tasklets.sleep(0)
+        raise tasklets.Return(a + b)
+      self.assertEqual(add(1, 2).get_result(), 3)
+      self.assertTrue(re.match(r'<Future [\da-f]+ created by \? for prod; '
+                               r'result 42>$', repr(f)), repr(f))
+    finally:
+      utils.DEBUG = save_debug
+
   def testFuture_Done_State(self):
     f = tasklets.Future()
     self.assertFalse(f.done())
@@ -430,6 +454,68 @@ class TaskletTests(test_utils.DatastoreTest):
     sqf.set_exception(KeyError())
     self.assertRaises(KeyError, sqf.getq().get_result)
 
+  def testSerialQueueFuture_MaxSize(self):
+    q = tasklets.SerialQueueFuture(maxsize=4)
+    log = []
+    @tasklets.tasklet
+    def producer():
+      for i in range(10):
+        q.putq(i)
+        log.append(('put', i, q.qsize()))
+        if q.full():
+          yield q.wait_not_full()
+      q.complete()
+    @tasklets.tasklet
+    def consumer():
+      res = []
+      while True:
+        try:
+          val = yield q.getq()
+        except EOFError:
+          break
+        res.append(val)
+      raise tasklets.Return(res)
+    @tasklets.synctasklet
+    def foo():
+      _, res = yield producer(), consumer()
+      self.assertEqual(res, range(10))
+    foo()
+    self.assertTrue(max(size for _, _, size in log) <= 4)
+
+  def testSerialQueueFuture_MaxSize_SetException(self):
+    q = tasklets.SerialQueueFuture(maxsize=1)
+    q.putq(1)
+    self.assertTrue(q.full())
+    fut = q.wait_not_full()
+    self.assertFalse(fut.done())
+    q.set_exception(KeyError())
+    self.assertTrue(fut.done())
+
+  def testQueueFuture_MaxSize(self):
+    q = tasklets.QueueFuture(maxsize=2)
+    self.assertFalse(q.full())
+    f1 = Future()
+    q.add_dependent(f1)
+    q.putq(2)
+    self.assertTrue(q.full())
+    fut = q.wait_not_full()
+    self.assertEqual(q.getq().get_result(), 2)
+    self.assertTrue(fut.done())
+    f1.set_result(1)
+    q.complete()
+    self.assertEqual(q.getq().get_result(), 1)
+
+  def testReducingFuture_Adaptive(self):
+    def reducer(arg):
+      return sum(arg)
+    rf = tasklets.ReducingFuture(reducer)
+    self.assertEqual(rf._batch_size, 20)
+    for i in range(100):
+      rf.putq(i)
+    rf.complete()
+    self.assertEqual(rf.get_result(), sum(range(100)))
+    self.assertTrue(rf._batch_size > 20)
+
   def testReducingFuture(self):
     def reducer(arg):
       return sum(arg)
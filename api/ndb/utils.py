@@ -2,7 +2,9 @@ import logging
 import os
 import sys
 
-DEBUG = True  # Set to False for some speedups
+# Debugging aids (e.g. recording where Futures were created) are on in the
+# dev appserver and outside App Engine, and off in production for speed.
+DEBUG = os.getenv('SERVER_SOFTWARE', 'Development').startswith('Development')
 
 def wrapping(wrapped):
   # A decorator to decorate a decorator's wrapper.  Following the lead